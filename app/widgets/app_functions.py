@@ -2,45 +2,96 @@
 
 # Imports ---------------------------------------------------------------------
 import os
+import time
 import streamlit as st
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from src.sto_generator import generate_sto
-from src.moco_track_kinematics import moco_track_states
+from src.moco_track_kinematics import moco_track_states, extract_muscle_fiber_data
 from src.force_vector_extractor import extract_force_vectors
+from src.pipeline import Stage, run_pipeline
+from utils.solver_telemetry import read_telemetry
+from app.widgets.app_visuals import visual_solver_telemetry
 
 
 # Defs ------------------------------------------------------------------------
 def run_moco(moco_path, osim_path, mat_path, output_path):
     if st.button("Run Moco"):
         try:
-            os.chdir(output_path)
             filter_params = {
                 "state_filters": ["jointset"],
                 "invert_filter": False,
             }
+            osim_path, mat_path = Path(osim_path).resolve(), Path(mat_path).resolve()
+            kinematics_file = Path(osim_path.stem + "_moco_track_states.sto")
+            solution_file = Path(kinematics_file.stem + "_solution_success.sto")
+            muscle_fiber_file = Path(solution_file.stem + "_muscle_fiber_data.sto")
+            telemetry_file = Path(output_path) / (kinematics_file.stem + "_telemetry.jsonl")
 
-            st.session_state.kinematics_path = generate_sto(
-                Path(mat_path),
-                model_file=Path(osim_path),
-            )
-            st.session_state.kinematics_path = os.path.join(
-                output_path, str(st.session_state.kinematics_path)
-            )
-            st.write(f"Kinematics written: {st.session_state.kinematics_path}")
+            # Stages with unchanged inputs are served from the previous run
+            stages = [
+                Stage(
+                    "kinematics",
+                    generate_sto,
+                    inputs=[mat_path, osim_path],
+                    outputs=[kinematics_file],
+                    kwargs=dict(
+                        input_file=mat_path,
+                        model_file=osim_path,
+                        output_file=kinematics_file,
+                    ),
+                ),
+                Stage(
+                    "track",
+                    moco_track_states,
+                    inputs=[osim_path, kinematics_file],
+                    outputs=[solution_file],
+                    kwargs=dict(
+                        model_file=osim_path,
+                        input_sto_file=kinematics_file,
+                        filter_params=filter_params,
+                        analyze_fibers=False,
+                        telemetry=telemetry_file,
+                    ),
+                ),
+                Stage(
+                    "fibers",
+                    extract_muscle_fiber_data,
+                    inputs=[osim_path, solution_file],
+                    outputs=[muscle_fiber_file],
+                    kwargs=dict(model_file=osim_path, solution_file=solution_file),
+                ),
+            ]
             st.write("Running Moco Track...")
+            # Solve in the background and chart the solver's telemetry meanwhile
+            chart = st.empty()
+            if telemetry_file.exists():
+                telemetry_file.unlink()
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(run_pipeline, stages, workdir=output_path)
+                while not future.done():
+                    visual_solver_telemetry(read_telemetry(telemetry_file), chart)
+                    time.sleep(1)
+                records = future.result()
+            if telemetry_file.exists():
+                visual_solver_telemetry(read_telemetry(telemetry_file), chart)
+            for name, record in records.items():
+                st.write(f"{name}: {record['status']} ({record['seconds']:.1f} s)")
+
+            failed = [r["error"] for r in records.values() if r["status"] == "failed"]
+            if failed:
+                st.error(f"An error occurred: {failed[0]}")
+                return
 
-            solution_path, muscle_fiber_path = moco_track_states(
-                Path(osim_path),
-                Path(st.session_state.kinematics_path),
-                filter_params,
+            st.session_state.kinematics_path = os.path.join(
+                output_path, str(kinematics_file)
             )
-            os.chdir(moco_path)
             st.session_state.moco_solution_path = os.path.join(
-                output_path, str(solution_path)
+                output_path, str(solution_file)
             )
             st.session_state.moco_solution_muscle_fiber_path = os.path.join(
-                output_path, str(muscle_fiber_path)
+                output_path, str(muscle_fiber_file)
             )
 
             st.success("Script executed successfully!")
@@ -52,12 +103,21 @@ def run_moco(moco_path, osim_path, mat_path, output_path):
 
 
 def force_vector_extraction(model, sto_data, output_path):
+    bundle = st.checkbox("Store in run bundle (HDF5)")
     if st.button("Extract force vectors"):
         try:
             (
                 st.session_state.force_origins_path,
                 st.session_state.force_vectors_path,
-            ) = extract_force_vectors(model, sto_data, output_path)
+            ) = extract_force_vectors(
+                model,
+                sto_data,
+                output_path,
+                workers=None,
+                bundle=bundle,
+            )
+            if bundle:
+                st.session_state.bundle_path = st.session_state.force_vectors_path
 
         except Exception as e:
             st.error(f"An error occurred: {e}")
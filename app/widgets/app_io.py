@@ -4,7 +4,7 @@
 import os
 import streamlit as st
 
-from src.sto_generator import read_mat_to_df
+from utils.mat_reader import list_mat_fields
 
 
 # Defs ------------------------------------------------------------------------
@@ -65,6 +65,12 @@ def setup_paths():
             "muscle_vectors.json",
         )
 
+    if "bundle_path" not in st.session_state:
+        st.session_state.bundle_path = find_file_in_dir(
+            st.session_state.output_path,
+            "_run.h5",
+        )
+
     if "gif_path" not in st.session_state:
         st.session_state.gif_path = find_file_in_dir(
             st.session_state.output_path,
@@ -81,6 +87,7 @@ def setup_paths():
 def find_file_in_dir(directory, string):
     for root, _, files in os.walk(directory):
         f = 0
+        osim_file = None
         for file in files:
             if string in file.lower():
                 f += 1
@@ -121,5 +128,5 @@ def mat_uploader():
 
     if st.session_state.mat_path is not None:
         with st.expander("Show .mat keyvalues", expanded=False):
-            df = read_mat_to_df(st.session_state.mat_path)
-            st.write([col[:-3] for col in df if col.endswith("Ang")])
+            fields = list_mat_fields(st.session_state.mat_path, suffixes=("Ang",))
+            st.write([field[:-3] for field in fields])
@@ -8,6 +8,7 @@ from app.widgets.app_visuals import (
     visual_validate_muscle_parameters,
     visual_force_vector_gif,
 )
+from utils.run_bundle import bundle_contents
 
 
 # Defs ------------------------------------------------------------------------
@@ -48,7 +49,11 @@ def page_moco():
         )
 
     # Validate muscle parameters ----------------------------------------------
-    if st.session_state.moco_solution_muscle_fiber_path is not None and os.path.exists(
+    if "muscle_fiber_data" in bundle_contents(st.session_state.bundle_path):
+        st.subheader("Muscle fiber parameters")
+
+        visual_validate_muscle_parameters(st.session_state.bundle_path)
+    elif st.session_state.moco_solution_muscle_fiber_path is not None and os.path.exists(
         st.session_state.moco_solution_muscle_fiber_path
     ):
         st.subheader("Muscle fiber parameters")
@@ -75,6 +80,14 @@ def page_force_vector():
             st.session_state.output_path,
         )
 
+    # Origins and vectors stored in a run bundle are read from it
+    if (
+        st.session_state.force_origins_path is None
+        or not os.path.exists(st.session_state.force_origins_path)
+    ) and "force_vectors" in bundle_contents(st.session_state.bundle_path):
+        st.session_state.force_origins_path = st.session_state.bundle_path
+        st.session_state.force_vectors_path = st.session_state.bundle_path
+
     if (
         st.session_state.force_origins_path is not None
         and st.session_state.force_vectors_path is not None
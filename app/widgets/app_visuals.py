@@ -10,12 +10,14 @@ import plotly.graph_objects as go
 
 from src.sto_generator import read_input
 from utils.generate_force_vector_gif import generate_vector_gif
+from utils.run_bundle import is_bundle, read_bundle_table
 
 
 # Defs ------------------------------------------------------------------------
 def visual_compare_timeseries(sto1, sto2):
     df, _ = read_input(sto1)
-    df2, _ = read_input(sto2)
+    # Only the input states are compared, skip the remaining solution columns
+    df2, _ = read_input(sto2, columns=list(df.columns))
 
     color_scale_df = pc.get_colorscale("Viridis")
     fig = go.Figure()
@@ -66,8 +68,55 @@ def visual_compare_timeseries(sto1, sto2):
     )
 
 
+def visual_solver_telemetry(records, placeholder):
+    """
+    Draw objective and constraint violation per IPOPT iteration into a
+    Streamlit placeholder, see `utils.solver_telemetry`.
+    """
+    iterations = [r for r in records if "event" not in r]
+    steps = list(range(len(iterations)))
+    fig = go.Figure()
+    fig.add_trace(
+        go.Scatter(
+            x=steps,
+            y=[r["objective"] for r in iterations],
+            mode="lines",
+            name="Objective",
+        )
+    )
+    fig.add_trace(
+        go.Scatter(
+            x=steps,
+            y=[r["inf_pr"] for r in iterations],
+            mode="lines",
+            name="Constraint violation",
+            yaxis="y2",
+        )
+    )
+    last = records[-1] if records else None
+    fig.update_layout(
+        title=(
+            f"{last['phase']}: iteration {last['iteration']}, {last['elapsed']:.0f} s"
+            if last
+            else "Waiting for solver"
+        ),
+        height=400,
+        xaxis_title="Iteration (all solves)",
+        yaxis=dict(title="Objective", type="log"),
+        yaxis2=dict(title="Constraint violation", type="log", overlaying="y", side="right"),
+        legend=dict(orientation="h", yanchor="top", y=-0.2, xanchor="right", x=0.5),
+    )
+    placeholder.plotly_chart(
+        fig,
+        use_container_width=True,
+    )
+
+
 def visual_validate_muscle_parameters(sto1):
-    df, _ = read_input(sto1)
+    if is_bundle(sto1):
+        df, _ = read_bundle_table(sto1, "muscle_fiber_data")
+    else:
+        df, _ = read_input(sto1)
 
     color_scale_df = pc.get_colorscale("Viridis")
     fig = go.Figure()
@@ -2,180 +2,722 @@
 
 # Imports ---------------------------------------------------------------------
 import os
+import sys
+import json
 import math
+import hashlib
+import argparse
 import numpy as np
 import pandas as pd
 import opensim as osim
 from pathlib import Path
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.file_cache import atomic_write, sidecar_path
+from utils.osim_model_parser import muscle_dependencies
+from utils.run_bundle import bundle_path, write_bundle_force_vectors
+from utils.solve_cache import code_digest
+from utils.sto_io import read_sto
+
+
+# Parse args ------------------------------------------------------------------
+def parse_arguments():
+    """
+    Parse CLI arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Extract muscle insertion points and force directions of a solution",
+        add_help=False,
+    )
+    parser.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        default=argparse.SUPPRESS,
+        help='Use switches followed by "=" to use CLI file autocomplete, example "-m="',
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        type=str,
+        help="Path to .osim model",
+        required=True,
+    )
+    parser.add_argument(
+        "-s",
+        "--sto",
+        type=str,
+        help="Solution .sto with coordinate values",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=".",
+        help="Output directory (default: working directory)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes, 0 for as many as the solution length pays for, "
+        "up to all cores (default: 1)",
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk_size",
+        type=int,
+        default=None,
+        help="Rows per worker chunk (default: about four chunks per worker)",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Extract every muscle and frame, bypassing the force vector cache",
+    )
+    parser.add_argument(
+        "--bundle",
+        action="store_true",
+        help="Write into the run bundle <solution stem>_run.h5 instead of JSON",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Store single precision in the run bundle",
+    )
+    parser.add_argument(
+        "--check",
+        type=int,
+        default=0,
+        metavar="FRAMES",
+        help="Only compare this many frames against the original per-frame loop",
+    )
+    return parser.parse_args()
 
 
 # Defs ------------------------------------------------------------------------
-def extract_force_vectors(osim_path, sto_path, output_path):
-    # Load input
-    model = osim.Model(osim_path)
-    sto_data = osim.TimeSeriesTable(sto_path)
+@dataclass
+class ForceVectors:
+    """
+    Muscle insertion points and force directions over time.
+
+    `origins` holds the insertion point of every muscle in its parent frame,
+    `directions` the unit vector from the insertion towards the previous path
+    point, expressed in the insertion frame (ground to insertion frame
+    rotation, as `ground.findTransformBetween(state, frame).R()`) and
+    converted with `np.degrees` component-wise, both shaped (time, muscle, 3).
+    """
+    time: np.ndarray
+    muscles: list
+    origins: np.ndarray
+    directions: np.ndarray
+
+
+@dataclass
+class MusclePath:
+    """
+    Handles of a muscle's last two path points, resolved once per model.
+
+    Paths of fixed `PathPoint`s without wrapping are `static`: the two points
+    are constant in their frames (indices into the engine's frame list).
+    Other paths are evaluated through `getPointForceDirections` each frame.
+    """
+    name: str
+    muscle: object
+    static: bool
+    insertion_frame: int = -1
+    previous_frame: int = -1
+    insertion: np.ndarray = None
+    previous: np.ndarray = None
 
-    # Initiate output
-    force_origins = {}
-    force_directions = {"time": []}
-    previous = {}
-    current = {}
 
+def _vec3(vec):
+    return np.array([vec[0], vec[1], vec[2]])
+
+
+def coordinate_labels(labels, model):
+    """
+    Map .sto coordinate value columns to model coordinate names.
+
+    returns: dict of column label to coordinate name
+    """
+    model_coordinates = {coord.getName() for coord in model.getCoordinateSet()}
+    return {
+        label: label.split("/")[-2]
+        for label in labels
+        if label.endswith("/value") and label.split("/")[-2] in model_coordinates
+    }
+
+
+def resolve_muscle_paths(model, state, muscle_names=None):
+    """
+    Resolve the insertion and previous path point of every muscle once.
+
+    :param model osim.Model: Initialized model
+    :param state osim.State: State from `initSystem`
+    :param muscle_names list: Muscles to resolve, default all
+
+    returns: `paths`: list of MusclePath, `frames`: list of the distinct
+        parent frames of the static paths' points
+    """
     muscles = model.getMuscles()
-    for muscle_name in [muscles.get(i).getName() for i in range(muscles.getSize())]:
-        force_origins[muscle_name] = []
-        force_directions[muscle_name] = []
-        previous[muscle_name] = []
-        current[muscle_name] = []
+    by_name = {muscles.get(i).getName(): muscles.get(i) for i in range(muscles.getSize())}
+    muscle_names = list(by_name) if muscle_names is None else list(muscle_names)
+
+    frames, frame_index = [], {}
+
+    def index_of(frame):
+        path = frame.getAbsolutePathString()
+        if path not in frame_index:
+            frame_index[path] = len(frames)
+            frames.append(frame)
+        return frame_index[path]
+
+    paths = []
+    for name in muscle_names:
+        muscle = by_name[name]
+        geom_path = muscle.getGeometryPath()
+        points = geom_path.getPathPointSet()
+        static = (
+            geom_path.getWrapSet().getSize() == 0
+            and points.getSize() >= 2
+            and all(
+                points.get(i).getConcreteClassName() == "PathPoint"
+                for i in range(points.getSize())
+            )
+        )
+        if not static:
+            paths.append(MusclePath(name, muscle, static=False))
+            continue
+
+        insertion = points.get(points.getSize() - 1)
+        previous = points.get(points.getSize() - 2)
+        paths.append(
+            MusclePath(
+                name,
+                muscle,
+                static=True,
+                insertion_frame=index_of(insertion.getParentFrame()),
+                previous_frame=index_of(previous.getParentFrame()),
+                insertion=_vec3(insertion.getLocation(state)),
+                previous=_vec3(previous.getLocation(state)),
+            )
+        )
+    return paths, frames
+
+
+def _frame_transforms(frames, state):
+    # Rotation (F, 3, 3) and origin (F, 3) of every frame in ground
+    rotations = np.empty((len(frames), 3, 3))
+    positions = np.empty((len(frames), 3))
+    axes = [osim.Vec3(1, 0, 0), osim.Vec3(0, 1, 0), osim.Vec3(0, 0, 1)]
+    for i, frame in enumerate(frames):
+        for j, axis in enumerate(axes):
+            rotations[i, :, j] = _vec3(frame.expressVectorInGround(state, axis))
+        positions[i] = _vec3(frame.getPositionInGround(state))
+    return rotations, positions
+
+
+def _dynamic_path_vectors(path, state, ground):
+    # Current path of wrapping, conditional or moving points, as in the GUI
+    point_force_directions = osim.ArrayPointForceDirection()
+    path.muscle.getGeometryPath().getPointForceDirections(state, point_force_directions)
+    insertion_index = point_force_directions.getSize() - 1
+    pfd = point_force_directions.get(insertion_index)
+    pfd2 = point_force_directions.get(insertion_index - 1)
+
+    insertion_in_ground = _vec3(pfd.frame().findStationLocationInGround(state, pfd.point()))
+    previous_in_ground = _vec3(pfd2.frame().findStationLocationInGround(state, pfd2.point()))
+    vector = previous_in_ground - insertion_in_ground
+    direction = osim.Vec3(*(vector / np.linalg.norm(vector)).tolist())
+    rotated = _vec3(ground.expressVectorInAnotherFrame(state, direction, pfd.frame()))
+    return _vec3(pfd.point()), rotated
 
-    # Initiate model state
+
+def compute_force_vectors(model, state, coordinates, values, paths, frames):
+    """
+    Evaluate muscle insertion points and force directions for every row of
+    coordinate values, realizing the model to Position only.
+
+    :param model osim.Model: Initialized model
+    :param state osim.State: Working state
+    :param coordinates list: Coordinate names, matching the columns of `values`
+    :param values np.ndarray: Coordinate values, shaped (time, coordinate)
+    :param paths list: From `resolve_muscle_paths`
+    :param frames list: From `resolve_muscle_paths`
+
+    returns: `origins`, `directions`: arrays shaped (time, muscle, 3)
+    """
+    handles = [model.getCoordinateSet().get(name) for name in coordinates]
+    enforce_constraints = model.getConstraintSet().getSize() > 0
+
+    static = np.array([path.static for path in paths], dtype=bool)
+    static_paths = [path for path in paths if path.static]
+    insertion_frames = np.array([path.insertion_frame for path in static_paths], dtype=int)
+    previous_frames = np.array([path.previous_frame for path in static_paths], dtype=int)
+    insertions = np.array([path.insertion for path in static_paths]).reshape(-1, 3)
+    previous = np.array([path.previous for path in static_paths]).reshape(-1, 3)
+    dynamic = [(j, path) for j, path in enumerate(paths) if not path.static]
+
+    num_times = values.shape[0]
+    origins = np.empty((num_times, len(paths), 3))
+    rotated = np.empty((num_times, len(paths), 3))
+    origins[:, static] = insertions
+    for row in range(num_times):
+        for coord, value in zip(handles, values[row]):
+            coord.setValue(state, value, False)
+        # Satisfy constraints once per frame instead of after every coordinate
+        if enforce_constraints:
+            model.assemble(state)
+        model.realizePosition(state)
+
+        if static_paths:
+            rotations, positions = _frame_transforms(frames, state)
+            insertion_rotations = rotations[insertion_frames]
+            insertion_in_ground = (
+                np.einsum("mij,mj->mi", insertion_rotations, insertions)
+                + positions[insertion_frames]
+            )
+            previous_in_ground = (
+                np.einsum("mij,mj->mi", rotations[previous_frames], previous)
+                + positions[previous_frames]
+            )
+            vectors = previous_in_ground - insertion_in_ground
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            # Express in the insertion frame: transpose of its rotation in ground
+            rotated[row, static] = np.einsum("mji,mj->mi", insertion_rotations, vectors)
+
+        for j, path in dynamic:
+            origins[row, j], rotated[row, j] = _dynamic_path_vectors(
+                path, state, model.getGround()
+            )
+
+    return origins, np.degrees(rotated)
+
+
+def read_coordinate_values(sto_path, time_range=None):
+    """
+    Read the coordinate value columns of a solution.
+
+    returns: `time`: (time,) array, `labels`: list of `.../value` column
+        labels, `values`: (time, label) array
+    """
+    df, _ = read_sto(
+        sto_path,
+        columns=lambda label: label.endswith("/value"),
+        time_range=time_range,
+    )
+    labels = [label for label in df.columns if label != "time"]
+    return df["time"].to_numpy(), labels, df[labels].to_numpy(dtype=float)
+
+
+@dataclass
+class ExtractionEngine:
+    """A model prepared for extraction against a fixed set of .sto columns."""
+    model: object
+    state: object
+    coordinates: list
+    columns: list
+    paths: list
+    frames: list
+
+
+def build_engine(osim_path, labels, muscle_names=None):
+    """
+    Load a model and resolve coordinate columns and muscle paths once.
+
+    :param osim_path Path: .osim model
+    :param labels list: Coordinate value column labels of the .sto
+    :param muscle_names list: Muscles to extract, default all
+
+    returns: `engine`: ExtractionEngine
+    """
+    model = osim.Model(str(osim_path))
     state = model.initSystem()
+    mapping = coordinate_labels(labels, model)
+    paths, frames = resolve_muscle_paths(model, state, muscle_names)
+    return ExtractionEngine(
+        model,
+        state,
+        coordinates=list(mapping.values()),
+        columns=[labels.index(label) for label in mapping],
+        paths=paths,
+        frames=frames,
+    )
+
+
+def run_engine(engine, values):
+    """
+    Extract a block of rows of the .sto coordinate values.
+
+    returns: `origins`, `directions`: arrays shaped (rows, muscle, 3)
+    """
+    return compute_force_vectors(
+        engine.model,
+        engine.state,
+        engine.coordinates,
+        values[:, engine.columns],
+        engine.paths,
+        engine.frames,
+    )
+
+
+# With automatic workers, each process must have this many rows to extract to
+# pay for loading its own model
+MIN_ROWS_PER_WORKER = 2000
+
+_engine = None
+
+
+def _init_worker(osim_path, labels, muscle_names):
+    # Each worker process loads its own model once and reuses it for all chunks
+    global _engine
+    _engine = build_engine(osim_path, labels, muscle_names)
+
+
+def _extract_chunk(values):
+    origins, directions = run_engine(_engine, values)
+    return [path.name for path in _engine.paths], origins, directions
+
+
+def _extract(osim_path, labels, values, muscle_names, workers, chunk_size):
+    # Extract all rows of `values`, in chunks on worker processes if requested
+    if workers is None:
+        workers = min(os.cpu_count(), len(values) // MIN_ROWS_PER_WORKER)
+    workers = max(1, min(workers, len(values)))
 
-    # Build a coordinate map to track and update model states through time
-    model_coordinates = {coord.getName(): coord for coord in model.getCoordinateSet()}
-    sto_to_coord_map = {}
-    for label in sto_data.getColumnLabels():
-        if "/value" in label:
-            coord_name = label.split("/")[-2]
-            if coord_name in model_coordinates:
-                sto_to_coord_map[label] = coord_name
-
-    # Iterate through time steps in the .sto file
-    for time_index in range(sto_data.getNumRows()):
-        time = sto_data.getIndependentColumn()[time_index]
-        force_directions["time"].append(time)
-
-        # Update model states
-        for sto_label, coord_name in sto_to_coord_map.items():
-            value = sto_data.getDependentColumn(sto_label)[time_index]
+    if workers == 1:
+        engine = build_engine(osim_path, labels, muscle_names)
+        origins, directions = run_engine(engine, values)
+        return [path.name for path in engine.paths], origins, directions
+
+    chunk_size = chunk_size or math.ceil(len(values) / (4 * workers))
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(chunks)),
+        initializer=_init_worker,
+        initargs=(str(osim_path), labels, muscle_names),
+    ) as executor:
+        # map returns the chunks in submission (time) order
+        results = list(executor.map(_extract_chunk, chunks))
+
+    return (
+        results[0][0],
+        np.concatenate([origins for _, origins, _ in results]),
+        np.concatenate([directions for _, _, directions in results]),
+    )
+
+
+# Muscles keep at most this many distinct cached frames, the oldest are dropped
+FORCE_VECTOR_CACHE_ROWS = 200_000
+# Size bound of a model's cache; least recently used muscle entries are evicted
+FORCE_VECTOR_CACHE_MAX_BYTES = int(
+    os.environ.get("MOCOMSM_FORCE_VECTOR_CACHE_MAX_BYTES", 512 * 1024**2)
+)
+
+
+def force_vector_cache_dir(osim_path):
+    """Cache of per-muscle results, in the hidden cache folder next to the model."""
+    return sidecar_path(osim_path, ".force_vectors")
+
+
+def _dependency_columns(labels, dependency):
+    names = set(dependency.coordinates)
+    return [i for i, label in enumerate(labels) if label.split("/")[-2] in names]
+
+
+def _extraction_version():
+    # Extraction code and OpenSim version, so fixes to either invalidate the cache
+    return [
+        code_digest(
+            coordinate_labels,
+            resolve_muscle_paths,
+            _frame_transforms,
+            _dynamic_path_vectors,
+            compute_force_vectors,
+        ),
+        osim.GetVersion(),
+    ]
+
+
+def _cache_entry(cache_dir, dependency, labels, columns, version):
+    # Keyed on the muscle's geometry, the coordinate columns it depends on and
+    # the extraction version
+    key = hashlib.sha256(
+        json.dumps([dependency.digest, [labels[i] for i in columns], version]).encode()
+    ).hexdigest()
+    return Path(cache_dir) / f"{key}.npz"
+
+
+def _read_cache_entry(entry):
+    try:
+        with np.load(entry) as data:
+            cached = data["values"], data["origins"], data["directions"]
+        # Mark as recently used for eviction
+        os.utime(entry)
+        return cached
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def evict_force_vector_cache(cache_dir, max_bytes=FORCE_VECTOR_CACHE_MAX_BYTES, keep=()):
+    """
+    Remove least recently used entries until the cache fits `max_bytes`,
+    e.g. those left behind by earlier versions of a model.
+
+    :param keep iterable: Entries never removed, e.g. those just used
+    """
+    keep = {Path(entry) for entry in keep}
+    entries = []
+    for entry in Path(cache_dir).glob("*.npz"):
+        try:
+            entries.append((entry, entry.stat()))
+        except OSError:
+            pass
+    entries.sort(key=lambda item: item[1].st_mtime)
+    total = sum(stat.st_size for _, stat in entries)
+    for entry, stat in entries:
+        if total <= max_bytes:
+            break
+        if entry in keep:
+            continue
+        entry.unlink(missing_ok=True)
+        total -= stat.st_size
+
+
+def _write_cache_entry(entry, values, origins, directions, cached=None):
+    if cached is not None:
+        values = np.concatenate([cached[0], values])
+        origins = np.concatenate([cached[1], origins])
+        directions = np.concatenate([cached[2], directions])
+    # Keep the newest copy of every frame
+    _, last = np.unique(values[::-1], axis=0, return_index=True)
+    keep = np.sort(len(values) - 1 - last)[-FORCE_VECTOR_CACHE_ROWS:]
+
+    def write(tmp_path):
+        with open(tmp_path, "wb") as file:
+            np.savez(
+                file,
+                values=values[keep],
+                origins=origins[keep],
+                directions=directions[keep],
+            )
+
+    atomic_write(entry, write)
+
+
+def extract_force_vector_arrays(
+    osim_path,
+    sto_path,
+    muscle_names=None,
+    time_range=None,
+    workers=1,
+    chunk_size=None,
+    use_cache=True,
+):
+    """
+    Extract insertion points and force directions of a solution as arrays.
+
+    Frames are independent given the coordinate values, so with `workers`
+    other than 1 the rows are split into chunks extracted by worker
+    processes, each holding its own copy of the model, and merged in time
+    order.
+
+    With `use_cache`, results are kept per muscle, keyed on the muscle's path
+    geometry and the values of the coordinates its path depends on (see
+    `utils.osim_model_parser.muscle_dependencies`), the extraction code and
+    the OpenSim version. Only muscles whose geometry changed, and frames whose
+    relevant coordinates changed, are extracted again. Least recently used
+    entries beyond `FORCE_VECTOR_CACHE_MAX_BYTES` are evicted.
+
+    :param osim_path Path: .osim model
+    :param sto_path Path: Solution or states .sto with coordinate values
+    :param muscle_names list: Muscles to extract, default all
+    :param time_range tuple: (start, stop) in seconds, either may be None
+    :param workers int: Worker processes, 1 extracts in this process and
+        None uses up to all cores with at least `MIN_ROWS_PER_WORKER` rows
+        each (serial for short solutions)
+    :param chunk_size int: Rows per chunk, defaults to about four chunks per
+        worker to balance uneven chunks
+    :param use_cache bool: Reuse and store per-muscle results
+
+    returns: `force_vectors`: ForceVectors
+    """
+    time, labels, values = read_coordinate_values(sto_path, time_range)
+    if not use_cache:
+        names, origins, directions = _extract(
+            osim_path, labels, values, muscle_names, workers, chunk_size
+        )
+        return ForceVectors(time, names, origins, directions)
+
+    # Muscles as the model sees them, so both modes return the same muscles
+    muscles = osim.Model(str(osim_path)).getMuscles()
+    model_muscles = [muscles.get(i).getName() for i in range(muscles.getSize())]
+    names = model_muscles if muscle_names is None else list(muscle_names)
+    unknown = [name for name in names if name not in model_muscles]
+    if unknown:
+        sys.exit(f"Error: Muscles not found in {osim_path}: {unknown}")
+    dependencies = muscle_dependencies(osim_path)
+    cache_dir = force_vector_cache_dir(osim_path)
+    version = _extraction_version()
+
+    origins = np.empty((len(time), len(names), 3))
+    directions = np.empty((len(time), len(names), 3))
+    missing = np.zeros((len(time), len(names)), dtype=bool)
+    entries = []
+    for j, name in enumerate(names):
+        missing[:, j] = True
+        if name not in dependencies:
+            # No path found in the .osim: always extract, never cache
+            entries.append((None, None, None))
+            continue
+        columns = _dependency_columns(labels, dependencies[name])
+        entry = _cache_entry(cache_dir, dependencies[name], labels, columns, version)
+        cached = _read_cache_entry(entry)
+        entries.append((entry, columns, cached))
+        if cached is None:
+            continue
+        rows = {row.tobytes(): i for i, row in enumerate(cached[0])}
+        for t, row in enumerate(np.ascontiguousarray(values[:, columns])):
+            i = rows.get(row.tobytes())
+            if i is not None:
+                origins[t, j] = cached[1][i]
+                directions[t, j] = cached[2][i]
+                missing[t, j] = False
+
+    rows = np.flatnonzero(missing.any(axis=1))
+    stale = np.flatnonzero(missing.any(axis=0))
+    print(
+        f"-- Force vectors: {missing.size - missing.sum()} of {missing.size} "
+        f"muscle frames from cache, extracting {len(stale)} muscles "
+        f"at {len(rows)} frames"
+    )
+    if len(rows):
+        _, new_origins, new_directions = _extract(
+            osim_path,
+            labels,
+            values[rows],
+            [names[j] for j in stale],
+            workers,
+            chunk_size,
+        )
+        origins[np.ix_(rows, stale)] = new_origins
+        directions[np.ix_(rows, stale)] = new_directions
+
+        for k, j in enumerate(stale):
+            entry, columns, cached = entries[j]
+            if entry is None:
+                continue
+            try:
+                _write_cache_entry(
+                    entry,
+                    values[np.ix_(rows, columns)],
+                    new_origins[:, k],
+                    new_directions[:, k],
+                    cached,
+                )
+            except OSError as e:
+                print(f"-- Could not cache force vectors of {names[j]}: {e}")
+        evict_force_vector_cache(
+            cache_dir,
+            keep=[entry for entry, _, _ in entries if entry is not None],
+        )
+
+    return ForceVectors(time, names, origins, directions)
+
+
+def reference_force_vectors(osim_path, sto_path, rows):
+    """
+    Evaluate rows of a solution with the original per-frame loop: every
+    coordinate set with constraint enforcement, realized to Dynamics, every
+    path through `getPointForceDirections`.
+
+    :param rows list: Row indices of the .sto to evaluate
+
+    returns: `muscles`, `origins`, `directions` like `ForceVectors`
+    """
+    model = osim.Model(str(osim_path))
+    state = model.initSystem()
+    _, labels, values = read_coordinate_values(sto_path)
+    mapping = coordinate_labels(labels, model)
+    muscles = model.getMuscles()
+    names = [muscles.get(i).getName() for i in range(muscles.getSize())]
+
+    origins = np.empty((len(rows), len(names), 3))
+    directions = np.empty((len(rows), len(names), 3))
+    for k, row in enumerate(rows):
+        for label, coord_name in mapping.items():
             coord = model.updCoordinateSet().get(coord_name)
-            coord.setValue(state, value)
+            coord.setValue(state, float(values[row, labels.index(label)]))
         model.realizeDynamics(state)
 
-        # Extract muscle path points in current state
-        for i in range(muscles.getSize()):
-            muscle = muscles.get(i)
-            geom_path = muscle.getGeometryPath()
-
+        for j in range(muscles.getSize()):
             point_force_directions = osim.ArrayPointForceDirection()
-            geom_path.getPointForceDirections(state, point_force_directions)
-            geom_path.updateGeometry(state)
-
-            # Last point = point of muscle insertion
+            muscles.get(j).getGeometryPath().getPointForceDirections(
+                state, point_force_directions
+            )
             insertion_index = point_force_directions.getSize() - 1
-
             pfd = point_force_directions.get(insertion_index)
-
-            print(f"{muscle.getName()}: {pfd.direction()}")
-
-            insertion_in_ground = [
-                pfd.frame().findStationLocationInGround(state, pfd.point())[0],
-                pfd.frame().findStationLocationInGround(state, pfd.point())[1],
-                pfd.frame().findStationLocationInGround(state, pfd.point())[2],
-            ]
-            # #     pfd.frame().findStationLocationInAnotherFrame(state, pfd.point(), pfd.frame())[0],
-            # #     pfd.frame().findStationLocationInAnotherFrame(state, pfd.point(), pfd.frame())[1],
-            # #     pfd.frame().findStationLocationInAnotherFrame(state, pfd.point(), pfd.frame())[2],
-            # # ]
-            # print(f"Insertion: {insertion_in_ground}")
-            #
             pfd2 = point_force_directions.get(insertion_index - 1)
-            print(f"{muscle.getName()}: first {pfd.point()} second {pfd2.point()}")
-            previous_in_ground = [
-                pfd2.frame().findStationLocationInGround(state, pfd2.point())[0],
-                pfd2.frame().findStationLocationInGround(state, pfd2.point())[1],
-                pfd2.frame().findStationLocationInGround(state, pfd2.point())[2],
-            ]
-            #     pfd2.frame().findStationLocationInAnotherFrame(state, pfd2.point(), pfd.frame())[0],
-            #     pfd2.frame().findStationLocationInAnotherFrame(state, pfd2.point(), pfd.frame())[1],
-            #     pfd2.frame().findStationLocationInAnotherFrame(state, pfd2.point(), pfd.frame())[2],
-            # ]
-
-            insertion_vector = [
-                v1 - v2 for v1, v2 in zip(previous_in_ground, insertion_in_ground)
-            ]
-            normalized_vector = insertion_vector / np.linalg.norm(insertion_vector)
-            print(f"Normalized: {normalized_vector}")
-
 
+            insertion_in_ground = _vec3(
+                pfd.frame().findStationLocationInGround(state, pfd.point())
+            )
+            previous_in_ground = _vec3(
+                pfd2.frame().findStationLocationInGround(state, pfd2.point())
+            )
+            vector = previous_in_ground - insertion_in_ground
+            normalized_vector = osim.Vec3(*(vector / np.linalg.norm(vector)).tolist())
             transform = model.getGround().findTransformBetween(state, pfd.frame())
-            normalized_vector = osim.Vec3(normalized_vector)
-            rotated_vector = transform.R().multiply(normalized_vector)
-
-            # prev_in_insertion = pfd2.frame().findStationLocationInAnotherFrame(
-            #     state, pfd2.point(), pfd.frame()
-            # )
-            # print(prev_in_insertion)
-
-            # changed_vector = pfd.frame().expressVectorInAnotherFrame(
-            #     state,
-            #     pfd.direction(),
-            #     pfd.frame(),
-            # )
-            # print(normalized_vector, changed_vector)
-
-            force_directions[muscle.getName()].append(
-                [
-                    math.degrees(rotated_vector[0]),
-                    math.degrees(rotated_vector[1]),
-                    math.degrees(rotated_vector[2]),
-                ]
-                # [
-                #     math.degrees(normalized_vector[0]),
-                #     math.degrees(normalized_vector[1]),
-                #     math.degrees(normalized_vector[2]),
-                # ]
-                # [
-                #     math.degrees(changed_vector[0]),
-                #     math.degrees(changed_vector[1]),
-                #     math.degrees(changed_vector[2]),
-                # ]
-                # [
-                #     math.degrees(pfd.direction()[0]),
-                #     math.degrees(pfd.direction()[1]),
-                #     math.degrees(pfd.direction()[2]),
-                # ]
+            directions[k, j] = np.degrees(
+                _vec3(transform.R().multiply(normalized_vector))
             )
+            origins[k, j] = _vec3(pfd.point())
+    return names, origins, directions
 
-            force_origins[muscle.getName()].append(
-                [
-                    pfd.point()[0],
-                    pfd.point()[1],
-                    pfd.point()[2],
-                ]
-            )
-            # force_origins[muscle.getName()].append(
-            #         previous_in_ground
-            # )
-
-            # current[muscle.getName()].append(
-            #     [
-            #         pfd.point()[0],
-            #         pfd.point()[1],
-            #         pfd.point()[2],
-            #     ]
-            # )
-            # # current[muscle.getName()].append(
-            # #     insertion_in_ground
-            # # )
-            # previous[muscle.getName()].append(
-            #     previous_in_ground
-            # )
-
-    # previous_path = os.path.join(
-    #     output_path, f"{Path(sto_path).stem}_previous.json"
-    # )
-    # current_path = os.path.join(
-    #     output_path, f"{Path(sto_path).stem}_current.json"
-    # )
-    # pd.DataFrame(previous).to_json(
-    #     previous_path, orient="records", lines=True
-    # )
-    # pd.DataFrame(current).to_json(
-    #     current_path, orient="records", lines=True
-    # )
-
-    # Save to json
+
+def check_force_vectors(osim_path, sto_path, num_frames=10, atol=1e-6):
+    """
+    Compare `extract_force_vector_arrays` (uncached) with the original
+    per-frame loop on `num_frames` evenly spaced frames of a solution.
+
+    returns: dict of "origins" / "directions" to the largest absolute
+        difference, raises ValueError if either exceeds `atol`
+    """
+    time, _, _ = read_coordinate_values(sto_path)
+    rows = np.unique(np.linspace(0, len(time) - 1, num_frames).round().astype(int))
+    names, origins, directions = reference_force_vectors(osim_path, sto_path, rows)
+
+    force_vectors = extract_force_vector_arrays(
+        osim_path,
+        sto_path,
+        muscle_names=names,
+        use_cache=False,
+    )
+    differences = {
+        "origins": float(np.abs(force_vectors.origins[rows] - origins).max()),
+        "directions": float(np.abs(force_vectors.directions[rows] - directions).max()),
+    }
+    for name, difference in differences.items():
+        print(f"-- Check {name}: max difference {difference:.3g} over {len(rows)} frames")
+    if max(differences.values()) > atol:
+        raise ValueError(
+            f"Force vectors of {Path(sto_path).name} differ from the per-frame "
+            f"reference by up to {max(differences.values()):.3g} (atol {atol})"
+        )
+    return differences
+
+
+def write_force_vectors(force_vectors, sto_path, output_path):
+    """
+    Write origins and vectors as JSON lines, one record per time step with a
+    [x, y, z] list per muscle (vectors also carry `time`).
+
+    returns: `force_origin_paths`, `force_vector_paths`
+    """
     force_origin_paths = os.path.join(
         output_path, f"{Path(sto_path).stem}_muscle_origins.json"
     )
@@ -183,6 +725,18 @@ def extract_force_vectors(osim_path, sto_path, output_path):
         output_path, f"{Path(sto_path).stem}_muscle_vectors.json"
     )
 
+    force_origins = {
+        muscle: force_vectors.origins[:, j].tolist()
+        for j, muscle in enumerate(force_vectors.muscles)
+    }
+    force_directions = {"time": force_vectors.time.tolist()}
+    force_directions.update(
+        {
+            muscle: force_vectors.directions[:, j].tolist()
+            for j, muscle in enumerate(force_vectors.muscles)
+        }
+    )
+
     pd.DataFrame(force_origins).to_json(
         force_origin_paths, orient="records", lines=True
     )
@@ -191,3 +745,73 @@ def extract_force_vectors(osim_path, sto_path, output_path):
     )
 
     return force_origin_paths, force_vector_paths
+
+
+# Main ------------------------------------------------------------------------
+def extract_force_vectors(
+    osim_path,
+    sto_path,
+    output_path,
+    workers=1,
+    chunk_size=None,
+    use_cache=True,
+    bundle=False,
+    float32=False,
+):
+    """
+    Extract muscle insertion points and force directions of a solution and
+    write them as `<solution>_muscle_origins.json` and `_muscle_vectors.json`,
+    or into the run bundle `<solution>_run.h5` (see `utils.run_bundle`).
+
+    :param workers int: Worker processes, see `extract_force_vector_arrays`
+    :param chunk_size int: Rows per worker chunk
+    :param use_cache bool: Only extract muscles and frames whose inputs changed
+    :param bundle bool: Write to the run bundle instead of JSON
+    :param float32 bool: Bundle only - store single precision
+
+    returns: `force_origin_paths`, `force_vector_paths` (both the bundle
+        when writing to it)
+    """
+    force_vectors = extract_force_vector_arrays(
+        osim_path,
+        sto_path,
+        workers=workers,
+        chunk_size=chunk_size,
+        use_cache=use_cache,
+    )
+    if bundle:
+        bundle_file = Path(output_path) / bundle_path(sto_path).name
+        write_bundle_force_vectors(
+            bundle_file,
+            force_vectors.time,
+            force_vectors.muscles,
+            force_vectors.origins,
+            force_vectors.directions,
+            float32=float32,
+        )
+        return str(bundle_file), str(bundle_file)
+    return write_force_vectors(force_vectors, sto_path, output_path)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.check:
+        try:
+            check_force_vectors(args.model, args.sto, num_frames=args.check)
+        except ValueError as e:
+            sys.exit(f"Error: {e}")
+        sys.exit(0)
+
+    output_files = extract_force_vectors(
+        args.model,
+        args.sto,
+        args.output,
+        workers=args.workers or None,
+        chunk_size=args.chunk_size,
+        use_cache=not args.no_cache,
+        bundle=args.bundle,
+        float32=args.float32,
+    )
+    for output_file in dict.fromkeys(output_files):
+        print(f"-- Writing {output_file}")
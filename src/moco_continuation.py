@@ -0,0 +1,194 @@
+"""
+Multi-level Moco solves: solve a cheap version of the problem first and use
+its solution as the initial guess for the next, more expensive level. Levels
+coarsen the mesh (`default_mesh_levels`), loosen the tolerances
+(`tolerance_ladder`), or both.
+"""
+
+# Imports ---------------------------------------------------------------------
+import json
+import time
+from pathlib import Path
+from dataclasses import asdict, dataclass
+
+
+# Defs ------------------------------------------------------------------------
+@dataclass
+class SolveLevel:
+    """Solver settings of one continuation level."""
+    num_mesh_intervals: int
+    convergence_tolerance: float
+    constraint_tolerance: float
+    max_iterations: int | None = None
+
+
+def default_mesh_levels(solver, num_levels=3, coarsening=2, loosening=10, min_intervals=5):
+    """
+    Coarse-to-fine ladder ending at the solver's current mesh and tolerances.
+
+    Each coarser level halves (`coarsening`) the number of mesh intervals and
+    loosens both tolerances tenfold (`loosening`).
+
+    :param solver osim.MocoCasADiSolver: Solver configured for the final level
+    :param num_levels int: Number of levels, including the final one
+
+    returns: `levels`: list of SolveLevel, coarsest first
+    """
+    num_mesh_intervals = solver.get_num_mesh_intervals()
+    convergence_tolerance = solver.get_optim_convergence_tolerance()
+    constraint_tolerance = solver.get_optim_constraint_tolerance()
+
+    levels = []
+    for k in reversed(range(num_levels)):
+        levels.append(
+            SolveLevel(
+                num_mesh_intervals=max(num_mesh_intervals // coarsening**k, min_intervals),
+                convergence_tolerance=convergence_tolerance * loosening**k,
+                constraint_tolerance=constraint_tolerance * loosening**k,
+            )
+        )
+    return levels
+
+
+def tolerance_ladder(solver, num_rungs=3, tightening=10):
+    """
+    Loose-to-tight ladder on the solver's current mesh, starting at its current
+    tolerances and tightening both by `tightening` per rung.
+
+    :param solver osim.MocoCasADiSolver: Solver configured for the first rung
+    :param num_rungs int: Number of rungs, including the first one
+
+    returns: `levels`: list of SolveLevel, loosest first
+    """
+    num_mesh_intervals = solver.get_num_mesh_intervals()
+    convergence_tolerance = solver.get_optim_convergence_tolerance()
+    constraint_tolerance = solver.get_optim_constraint_tolerance()
+
+    return [
+        SolveLevel(
+            num_mesh_intervals=num_mesh_intervals,
+            convergence_tolerance=convergence_tolerance / tightening**k,
+            constraint_tolerance=constraint_tolerance / tightening**k,
+        )
+        for k in range(num_rungs)
+    ]
+
+
+def set_solver_threads(solver, num_threads):
+    """
+    Limit the threads CasADi uses to evaluate the problem in parallel.
+
+    Moco's `parallel` setting reads 0 as serial and 1 as all cores, so a single
+    thread is requested as 0.
+
+    :param solver osim.MocoCasADiSolver: Solver to configure
+    :param num_threads int: Number of threads, None keeps the solver default
+        (all cores, or the OPENSIM_MOCO_PARALLEL environment variable)
+    """
+    if num_threads is None:
+        return
+    solver.set_parallel(0 if num_threads <= 1 else int(num_threads))
+
+
+def num_mesh_times(solver, num_mesh_intervals):
+    """Number of grid points of a mesh for the solver's transcription scheme."""
+    if solver.get_transcription_scheme() == "trapezoidal":
+        return num_mesh_intervals + 1
+    return 2 * num_mesh_intervals + 1
+
+
+def solve_continuation(
+    study,
+    solver,
+    levels,
+    guess=None,
+    stop=None,
+    telemetry=None,
+    records=None,
+):
+    """
+    Solve `study` once per level, interpolating each solution onto the next
+    level's mesh as its initial guess.
+
+    When a level fails after a successful level on the same mesh (a tighter
+    rung of a tolerance ladder), the earlier solution is returned instead and
+    the failed level's record names it as `kept_level`.
+
+    :param study osim.MocoStudy: Fully configured study
+    :param solver osim.MocoCasADiSolver: The study's solver
+    :param levels list: SolveLevel per level, final level last
+    :param guess osim.MocoTrajectory: Guess for the first level, None keeps the
+        solver's current guess
+    :param stop callable: Called as `stop(solution, record)` after each
+        successful level; returning True skips the remaining levels. It may
+        add entries to `record`
+    :param telemetry SolverTelemetry: Active telemetry, labelled per level
+    :param records list: Receives the per-level records as levels finish, so
+        they are kept if a level raises
+
+    returns: `solution` of the last solved level, `records` with per-level
+        settings, success, iterations, objective and wall time
+    """
+    solution = None
+    last_success = None
+    records = [] if records is None else records
+    for i, level in enumerate(levels):
+        solver.set_num_mesh_intervals(level.num_mesh_intervals)
+        solver.set_optim_convergence_tolerance(level.convergence_tolerance)
+        solver.set_optim_constraint_tolerance(level.constraint_tolerance)
+        if level.max_iterations is not None:
+            solver.set_optim_max_iterations(level.max_iterations)
+
+        if solution is not None:
+            # Unsuccessful coarse solutions (unsealed below) are still a better
+            # guess than bounds
+            guess = solution
+            guess.resampleWithNumTimes(num_mesh_times(solver, level.num_mesh_intervals))
+        if guess is not None:
+            solver.setGuess(guess)
+        if telemetry is not None:
+            telemetry.phase = f"level {i + 1}/{len(levels)}"
+
+        start = time.perf_counter()
+        solution = study.solve()
+        wall_seconds = time.perf_counter() - start
+        success = solution.success()
+        if not success:
+            # Moco seals failed solutions; their accessors throw until unsealed
+            solution.unseal()
+
+        record = asdict(level)
+        record.update(
+            level=i,
+            success=success,
+            iterations=solution.getNumIterations(),
+            objective=solution.getObjective(),
+            wall_seconds=wall_seconds,
+        )
+        records.append(record)
+        print(
+            f"-- Level {i + 1} / {len(levels)}: {level.num_mesh_intervals} intervals, "
+            f"tol {level.convergence_tolerance:g}, {record['iterations']} iterations, "
+            f"{wall_seconds:.1f} s"
+        )
+
+        if success:
+            last_success = (solution, level.num_mesh_intervals, i)
+            if stop is not None and stop(solution, record):
+                print(f"-- Stopping after level {i + 1} / {len(levels)}")
+                break
+        elif last_success is not None and last_success[1] == level.num_mesh_intervals:
+            print(f"-- Level {i + 1} failed, keeping level {last_success[2] + 1} solution")
+            record["kept_level"] = last_success[2]
+            solution = last_success[0]
+            break
+
+    return solution, records
+
+
+def write_level_report(records, report_file):
+    """Write per-level records to JSON and return the path."""
+    report_file = Path(report_file)
+    with open(report_file, "w") as file:
+        json.dump(records, file, indent=2)
+    return report_file
@@ -3,13 +3,26 @@ kjgasjh
 """
 # Imports ---------------------------------------------------------------------
 import os, sys
+import json
+import time
 import argparse
 from pathlib import Path
+from contextlib import nullcontext
 import opensim as osim
 import numpy as np
 import math
 
+from src.moco_continuation import (
+    default_mesh_levels,
+    set_solver_threads,
+    solve_continuation,
+    write_level_report,
+)
+from src.moco_symmetry import apply_symmetry_pairs, build_symmetry_pairs, model_symmetry_pairs
+from src.warm_start_library import add_solution, find_nearest, library_guess
 from utils.md_logger import log_md
+from utils.solve_cache import code_digest, fetch_solve, solve_key, store_solve
+from utils.solver_telemetry import as_telemetry
 try:
     from utils.get_md_log_file import md_log_file
 except ImportError:
@@ -45,21 +58,53 @@ def parse_arguments():
         type=str,
         help="Filename for output .sto file",
     )
+    parser.add_argument(
+        "-v",
+        "--speed",
+        type=float,
+        default=1.25,
+        help="Average gait speed in m/s (default: 1.25)",
+    )
+    parser.add_argument(
+        "-s",
+        "--sweep",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Solve a list of speeds in order, warm-starting each from the previous solution",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Always solve, bypassing the solve cache",
+    )
+    parser.add_argument(
+        "--no_library",
+        action="store_true",
+        help="Neither seed from nor add to the warm-start solution library",
+    )
+    parser.add_argument(
+        "--telemetry",
+        action="store_true",
+        help="Write per-iteration solver progress to <model>_telemetry.jsonl",
+    )
+    parser.add_argument(
+        "-ml",
+        "--mesh_levels",
+        type=int,
+        default=1,
+        help="Number of coarse-to-fine mesh levels (default: 1, direct solve)",
+    )
     return parser.parse_args()
 
 
-# Main ------------------------------------------------------------------------
-@log_md(md_log_file)
-def moco_predict_kinematics(
-    input_model_file: Path,
-    output_file: Path | None = None,
-):
-    """
-    return name of output file
+# Defs ------------------------------------------------------------------------
+def build_gait_prediction(input_model_file: Path, vel_desired: float):
     """
+    Set up the gait prediction study for a prescribed average speed.
 
-    output_file = Path(input_model_file.stem + "_predicted_gait.sto") if output_file is None else Path(output_file)
-
+    returns: `study`, `solver`, `model` (processed)
+    """
     model = osim.Model(str(input_model_file))
     model.setName(input_model_file.stem)
 
@@ -68,9 +113,6 @@ def moco_predict_kinematics(
 
     problem = study.updProblem()
 
-    # see original model for speed variants
-    u = 1
-    vel_desired = 0.75 + 0.5 * u
     n_muscles = model.getMuscles().getSize()
     slow_twitch_ratio = 0.5
     specific_tension = 3e5
@@ -101,83 +143,8 @@ def moco_predict_kinematics(
     symmetry_goal = osim.MocoPeriodicityGoal("symmetry_goal")
     problem.addGoal(symmetry_goal)
 
-    state = model.initSystem()
-
-    for i in range(0, model.getNumStateVariables()):
-        current = model.getStateVariableNames().get(i)
-
-        # Symmetric coordinate values and speeds (except for pelvis_tx)
-        if "jointset" in current:
-            if "pelvis_tx/value" in current:
-                continue
-            elif (
-                "pelvis_list" in current
-                or "pelvis_rotation" in current
-                or "pelvis_tz" in current
-            ):
-                symmetry_goal.addNegatedStatePair(osim.MocoPeriodicityGoalPair(current))
-            elif "_r" in current:
-                if "inversion" in current or "abduction" in current:
-                    symmetry_goal.addNegatedStatePair(
-                        osim.MocoPeriodicityGoalPair(
-                            current,
-                            current.replace("_r", "_l"),
-                        )
-                    )
-                else:
-                    symmetry_goal.addStatePair(
-                        osim.MocoPeriodicityGoalPair(
-                            current,
-                            current.replace("_r", "_l"),
-                        )
-                    )
-            elif "_l" in current:
-                if "inversion" in current or "abduction" in current:
-                    symmetry_goal.addNegatedStatePair(
-                        osim.MocoPeriodicityGoalPair(
-                            current,
-                            current.replace("_l", "_r"),
-                        )
-                    )
-                else:
-                    symmetry_goal.addStatePair(
-                        osim.MocoPeriodicityGoalPair(
-                            current,
-                            current.replace("_l", "_r"),
-                        )
-                    )
-        # Symmetric muscle activations and normalized tendon forces (i.e. forceset)
-        elif "forceset" in current:
-            if "_r" in current and "pelvis_rotation" not in current:
-                symmetry_goal.addStatePair(
-                    osim.MocoPeriodicityGoalPair(
-                        current,
-                        current.replace("_r", "_l"),
-                    )
-                )
-            if "_l" in current and "pelvis_list" not in current:
-                symmetry_goal.addStatePair(
-                    osim.MocoPeriodicityGoalPair(
-                        current,
-                        current.replace("_l", "_r"),
-                    )
-                )
-    # Symmetric controls
-    for control_name in problem.createRep().createControlInfoNames():
-        if "_r" in control_name:
-            symmetry_goal.addControlPair(
-                osim.MocoPeriodicityGoalPair(
-                    control_name,
-                    control_name.replace("_r", "_l"),
-                )
-            )
-        if "_l" in control_name:
-            symmetry_goal.addControlPair(
-                osim.MocoPeriodicityGoalPair(
-                    control_name,
-                    control_name.replace("_l", "_r"),
-                )
-            )
+    model.initSystem()
+    apply_symmetry_pairs(symmetry_goal, model_symmetry_pairs(model))
 
     # Prescribed average gait speed
     speed_goal = osim.MocoAverageSpeedGoal("speed")
@@ -254,60 +221,194 @@ def moco_predict_kinematics(
         0.1250 * 1 / n_muscles / vel_desired
     )
 
-    guess = None
-    if vel_desired == 1.25:
-        # Quasi random guess
-        guess = solver.createGuess("bounds")
+    return study, solver, model
 
-        time_end = 0.45
-        guess.setTime(np.linspace(0, time_end, 101))
 
-        guess.setState(
-            "/jointset/groundPelvis/pelvis_tilt/value",
-            np.deg2rad(0) * np.ones(101),
-        )
-        guess.setState(
-            "/jointset/groundPelvis/pelvis_tx/value",
-            np.linspace(0, time_end * vel_desired, 101),
-        )
-        guess.setState(
-            "/jointset/groundPelvis/pelvis_ty/value",
-            0.85 * np.ones(101),
-        )
-        guess.setState(
-            "/jointset/hip_r/hip_flexion_r/value",
-            np.deg2rad(65) * np.ones(101),
-        )
-        guess.setState(
-            "/jointset/hip_l/hip_flexion_l/value",
-            np.deg2rad(65) * np.ones(101),
-        )
-        guess.setState(
-            "/jointset/knee_r/knee_angle_r/value",
-            np.linspace(np.deg2rad(-60), np.deg2rad(-110), 101),
-        )
-        guess.setState(
-            "/jointset/knee_l/knee_angle_l/value",
-            np.linspace(np.deg2rad(-95), np.deg2rad(-45), 101),
-        )
-        guess.setState(
-            "/jointset/ankle_r/ankle_angle_r/value",
-            np.linspace(np.deg2rad(30), np.deg2rad(35), 101),
-        )
-        guess.setState(
-            "/jointset/ankle_l/ankle_angle_l/value",
-            np.linspace(np.deg2rad(70), np.deg2rad(30), 101),
+def quasi_random_guess(solver, vel_desired, output_file):
+    """
+    Hand-made guess of a stride, tuned for the default speed (1.25 m/s)
+    """
+    guess = solver.createGuess("bounds")
+
+    time_end = 0.45
+    guess.setTime(np.linspace(0, time_end, 101))
+
+    guess.setState(
+        "/jointset/groundPelvis/pelvis_tilt/value",
+        np.deg2rad(0) * np.ones(101),
+    )
+    guess.setState(
+        "/jointset/groundPelvis/pelvis_tx/value",
+        np.linspace(0, time_end * vel_desired, 101),
+    )
+    guess.setState(
+        "/jointset/groundPelvis/pelvis_ty/value",
+        0.85 * np.ones(101),
+    )
+    guess.setState(
+        "/jointset/hip_r/hip_flexion_r/value",
+        np.deg2rad(65) * np.ones(101),
+    )
+    guess.setState(
+        "/jointset/hip_l/hip_flexion_l/value",
+        np.deg2rad(65) * np.ones(101),
+    )
+    guess.setState(
+        "/jointset/knee_r/knee_angle_r/value",
+        np.linspace(np.deg2rad(-60), np.deg2rad(-110), 101),
+    )
+    guess.setState(
+        "/jointset/knee_l/knee_angle_l/value",
+        np.linspace(np.deg2rad(-95), np.deg2rad(-45), 101),
+    )
+    guess.setState(
+        "/jointset/ankle_r/ankle_angle_r/value",
+        np.linspace(np.deg2rad(30), np.deg2rad(35), 101),
+    )
+    guess.setState(
+        "/jointset/ankle_l/ankle_angle_l/value",
+        np.linspace(np.deg2rad(70), np.deg2rad(30), 101),
+    )
+    guess.setState(
+        "/jointset/groundPelvis/pelvis_tx/speed",
+        vel_desired * np.ones(101),
+    )
+    guess.write(output_file.stem + "_quasirandom_guess.sto")
+
+    return guess
+
+
+def rescale_trajectory(trajectory, vel_from, vel_to):
+    """
+    Time-rescale a gait trajectory to another speed at constant stride length.
+
+    Times are stretched by vel_from / vel_to, coordinate speeds and first
+    order derivatives scale with the inverse, accelerations with its square.
+    """
+    scale = vel_from / vel_to
+    trajectory.setTime(trajectory.getTimeMat().to_numpy() * scale)
+    for name in trajectory.getStateNames():
+        if name.endswith("/speed"):
+            trajectory.setState(name, trajectory.getStateMat(name).to_numpy() / scale)
+    for name in trajectory.getDerivativeNames():
+        power = 2 if name.endswith("/accel") else 1
+        trajectory.setDerivative(
+            name,
+            trajectory.getDerivativeMat(name).to_numpy() / scale**power,
         )
-        guess.setState(
-            "/jointset/groundPelvis/pelvis_tx/speed",
-            vel_desired * np.ones(101),
+    return trajectory
+
+
+def write_gait_prediction(solution, output_file, model, input_model_file):
+    """
+    Write a successful solution, its full stride and the processed model.
+
+    returns: `output_file`: Path to the written `_success.sto`
+    """
+    output_file = Path(output_file.stem + "_success.sto")
+    solution.write(str(output_file))
+    full_stride = osim.createPeriodicTrajectory(solution)
+    full_stride.write(output_file.stem + "_fullstride.sto")
+
+    model.printToXML(input_model_file.stem + "_python.osim")
+
+    return output_file
+
+
+# Main ------------------------------------------------------------------------
+@log_md(md_log_file)
+def moco_predict_kinematics(
+    input_model_file: Path,
+    output_file: Path | None = None,
+    vel_desired: float = 1.25,
+    guess=None,
+    mesh_levels: int = 1,
+    use_cache: bool = True,
+    use_library: bool = True,
+    num_threads: int | None = None,
+    telemetry=None,
+):
+    """
+    Predict a gait stride at a prescribed average speed.
+
+    :param input_model_file Path: .osim model
+    :param output_file Path: Base name of the output .sto
+    :param vel_desired float: Average gait speed (m/s), the original model's
+        speed variants are 0.75 + 0.5 * u
+    :param guess osim.MocoTrajectory: Initial guess, defaults to a quasi random
+        guess at 1.25 m/s and a cold start otherwise
+    :param mesh_levels int: Solve on this many progressively finer meshes with
+        tighter tolerances, each seeded by the previous level (1 = direct solve)
+    :param use_cache bool: Return the stored outputs of an identical earlier
+        solve, see `utils.solve_cache`. Solves from a custom `guess` are not cached
+    :param use_library bool: Without a custom `guess`, seed the solve with the
+        nearest-speed solution of this model from the warm-start library (if
+        within `LIBRARY_MAX_DISTANCE`), and add successful solutions to it,
+        see `src.warm_start_library`
+    :param num_threads int: CasADi threads for this solve, None uses all cores
+    :param telemetry SolverTelemetry | Path: Live per-iteration progress, see
+        `utils.solver_telemetry`; a path writes it to that JSON-lines file
+
+    return name of output file
+    """
+
+    output_file = Path(input_model_file.stem + "_predicted_gait.sto") if output_file is None else Path(output_file)
+
+    # Serve repeated solves of an identical problem from the solve cache
+    use_cache = use_cache and guess is None
+    success_file = Path(output_file.stem + "_success.sto")
+    cached_outputs = {
+        "solution.sto": success_file,
+        "fullstride.sto": Path(success_file.stem + "_fullstride.sto"),
+        "model.osim": Path(input_model_file.stem + "_python.osim"),
+    }
+    if use_cache:
+        key = solve_key(
+            {"model": input_model_file},
+            vel_desired=vel_desired,
+            mesh_levels=mesh_levels,
+            setup=code_digest(build_gait_prediction, build_symmetry_pairs, quasi_random_guess),
+            opensim=osim.GetVersion(),
         )
-        guess.write(output_file.stem + "_quasirandom_guess.sto")
+        if fetch_solve(key, cached_outputs):
+            print(f"-- Gait prediction found in cache, writing:\n - {success_file}")
+            return success_file
+
+    study, solver, model = build_gait_prediction(input_model_file, vel_desired)
+    set_solver_threads(solver, num_threads)
+
+    warm_start = False
+    if guess is None and use_library:
+        entry, distance = find_nearest(input_model_file, "gait", speed=vel_desired)
+        if entry is not None:
+            # Constant stride length, as in rescale_trajectory
+            duration = entry["duration"] * entry["speed"] / vel_desired
+            guess = library_guess(solver, entry, 0, duration)
+            warm_start = True
+            print(
+                f"-- Warm start from library solution at {entry['speed']:g} m/s "
+                f"(distance {distance:.3g}):\n - {entry['source']}"
+            )
+
+    if guess is None and vel_desired == 1.25:
+        guess = quasi_random_guess(solver, vel_desired, output_file)
 
     solver.setGuess(guess)
 
     # Solve -----------------------------------------------------------------------
-    gait_predication_solution = study.solve()
+    telemetry = as_telemetry(telemetry)
+    if mesh_levels > 1:
+        with telemetry or nullcontext():
+            gait_predication_solution, records = solve_continuation(
+                study,
+                solver,
+                default_mesh_levels(solver, mesh_levels),
+                telemetry=telemetry,
+            )
+        write_level_report(records, output_file.stem + "_solve_levels.json")
+    else:
+        with telemetry or nullcontext():
+            gait_predication_solution = study.solve()
 
     if gait_predication_solution.success() is False:
         output_file = Path(output_file.stem + "_failed.sto")
@@ -316,28 +417,160 @@ def moco_predict_kinematics(
 
         sys.exit(f"-- Gait prediction failed, writing:\n - {output_file}")
     else:
-        output_file = Path(output_file.stem + "_success.sto")
-        gait_predication_solution.write(str(output_file))
-        full_stride = osim.createPeriodicTrajectory(gait_predication_solution)
-        full_stride.write(output_file.stem + "_fullstride.sto")
-
-        model.printToXML(input_model_file.stem + "_python.osim")
+        output_file = write_gait_prediction(
+            gait_predication_solution,
+            output_file,
+            model,
+            input_model_file,
+        )
+        if use_cache:
+            store_solve(key, cached_outputs)
+        if use_library:
+            add_solution(
+                output_file,
+                input_model_file,
+                "gait",
+                speed=vel_desired,
+                iterations=gait_predication_solution.getNumIterations(),
+                objective=gait_predication_solution.getObjective(),
+                warm_start=warm_start,
+            )
 
         print(f"-- Gait prediction successful, writing:\n - {output_file}")
 
         return output_file
 
 
+@log_md(md_log_file)
+def moco_predict_speed_sweep(
+    input_model_file: Path,
+    speeds: list,
+    output_file: Path | None = None,
+    use_library: bool = True,
+):
+    """
+    Predict gait at a list of speeds as a continuation chain: each solve is
+    seeded with the previous successful solution, time-rescaled to the new
+    speed. Only the first speed starts from the nearest library solution or
+    the default guess.
+
+    :param input_model_file Path: .osim model
+    :param speeds list: Average gait speeds (m/s), solved in the given order
+    :param output_file Path: Base name of the output .sto files
+    :param use_library bool: Seed the first speed from, and add successful
+        solutions to, the warm-start library
+
+    returns: `summary_file`: Path to the JSON summary with per-speed
+        success, iterations, objective and wall time
+    """
+    output_file = Path(input_model_file.stem + "_predicted_gait.sto") if output_file is None else Path(output_file)
+
+    records = []
+    previous = None
+    for vel_desired in speeds:
+        speed_output_file = Path(f"{output_file.stem}_{vel_desired:g}ms.sto")
+        print(f"-- Predicting gait at {vel_desired:g} m/s")
+
+        study, solver, model = build_gait_prediction(input_model_file, vel_desired)
+        entry = None
+        if previous is None and use_library:
+            entry, _ = find_nearest(input_model_file, "gait", speed=vel_desired)
+
+        if previous is not None:
+            previous_file, previous_vel = previous
+            guess = rescale_trajectory(
+                osim.MocoTrajectory(str(previous_file)),
+                previous_vel,
+                vel_desired,
+            )
+        elif entry is not None:
+            duration = entry["duration"] * entry["speed"] / vel_desired
+            guess = library_guess(solver, entry, 0, duration)
+        elif vel_desired == 1.25:
+            guess = quasi_random_guess(solver, vel_desired, speed_output_file)
+        else:
+            guess = None
+        solver.setGuess(guess)
+
+        start = time.perf_counter()
+        solution = study.solve()
+        wall_seconds = time.perf_counter() - start
+        success = solution.success()
+        if not success:
+            # Moco seals failed solutions; their accessors throw until unsealed
+            solution.unseal()
+
+        record = {
+            "speed": vel_desired,
+            "warm_start": previous is not None or entry is not None,
+            "success": success,
+            "iterations": solution.getNumIterations(),
+            "objective": solution.getObjective(),
+            "wall_seconds": wall_seconds,
+        }
+        if success:
+            speed_output_file = write_gait_prediction(
+                solution,
+                speed_output_file,
+                model,
+                input_model_file,
+            )
+            previous = (speed_output_file, vel_desired)
+            if use_library:
+                add_solution(
+                    speed_output_file,
+                    input_model_file,
+                    "gait",
+                    speed=vel_desired,
+                    iterations=record["iterations"],
+                    objective=record["objective"],
+                    warm_start=record["warm_start"],
+                )
+        else:
+            # Keep seeding from the last successful speed
+            speed_output_file = speed_output_file.with_name(
+                speed_output_file.stem + "_failed.sto"
+            )
+            solution.write(str(speed_output_file))
+        record["output"] = str(speed_output_file)
+        records.append(record)
+
+        print(
+            f"-- {vel_desired:g} m/s: {'success' if record['success'] else 'failed'}, "
+            f"{record['iterations']} iterations, {wall_seconds:.1f} s"
+        )
+
+    summary_file = Path(output_file.stem + "_speed_sweep.json")
+    with open(summary_file, "w") as file:
+        json.dump(records, file, indent=2)
+    print(f"-- Speed sweep done, writing:\n - {summary_file}")
+
+    return summary_file
+
+
 if __name__ == "__main__":
 
     args = parse_arguments()
 
     os.chdir(Path(args.model).parents[0])
 
-    model_file = args.model
-    output_file = args.output
+    model_file = Path(args.model)
+    output_file = Path(args.output) if args.output else None
 
-    moco_predict_kinematics(
-        Path(model_file),
-        Path(output_file),
-    )
+    if args.sweep:
+        moco_predict_speed_sweep(
+            model_file,
+            args.sweep,
+            output_file,
+            use_library=not args.no_library,
+        )
+    else:
+        moco_predict_kinematics(
+            model_file,
+            output_file,
+            vel_desired=args.speed,
+            mesh_levels=args.mesh_levels,
+            use_cache=not args.no_cache,
+            use_library=not args.no_library,
+            telemetry=Path(model_file.stem + "_telemetry.jsonl") if args.telemetry else None,
+        )
@@ -0,0 +1,383 @@
+"""
+Resource-aware scheduling of batches of Moco.Track solves.
+
+Each job's memory and thread demand is estimated from its problem size; jobs
+are started in separate processes only while the CPU and RAM budgets allow,
+and each solve is limited to its share of threads through CasADi's parallel
+setting. Per-job peak memory and batch throughput are recorded, so the split
+between threads per solve and concurrent solves can be tuned per machine.
+"""
+
+# Imports ---------------------------------------------------------------------
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import multiprocessing
+from multiprocessing.connection import wait
+from pathlib import Path
+from dataclasses import dataclass
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from src.moco_track_batch import JOB_TELEMETRY_NAME, read_manifest, run_track_job
+from src.moco_track_kinematics import TRACK_MESH_INTERVAL
+from utils.osim_model_parser import load_model_index
+from utils.solver_telemetry import STALLED_EXIT_CODE, read_telemetry
+from utils.sto_io import read_sto
+
+
+# Parse args ------------------------------------------------------------------
+def parse_arguments():
+    """
+    Parse CLI arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Track a manifest of jobs within CPU and memory budgets",
+        add_help=False,
+    )
+    parser.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        default=argparse.SUPPRESS,
+        help='Use switches followed by "=" to use CLI file autocomplete, example "-i="',
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        help="Job manifest (.json or .csv), see src.moco_track_batch",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Output directory, one subdirectory per job (default: next to the manifest)",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=2,
+        help="CasADi threads per solve (default: 2)",
+    )
+    parser.add_argument(
+        "-c",
+        "--cpus",
+        type=int,
+        default=None,
+        help="CPU budget in threads (default: number of cores)",
+    )
+    parser.add_argument(
+        "-r",
+        "--memory",
+        type=float,
+        default=None,
+        help="Memory budget in GB (default: 90%% of the available memory)",
+    )
+    parser.add_argument(
+        "--stall",
+        type=int,
+        default=None,
+        help="Abort solves without progress for this many iterations",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Always solve, bypassing the solve cache",
+    )
+    return parser.parse_args()
+
+
+# Defs ------------------------------------------------------------------------
+SCHEDULE_SUMMARY_NAME = "moco_schedule_summary.csv"
+SCHEDULE_METRICS_NAME = "moco_schedule_metrics.json"
+SCHEDULE_HISTORY_NAME = "moco_schedule_history.jsonl"
+
+# Memory model of a solve: interpreter, OpenSim and CasADi baseline, the
+# evaluation workspace of every CasADi thread, and the IPOPT/MUMPS factorization
+# growing with the number of mesh points times problem variables. Compare
+# `estimated_memory_bytes` with the measured `peak_rss_bytes` in the schedule
+# summary to recalibrate on a new machine.
+MEMORY_BASE_BYTES = 400 * 1024**2
+MEMORY_PER_THREAD_BYTES = 150 * 1024**2
+MEMORY_PER_NODE_VARIABLE_BYTES = 48 * 1024
+THREAD_ENVIRONMENT = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+@dataclass
+class JobDemand:
+    """Estimated resources of one solve."""
+    threads: int
+    memory_bytes: int
+    num_mesh_times: int
+    num_variables: int
+
+
+def available_memory():
+    """
+    Currently available physical memory in bytes, from /proc/meminfo, psutil
+    if installed, or sysconf; None where none of them is available (e.g.
+    Windows without psutil).
+    """
+    try:
+        with open("/proc/meminfo", "r") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        # Not defined on Windows, SC_AVPHYS_PAGES is missing on macOS
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def estimate_demand(job, threads):
+    """
+    Estimate the memory and thread demand of a tracking job from the size of
+    its transcribed problem (Hermite-Simpson: two points per mesh interval).
+
+    :param job dict: Job from `read_manifest`
+    :param threads int: CasADi threads the solve will use
+
+    returns: `demand`: JobDemand
+    """
+    model_index = load_model_index(Path(job["model"]))
+    num_variables = (
+        len(model_index.states)
+        + len(model_index.controls)
+        + len(model_index.derivatives)
+    )
+    times = read_sto(job["trial"], columns=[])[0]["time"]
+    # moco_track_states tracks up to the second to last reference time
+    duration = times.iloc[-2] - times.iloc[0]
+    num_mesh_times = 2 * math.ceil(duration / TRACK_MESH_INTERVAL) + 1
+
+    memory_bytes = (
+        MEMORY_BASE_BYTES
+        + MEMORY_PER_THREAD_BYTES * threads
+        + MEMORY_PER_NODE_VARIABLE_BYTES * num_mesh_times * num_variables
+    )
+    return JobDemand(threads, int(memory_bytes), num_mesh_times, num_variables)
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _job_process(job, job_dir, use_cache, threads, stall_iterations, connection):
+    # Keep BLAS/OpenMP pools inside the solve's share of the CPU budget
+    for variable in THREAD_ENVIRONMENT:
+        os.environ[variable] = str(threads)
+    record = run_track_job(
+        job,
+        job_dir,
+        use_cache=use_cache,
+        num_threads=threads,
+        stall_iterations=stall_iterations,
+        exit_on_stall=True,
+    )
+    record["peak_rss_bytes"] = _peak_rss()
+    connection.send(record)
+    connection.close()
+
+
+# Main ------------------------------------------------------------------------
+def moco_schedule_batch(
+    manifest_file: Path,
+    output_dir: Path | None = None,
+    threads: int = 2,
+    cpus: int | None = None,
+    memory_bytes: int | None = None,
+    use_cache: bool = True,
+    stall_iterations: int | None = None,
+):
+    """
+    Run a manifest of tracking jobs, one process per job, admitting jobs in
+    manifest order while their estimated threads and memory fit the budgets.
+    Smaller later jobs are started first when the next job does not fit; a job
+    larger than the whole budget runs alone.
+
+    :param manifest_file Path: Job manifest, see `src.moco_track_batch.read_manifest`
+    :param output_dir Path: Parent of the per-job directories, defaults to the
+        manifest's directory
+    :param threads int: CasADi threads per solve
+    :param cpus int: CPU budget in threads, defaults to the core count
+    :param memory_bytes int: Memory budget, defaults to 90% of available memory;
+        without a budget and where available memory is unknown, only threads
+        are budgeted
+    :param use_cache bool: Serve repeated jobs from the solve cache
+    :param stall_iterations int: Abort solves without progress for this many
+        iterations, freeing their resources for the next job
+
+    returns: `metrics_file`: Path to the JSON with budgets and throughput
+    """
+    manifest_file = Path(manifest_file).resolve()
+    jobs = read_manifest(manifest_file)
+    if not jobs:
+        sys.exit("Error: No jobs in manifest. Exiting")
+
+    output_dir = Path(output_dir).resolve() if output_dir else manifest_file.parent
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    cpus = cpus or os.cpu_count()
+    threads = max(1, min(threads, cpus))
+    if not memory_bytes:
+        available = available_memory()
+        memory_bytes = int(0.9 * available) if available is not None else None
+    demands = {job["name"]: estimate_demand(job, threads) for job in jobs}
+    memory_budget = (
+        f"{memory_bytes / 1024**3:.1f} GB" if memory_bytes is not None else "no memory cap"
+    )
+    print(
+        f"-- Scheduling {len(jobs)} jobs: {cpus} threads, "
+        f"{memory_budget}, {threads} threads per solve"
+    )
+
+    start = time.perf_counter()
+    pending = list(jobs)
+    running = {}
+    records = []
+    used_threads, used_memory = 0, 0
+    while pending or running:
+        for job in list(pending):
+            demand = demands[job["name"]]
+            fits = (
+                used_threads + demand.threads <= cpus
+                and (
+                    memory_bytes is None
+                    or used_memory + demand.memory_bytes <= memory_bytes
+                )
+            )
+            if not fits and running:
+                continue
+
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=_job_process,
+                args=(
+                    job,
+                    output_dir / job["name"],
+                    use_cache,
+                    demand.threads,
+                    stall_iterations,
+                    sender,
+                ),
+            )
+            process.start()
+            sender.close()
+            running[process.sentinel] = (job, demand, process, receiver, time.perf_counter())
+            used_threads += demand.threads
+            used_memory += demand.memory_bytes
+            pending.remove(job)
+            print(
+                f" - started: {job['name']} ({demand.threads} threads, "
+                f"~{demand.memory_bytes / 1024**3:.1f} GB)"
+            )
+            if not fits:
+                break
+
+        for sentinel in wait(list(running)):
+            job, demand, process, receiver, started = running.pop(sentinel)
+            record = receiver.recv() if receiver.poll() else None
+            process.join()
+            receiver.close()
+            if record is None:
+                record = {
+                    "job": job["name"],
+                    "model": job["model"],
+                    "trial": job["trial"],
+                    "success": False,
+                    "error": f"Worker exited with code {process.exitcode}",
+                }
+                if process.exitcode == STALLED_EXIT_CODE:
+                    telemetry = read_telemetry(output_dir / job["name"] / JOB_TELEMETRY_NAME)
+                    record["stalled_at"] = telemetry[-1]["iteration"] if telemetry else None
+                    record["error"] = f"Solve stalled at iteration {record['stalled_at']}"
+            record.update(
+                threads=demand.threads,
+                estimated_memory_bytes=demand.memory_bytes,
+                num_mesh_times=demand.num_mesh_times,
+                num_variables=demand.num_variables,
+                started=started - start,
+                wall_seconds=time.perf_counter() - started,
+            )
+            records.append(record)
+            used_threads -= demand.threads
+            used_memory -= demand.memory_bytes
+            status = "success" if record["success"] else "failed"
+            print(f" - {status}: {record['job']} ({record['wall_seconds']:.1f} s)")
+
+    makespan = time.perf_counter() - start
+    order = {job["name"]: i for i, job in enumerate(jobs)}
+    records.sort(key=lambda record: order[record["job"]])
+    summary_file = output_dir / SCHEDULE_SUMMARY_NAME
+    pd.DataFrame(records).to_csv(summary_file, index=False)
+
+    busy_seconds = sum(r["wall_seconds"] for r in records)
+    thread_seconds = sum(r["wall_seconds"] * r["threads"] for r in records)
+    peaks = [r["peak_rss_bytes"] for r in records if r.get("peak_rss_bytes")]
+    metrics = {
+        "manifest": str(manifest_file),
+        "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "cpus": cpus,
+        "memory_budget_bytes": memory_bytes,
+        "threads_per_solve": threads,
+        "num_jobs": len(records),
+        "num_failed": sum(not r["success"] for r in records),
+        "makespan_seconds": makespan,
+        "jobs_per_hour": 3600 * len(records) / makespan if makespan > 0 else None,
+        "mean_concurrency": busy_seconds / makespan if makespan > 0 else None,
+        "cpu_utilization": thread_seconds / (cpus * makespan) if makespan > 0 else None,
+        "max_peak_rss_bytes": max(peaks, default=None),
+    }
+    metrics_file = output_dir / SCHEDULE_METRICS_NAME
+    with open(metrics_file, "w") as file:
+        json.dump(metrics, file, indent=2)
+    # One line per run, to compare thread splits on the same machine
+    with open(output_dir / SCHEDULE_HISTORY_NAME, "a") as file:
+        file.write(json.dumps(metrics) + "\n")
+
+    print(
+        f"-- Done, {metrics['num_jobs'] - metrics['num_failed']} / {metrics['num_jobs']} "
+        f"tracked in {makespan:.1f} s ({metrics['jobs_per_hour']:.1f} jobs/h), writing:"
+        f"\n - {summary_file}\n - {metrics_file}"
+    )
+
+    return metrics_file
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    moco_schedule_batch(
+        Path(args.input),
+        Path(args.output) if args.output else None,
+        threads=args.threads,
+        cpus=args.cpus,
+        memory_bytes=int(args.memory * 1024**3) if args.memory else None,
+        use_cache=not args.no_cache,
+        stall_iterations=args.stall,
+    )
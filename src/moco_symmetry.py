@@ -0,0 +1,122 @@
+"""
+Left/right symmetry pairs for MocoPeriodicityGoal.
+
+The pairing depends only on the model's state and control names, so it is
+built once per name layout and reused for every problem set up on that model
+(e.g. each speed of a sweep).
+"""
+
+# Imports ---------------------------------------------------------------------
+from dataclasses import dataclass, field
+
+import opensim as osim
+
+
+# Defs ------------------------------------------------------------------------
+@dataclass
+class SymmetryPairs:
+    """
+    Periodicity pairs as (initial, final) name tuples; a single-element tuple
+    pairs a variable with itself.
+    """
+    state_pairs: list = field(default_factory=list)
+    negated_state_pairs: list = field(default_factory=list)
+    control_pairs: list = field(default_factory=list)
+
+
+_symmetry_pairs = {}
+
+
+def _mirror(name, side, other):
+    return (name, name.replace(side, other))
+
+
+def build_symmetry_pairs(state_names, control_names):
+    """
+    Pair right and left states and controls of a gait model.
+
+    Coordinate values and speeds are mirrored (negated for out-of-plane
+    `inversion` and `abduction` coordinates and for pelvis list, rotation and
+    tz), except pelvis_tx/value. Muscle states and controls are mirrored.
+
+    :param state_names list: Model state variable names
+    :param control_names list: Problem control names (actuator paths)
+
+    returns: `pairs`: SymmetryPairs, cached per name layout
+    """
+    key = (tuple(state_names), tuple(control_names))
+    if key in _symmetry_pairs:
+        return _symmetry_pairs[key]
+
+    pairs = SymmetryPairs()
+    for current in state_names:
+        # Symmetric coordinate values and speeds (except for pelvis_tx)
+        if "jointset" in current:
+            if "pelvis_tx/value" in current:
+                continue
+            elif (
+                "pelvis_list" in current
+                or "pelvis_rotation" in current
+                or "pelvis_tz" in current
+            ):
+                pairs.negated_state_pairs.append((current,))
+            elif "_r" in current or "_l" in current:
+                side, other = ("_r", "_l") if "_r" in current else ("_l", "_r")
+                if "inversion" in current or "abduction" in current:
+                    pairs.negated_state_pairs.append(_mirror(current, side, other))
+                else:
+                    pairs.state_pairs.append(_mirror(current, side, other))
+        # Symmetric muscle activations and normalized tendon forces (i.e. forceset)
+        elif "forceset" in current:
+            if "_r" in current and "pelvis_rotation" not in current:
+                pairs.state_pairs.append(_mirror(current, "_r", "_l"))
+            if "_l" in current and "pelvis_list" not in current:
+                pairs.state_pairs.append(_mirror(current, "_l", "_r"))
+
+    # Symmetric controls
+    for control_name in control_names:
+        if "_r" in control_name:
+            pairs.control_pairs.append(_mirror(control_name, "_r", "_l"))
+        if "_l" in control_name:
+            pairs.control_pairs.append(_mirror(control_name, "_l", "_r"))
+
+    _symmetry_pairs[key] = pairs
+    return pairs
+
+
+def model_symmetry_pairs(model):
+    """
+    Symmetry pairs of an initialized model.
+
+    State names are fetched in a single call, control names are taken from the
+    actuator paths (Moco's control names for scalar actuators) instead of
+    building a problem representation.
+
+    :param model osim.Model: Model after `initSystem`
+
+    returns: `pairs`: SymmetryPairs
+    """
+    names = model.getStateVariableNames()
+    state_names = [names.get(i) for i in range(names.getSize())]
+    control_names = [
+        actuator.getAbsolutePathString() for actuator in model.getActuators()
+    ]
+    return build_symmetry_pairs(state_names, control_names)
+
+
+def apply_symmetry_pairs(goal, pairs):
+    """
+    Add all pairs to a periodicity goal.
+
+    :param goal osim.MocoPeriodicityGoal: Goal to extend
+    :param pairs SymmetryPairs: From `model_symmetry_pairs`
+
+    returns: `goal`
+    """
+    for pair in pairs.state_pairs:
+        goal.addStatePair(osim.MocoPeriodicityGoalPair(*pair))
+    for pair in pairs.negated_state_pairs:
+        goal.addNegatedStatePair(osim.MocoPeriodicityGoalPair(*pair))
+    for pair in pairs.control_pairs:
+        goal.addControlPair(osim.MocoPeriodicityGoalPair(*pair))
+    return goal
@@ -0,0 +1,322 @@
+"""
+Run a manifest of Moco.Track jobs on a pool of worker processes
+"""
+
+# Imports ---------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from src.moco_track_kinematics import moco_track_states
+from utils.solver_telemetry import SolverTelemetry
+from utils.sto_io import read_sto_header, read_sto_metadata
+
+
+# Parse args ------------------------------------------------------------------
+def parse_arguments():
+    """
+    Parse CLI arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Track a manifest of (model, trial, filter) jobs in parallel",
+        add_help=False,
+    )
+    parser.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        default=argparse.SUPPRESS,
+        help='Use switches followed by "=" to use CLI file autocomplete, example "-i="',
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        help="Job manifest (.json or .csv)",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Output directory, one subdirectory per job (default: next to the manifest)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of cores)",
+    )
+    parser.add_argument(
+        "--stall",
+        type=int,
+        default=None,
+        help="Flag solves without progress for this many iterations as stalled",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Always solve, bypassing the solve cache",
+    )
+    return parser.parse_args()
+
+
+# Defs ------------------------------------------------------------------------
+SUMMARY_NAME = "moco_track_batch_summary.csv"
+JOB_LOG_NAME = "job.log"
+JOB_TELEMETRY_NAME = "telemetry.jsonl"
+
+
+def read_manifest(manifest_file):
+    """
+    Read tracking jobs from a manifest.
+
+    A .json manifest is a list of jobs (or {"jobs": [...]}) with keys `model`,
+    `trial`, and optionally `filter` (list of strings), `invert_filter` and
+    `name`. A .csv manifest has the same columns, with space-separated filters.
+    Relative paths are resolved against the manifest's directory.
+
+    returns: `jobs`: list of dicts with absolute paths, filter_params and name
+    """
+    manifest_file = Path(manifest_file)
+    if manifest_file.suffix == ".csv":
+        entries = pd.read_csv(manifest_file, dtype=str, keep_default_na=False)
+        entries = entries.to_dict("records")
+        for entry in entries:
+            entry["filter"] = entry.get("filter", "").split() or None
+            entry["invert_filter"] = entry.get("invert_filter", "").lower() in ("1", "true", "yes")
+    else:
+        with open(manifest_file, "r") as file:
+            entries = json.load(file)
+        if isinstance(entries, dict):
+            entries = entries["jobs"]
+
+    jobs = []
+    for i, entry in enumerate(entries):
+        trial = (manifest_file.parent / entry["trial"]).resolve()
+        jobs.append(
+            {
+                "name": entry.get("name") or f"{i:03d}_{trial.stem}",
+                "model": str((manifest_file.parent / entry["model"]).resolve()),
+                "trial": str(trial),
+                "filter_params": {
+                    "state_filters": entry.get("filter") or None,
+                    "invert_filter": bool(entry.get("invert_filter", False)),
+                },
+            }
+        )
+
+    names = [job["name"] for job in jobs]
+    if len(set(names)) != len(names):
+        sys.exit("Error: Job names in the manifest must be unique")
+    return jobs
+
+
+@contextmanager
+def redirect_output(log_file):
+    """
+    Redirect this process' stdout and stderr to `log_file` at the file
+    descriptor level, so output of the OpenSim and IPOPT libraries is captured.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    try:
+        with open(log_file, "a") as log:
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+            try:
+                yield
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.dup2(saved[0], 1)
+                os.dup2(saved[1], 2)
+    finally:
+        for fd in saved:
+            os.close(fd)
+
+
+def solution_summary(solution_file):
+    """Objective and iteration count from a Moco solution .sto header."""
+    with open(solution_file, "r") as file:
+        metadata = read_sto_metadata(read_sto_header(file))
+    iterations = metadata.get("num_iterations", metadata.get("iterations"))
+    objective = metadata.get("objective")
+    return {
+        "objective": float(objective) if objective is not None else None,
+        "iterations": int(iterations) if iterations is not None else None,
+    }
+
+
+def run_track_job(
+    job,
+    job_dir,
+    use_cache=True,
+    num_threads=None,
+    stall_iterations=None,
+    exit_on_stall=False,
+):
+    """
+    Track one job in its own directory, logging to `job_dir/job.log` and
+    solver progress to `job_dir/telemetry.jsonl`.
+
+    :param num_threads int: CasADi threads for the solve, None uses all cores
+    :param stall_iterations int: Iterations without progress after which the
+        solve is reported as stalled, see `utils.solver_telemetry`
+    :param exit_on_stall bool: End the worker process on a stall, only for
+        jobs running in a process of their own
+
+    returns: `record`: dict with job, success, objective, iterations, seconds,
+        output files and error
+    """
+    job_dir = Path(job_dir)
+    job_dir.mkdir(parents=True, exist_ok=True)
+    os.chdir(job_dir)
+
+    # moco_track_states reads its reference from the working directory
+    trial = Path(job["trial"])
+    if not (job_dir / trial.name).exists():
+        shutil.copyfile(trial, job_dir / trial.name)
+
+    record = {
+        "job": job["name"],
+        "model": job["model"],
+        "trial": job["trial"],
+        "success": False,
+        "objective": None,
+        "iterations": None,
+        "seconds": None,
+        "solution": None,
+        "muscle_fiber_data": None,
+        "log": str(job_dir / JOB_LOG_NAME),
+        "stalled_at": None,
+        "error": None,
+    }
+    telemetry = SolverTelemetry(
+        job_dir / JOB_TELEMETRY_NAME,
+        stall_iterations=stall_iterations,
+        exit_on_stall=exit_on_stall,
+    )
+    start = time.perf_counter()
+    with redirect_output(job_dir / JOB_LOG_NAME):
+        try:
+            # Jobs do not use the warm-start library, so their guesses do not
+            # depend on which concurrent jobs finished first
+            solution_file, muscle_fiber_file = moco_track_states(
+                Path(job["model"]),
+                Path(trial.name),
+                job["filter_params"],
+                use_cache=use_cache,
+                use_library=False,
+                num_threads=num_threads,
+                telemetry=telemetry,
+            )
+            record.update(
+                success=True,
+                solution=str(job_dir / solution_file),
+                muscle_fiber_data=str(job_dir / muscle_fiber_file),
+            )
+        except (Exception, SystemExit) as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+    record["seconds"] = time.perf_counter() - start
+    if telemetry.stalled is not None:
+        record["stalled_at"] = telemetry.stalled["iteration"]
+
+    # Failed solves still write their last iterate
+    solution_file = record["solution"] or next(
+        iter(job_dir.glob(f"{trial.stem}_solution_failed.sto")), None
+    )
+    if solution_file is not None:
+        record.update(solution_summary(solution_file))
+
+    return record
+
+
+# Main ------------------------------------------------------------------------
+def moco_track_batch(
+    manifest_file: Path,
+    output_dir: Path | None = None,
+    workers: int | None = None,
+    use_cache: bool = True,
+    stall_iterations: int | None = None,
+):
+    """
+    Run all jobs of a manifest on a process pool, each in its own directory.
+
+    Stalled solves are flagged in the summary but run to completion, since
+    ending a pool worker would break the pool; use `src.moco_scheduler` to
+    abort them early.
+
+    :param manifest_file Path: Job manifest, see `read_manifest`
+    :param output_dir Path: Parent of the per-job directories, defaults to the
+        manifest's directory
+    :param workers int: Number of worker processes, defaults to the core count
+    :param use_cache bool: Serve repeated jobs from the solve cache
+    :param stall_iterations int: Iterations without progress that flag a stall
+
+    returns: `summary_file`: Path to the CSV with one row per job
+    """
+    manifest_file = Path(manifest_file).resolve()
+    jobs = read_manifest(manifest_file)
+    if not jobs:
+        sys.exit("Error: No jobs in manifest. Exiting")
+
+    output_dir = Path(output_dir).resolve() if output_dir else manifest_file.parent
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    records = []
+    print(f"-- Tracking {len(jobs)} jobs on {workers or os.cpu_count()} workers")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                run_track_job,
+                job,
+                output_dir / job["name"],
+                use_cache,
+                stall_iterations=stall_iterations,
+            )
+            for job in jobs
+        ]
+        for future in as_completed(futures):
+            record = future.result()
+            records.append(record)
+            status = "success" if record["success"] else "failed"
+            print(f" - {status}: {record['job']} ({record['seconds']:.1f} s)")
+
+    order = {job["name"]: i for i, job in enumerate(jobs)}
+    records.sort(key=lambda record: order[record["job"]])
+    summary_file = output_dir / SUMMARY_NAME
+    pd.DataFrame(records).to_csv(summary_file, index=False)
+
+    failed = [record for record in records if not record["success"]]
+    print(
+        f"-- Done, {len(records) - len(failed)} / {len(records)} tracked in "
+        f"{time.perf_counter() - start:.1f} s, writing:\n - {summary_file}"
+    )
+    for record in failed:
+        print(f" - Failed: {record['job']}: {record['error']} (see {record['log']})")
+
+    return summary_file
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    moco_track_batch(
+        Path(args.input),
+        Path(args.output) if args.output else None,
+        workers=args.workers,
+        use_cache=not args.no_cache,
+        stall_iterations=args.stall,
+    )
@@ -19,12 +19,26 @@ import os
 import sys
 import argparse
 from pathlib import Path
+from contextlib import nullcontext
+
+import numpy as np
 
 from setup_envMocoMSM.osim_path import import_opensim
 
 osim = import_opensim()
 
+from src.moco_continuation import (
+    default_mesh_levels,
+    set_solver_threads,
+    solve_continuation,
+    tolerance_ladder,
+    write_level_report,
+)
+from src.warm_start_library import add_solution, find_nearest, kinematic_signature, library_guess
+from utils.sto_io import read_sto
 from utils.md_logger import log_md
+from utils.solve_cache import code_digest, fetch_solve, solve_key, store_solve
+from utils.solver_telemetry import as_telemetry
 
 try:
     from utils.get_paths import md_log_file
@@ -81,10 +95,100 @@ def parse_arguments():
         action="store_true",
         help="Inverts filter to exclude strings passed with -f / --filter",
     )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Always solve, bypassing the solve cache",
+    )
+    parser.add_argument(
+        "--no_library",
+        action="store_true",
+        help="Neither seed from nor add to the warm-start solution library",
+    )
+    parser.add_argument(
+        "-ml",
+        "--mesh_levels",
+        type=int,
+        default=1,
+        help="Number of coarse-to-fine mesh levels (default: 1, direct solve)",
+    )
+    parser.add_argument(
+        "-tl",
+        "--tolerance_levels",
+        type=int,
+        default=1,
+        help="Number of loose-to-tight tolerance rungs, each 10x tighter (default: 1)",
+    )
+    parser.add_argument(
+        "-te",
+        "--tracking_error",
+        type=float,
+        default=None,
+        help="Stop tightening once the RMS tracking error of coordinate values (rad) is below this",
+    )
+    parser.add_argument(
+        "--telemetry",
+        action="store_true",
+        help="Write per-iteration solver progress to <sto>_telemetry.jsonl",
+    )
     return parser.parse_args()
 
 
 # Defs ------------------------------------------------------------------------
+TRACK_MESH_INTERVAL = 0.02
+MUSCLE_FIBER_OUTPUTS = [
+    r".*active_fiber_force",
+    r".*passive_fiber_force",
+    r".*fiber_length",
+    r".*fiber_velocity",
+    r".*fiber_active_power",
+    r".*fiber_passive_power",
+    r".*normalized_fiber_length",
+    r".*normalized_fiber_velocity",
+    r".*activation",
+    r".*excitation",
+    r".*active_force_length_multiplier",
+]
+
+
+def track_model_processor(model_file):
+    """Model adaptations applied to every tracked model."""
+    modelProcessor = osim.ModelProcessor(str(model_file))
+    modelProcessor.append(osim.ModOpTendonComplianceDynamicsModeDGF("implicit"))
+    modelProcessor.append(osim.ModOpScaleActiveFiberForceCurveWidthDGF(1.5))
+    return modelProcessor
+
+
+def extract_muscle_fiber_data(model_file, solution_file, output_file=None):
+    """
+    Extract muscle fiber data from a tracking solution, independently of the
+    solve that produced it.
+
+    :param model_file Path: .osim model that was tracked
+    :param solution_file Path: Tracking solution .sto
+    :param output_file Path: Output .sto, defaults to
+        `<solution stem>_muscle_fiber_data.sto`
+
+    returns: `output_file`
+    """
+    solution_file = Path(solution_file)
+    output_file = (
+        Path(output_file)
+        if output_file
+        else Path(solution_file.stem + "_muscle_fiber_data.sto")
+    )
+
+    study = osim.MocoStudy()
+    study.updProblem().setModelProcessor(track_model_processor(model_file))
+    muscle_fiber_data = study.analyze(
+        osim.MocoTrajectory(str(solution_file)),
+        MUSCLE_FIBER_OUTPUTS,
+    )
+    osim.STOFileAdapter.write(muscle_fiber_data, str(output_file))
+
+    return output_file
+
+
 def set_state_weights(
     track,
     state_names,
@@ -93,7 +197,12 @@ def set_state_weights(
     inverse_filter=False,
     verbose=False,
 ):
-    tracked_states = 0
+    """
+    Weight states matching the filters with 10, all others with 0.
+
+    returns: `tracked`: names of the states with a nonzero weight
+    """
+    tracked = []
     # Set weights based on filters and inverse_filter flag
     for state_name in state_names:
         if filters:
@@ -104,10 +213,10 @@ def set_state_weights(
             weight = 10
         state_weights.cloneAndAppend(osim.MocoWeight(state_name, weight))
         if weight:
-            tracked_states += 1
+            tracked.append(state_name)
             print(f"Tracking: {state_name}")
     track.set_states_weight_set(state_weights)
-    print(f"-- Tracking {tracked_states} / {len(state_names)} states")
+    print(f"-- Tracking {len(tracked)} / {len(state_names)} states")
     # Reported marker weights when calling Moco seem to be bugged:
     # always reports non-kinematic states as weight=1.0
     # use verbose flag to look at set weights which should be the correct ones.
@@ -118,6 +227,24 @@ def set_state_weights(
                 f"Marker: {state_weight.getName()}, Weight: {state_weight.getWeight()}"
             )
 
+    return tracked
+
+
+def tracking_error(solution, reference_df, state_names):
+    """
+    RMS difference between solution and reference over `state_names`, with
+    the reference interpolated onto the solution's time points.
+    """
+    times = solution.getTimeMat().to_numpy()
+    solved = set(solution.getStateNames())
+    errors = [
+        np.interp(times, reference_df["time"], reference_df[name])
+        - solution.getStateMat(name).to_numpy()
+        for name in state_names
+        if name in solved
+    ]
+    return float(np.sqrt(np.mean(np.square(errors)))) if errors else float("nan")
+
 
 # Main ------------------------------------------------------------------------
 @log_md(md_log_file)
@@ -126,7 +253,45 @@ def moco_track_states(
     input_sto_file: Path | None,
     filter_params: dict,
     output_file: Path | None = None,
+    mesh_levels: int = 1,
+    tolerance_levels: int = 1,
+    tracking_error_target: float | None = None,
+    use_cache: bool = True,
+    analyze_fibers: bool = True,
+    use_library: bool = True,
+    num_threads: int | None = None,
+    telemetry=None,
 ) -> Path:
+    """
+    Track the states of `input_sto_file` with Moco.Track.
+
+    :param model_file Path: .osim model
+    :param input_sto_file Path: Reference states, defaults to the model's
+        `_moco_track_states.sto`
+    :param filter_params Dict: filter parameters selecting the tracked states
+    :param output_file Path: Base name of the solution .sto
+    :param mesh_levels int: Solve on this many progressively finer meshes with
+        tighter tolerances, each seeded by the previous level (1 = direct solve)
+    :param tolerance_levels int: Re-solve the final mesh this many times from
+        the previous iterate, tightening the convergence and constraint
+        tolerances tenfold per rung (1 = single tolerance). A rung that fails
+        keeps the solution of the previous rung
+    :param tracking_error_target float: Skip the remaining rungs once the RMS
+        error of the tracked coordinate values (rad) is at most this
+    :param use_cache bool: Return the stored outputs of an identical earlier
+        solve (same model, reference, filters and settings), see `utils.solve_cache`
+    :param analyze_fibers bool: Also extract muscle fiber data from the solution,
+        disable to run `extract_muscle_fiber_data` as a separate step
+    :param use_library bool: Seed the solve with the library solution of this
+        model closest in duration and kinematics instead of the tracked states,
+        if one is within `LIBRARY_MAX_DISTANCE`, and add successful solutions
+        to it, see `src.warm_start_library`
+    :param num_threads int: CasADi threads for this solve, None uses all cores
+    :param telemetry SolverTelemetry | Path: Live per-iteration progress, see
+        `utils.solver_telemetry`; a path writes it to that JSON-lines file
+
+    returns: `output_file`, `muscle_fiber_file` (None if not analyzed)
+    """
     # Handle Paths
     input_sto_file = (
         Path(input_sto_file.name)
@@ -139,6 +304,31 @@ def moco_track_states(
         else Path(str(input_sto_file.with_suffix("")) + "_solution.sto")
     )
 
+    # Serve repeated solves of an identical problem from the solve cache
+    success_file = Path(output_file.stem + "_success.sto")
+    cached_outputs = {
+        "solution.sto": success_file,
+        "fullstride.sto": Path(success_file.stem + "_fullstride.sto"),
+    }
+    if analyze_fibers:
+        cached_outputs["muscle_fiber_data.sto"] = Path(
+            success_file.stem + "_muscle_fiber_data.sto"
+        )
+    if use_cache:
+        key = solve_key(
+            {"model": model_file, "reference": input_sto_file},
+            filter_params=filter_params,
+            mesh_levels=mesh_levels,
+            tolerance_levels=tolerance_levels,
+            tracking_error_target=tracking_error_target,
+            setup=code_digest(moco_track_states, set_state_weights, track_model_processor),
+            opensim=osim.GetVersion(),
+        )
+        if fetch_solve(key, cached_outputs):
+            print(f"-- Tracking solution found in cache, writing:\n - {success_file}")
+            muscle_fiber_file = cached_outputs.get("muscle_fiber_data.sto")
+            return success_file, str(muscle_fiber_file) if muscle_fiber_file else None
+
     # Moco
     track = osim.MocoTrack()
     track.setName(model_file.stem)
@@ -147,10 +337,7 @@ def moco_track_states(
     # osim.Logger.setLevelString("Debug")
 
     # Load model and adapt model
-    modelProcessor = osim.ModelProcessor(str(model_file))
-    modelProcessor.append(osim.ModOpTendonComplianceDynamicsModeDGF("implicit"))
-    modelProcessor.append(osim.ModOpScaleActiveFiberForceCurveWidthDGF(1.5))
-    track.setModel(modelProcessor)
+    track.setModel(track_model_processor(model_file))
 
     # Load states from .sto
     table_processor = osim.TableProcessor(str(input_sto_file))
@@ -161,7 +348,7 @@ def moco_track_states(
     state_names = table.getColumnLabels()
     state_weights = osim.MocoWeightSet()
 
-    set_state_weights(
+    tracked_states = set_state_weights(
         track,
         state_names,
         state_weights,
@@ -172,9 +359,11 @@ def moco_track_states(
 
     track.set_allow_unused_references(True)
     track.set_track_reference_position_derivatives(True)
-    track.set_initial_time(table.getIndependentColumn()[0])
-    track.set_final_time(table.getIndependentColumn()[-2])
-    track.set_mesh_interval(0.02)
+    initial_time = table.getIndependentColumn()[0]
+    final_time = table.getIndependentColumn()[-2]
+    track.set_initial_time(initial_time)
+    track.set_final_time(final_time)
+    track.set_mesh_interval(TRACK_MESH_INTERVAL)
     track.set_apply_tracked_states_to_guess(True)
 
     study = track.initialize()
@@ -184,8 +373,64 @@ def moco_track_states(
     solver.set_optim_convergence_tolerance(1e-1)
     # solver.set_optim_convergence_tolerance(1e-3)
     solver.set_optim_constraint_tolerance(1e-4)
+    set_solver_threads(solver, num_threads)
+
+    reference_df, _ = read_sto(input_sto_file)
+    warm_start = False
+    if use_library:
+        entry, distance = find_nearest(
+            model_file,
+            "track",
+            duration=final_time - initial_time,
+            signature=kinematic_signature(reference_df),
+        )
+        if entry is not None:
+            solver.setGuess(library_guess(solver, entry, initial_time, final_time))
+            warm_start = True
+            print(
+                f"-- Warm start from library solution (distance {distance:.3g}):"
+                f"\n - {entry['source']}"
+            )
+        else:
+            print("-- No library solution within reach, guessing the tracked states")
+
+    levels = default_mesh_levels(solver, mesh_levels) if mesh_levels > 1 else []
+    if tolerance_levels > 1:
+        # The first rung is the final mesh level
+        levels = levels[:-1] + tolerance_ladder(solver, tolerance_levels)
+
+    telemetry = as_telemetry(telemetry)
+    if levels:
+        error_states = [s for s in tracked_states if s.endswith("/value")] or tracked_states
+        final_intervals = solver.get_num_mesh_intervals()
 
-    solution = study.solve()
+        def reached_target(solution, record):
+            record["tracking_error"] = tracking_error(solution, reference_df, error_states)
+            print(f"-- RMS tracking error: {record['tracking_error']:.4g}")
+            return (
+                tracking_error_target is not None
+                and record["num_mesh_intervals"] == final_intervals
+                and record["tracking_error"] <= tracking_error_target
+            )
+
+        # A failed tighter rung falls back to the last rung that met its
+        # tolerances; the level report is written even if a rung raises
+        records = []
+        try:
+            with telemetry or nullcontext():
+                solution, _ = solve_continuation(
+                    study,
+                    solver,
+                    levels,
+                    stop=reached_target,
+                    telemetry=telemetry,
+                    records=records,
+                )
+        finally:
+            write_level_report(records, output_file.stem + "_solve_levels.json")
+    else:
+        with telemetry or nullcontext():
+            solution = study.solve()
 
     if solution.success() is False:
         output_file = Path(output_file.stem + "_failed.sto")
@@ -199,33 +444,33 @@ def moco_track_states(
         full_stride = osim.createPeriodicTrajectory(solution)
         full_stride.write(output_file.stem + "_fullstride.sto")
 
+        if use_library:
+            add_solution(
+                output_file,
+                model_file,
+                "track",
+                iterations=solution.getNumIterations(),
+                objective=solution.getObjective(),
+                warm_start=warm_start,
+            )
+
         print(
             f"-- Tracking succesful, writing:\n - {str(output_file)}\n - {str(output_file.stem + '_fullstride.sto')}"
         )
 
     # Extract solution muscle fiber data
-    muscle_fiber_data = study.analyze(
-        solution,
-        [
-            r".*active_fiber_force",
-            r".*passive_fiber_force",
-            r".*fiber_length",
-            r".*fiber_velocity",
-            r".*fiber_active_power",
-            r".*fiber_passive_power",
-            r".*normalized_fiber_length",
-            r".*normalized_fiber_velocity",
-            r".*activation",
-            r".*excitation",
-            r".*active_force_length_multiplier",
-        ],
-    )
-    muscle_fiber_file = output_file.stem + "_muscle_fiber_data.sto"
-    print(muscle_fiber_file)
-    osim.STOFileAdapter.write(
-        muscle_fiber_data,
-        output_file.stem + "_muscle_fiber_data.sto",
-    )
+    muscle_fiber_file = None
+    if analyze_fibers:
+        muscle_fiber_data = study.analyze(solution, MUSCLE_FIBER_OUTPUTS)
+        muscle_fiber_file = output_file.stem + "_muscle_fiber_data.sto"
+        print(muscle_fiber_file)
+        osim.STOFileAdapter.write(
+            muscle_fiber_data,
+            output_file.stem + "_muscle_fiber_data.sto",
+        )
+
+    if use_cache:
+        store_solve(key, cached_outputs)
 
     return output_file, muscle_fiber_file
 
@@ -247,4 +492,10 @@ if __name__ == "__main__":
         Path(args.sto),
         filter_params,
         args.output,
+        mesh_levels=args.mesh_levels,
+        tolerance_levels=args.tolerance_levels,
+        tracking_error_target=args.tracking_error,
+        telemetry=Path(Path(args.sto).stem + "_telemetry.jsonl") if args.telemetry else None,
+        use_cache=not args.no_cache,
+        use_library=not args.no_library,
     )
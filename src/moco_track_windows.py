@@ -0,0 +1,350 @@
+"""
+Windowed Moco.Track for long trials: split the reference into overlapping
+time windows, track them concurrently and crossfade the overlaps into one
+continuous solution and muscle fiber data table.
+"""
+
+# Imports ---------------------------------------------------------------------
+import os
+import json
+import math
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from src.moco_track_kinematics import moco_track_states
+from utils.md_logger import log_md
+from utils.sto_io import read_sto, write_sto
+
+try:
+    from utils.get_paths import md_log_file
+except ImportError:
+    md_log_file = None
+
+
+# Parse args ------------------------------------------------------------------
+def parse_arguments():
+    """
+    Parse CLI arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Track a long trial in overlapping time windows solved in parallel",
+        add_help=False,
+    )
+    parser.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        default=argparse.SUPPRESS,
+        help='Use switches followed by "=" to use CLI file autocomplete, example "-i="',
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        type=str,
+        help="Path to input .osim model",
+        required=True,
+    )
+    parser.add_argument(
+        "-s",
+        "--sto",
+        type=str,
+        help="Path to input .sto file",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Filename for output .sto file",
+    )
+    parser.add_argument(
+        "-f",
+        "--filter",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Strings to filter visualized data (e.g. jointset angle)- filters out states containing any of the passed filter",
+    )
+    parser.add_argument(
+        "-if",
+        "--invert_filter",
+        action="store_true",
+        help="Inverts filter to exclude strings passed with -f / --filter",
+    )
+    parser.add_argument(
+        "-tw",
+        "--window",
+        type=float,
+        default=1.0,
+        help="Window length in seconds (default: 1.0)",
+    )
+    parser.add_argument(
+        "-ol",
+        "--overlap",
+        type=float,
+        default=0.2,
+        help="Overlap of consecutive windows in seconds (default: 0.2)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of windows solved concurrently (default: all cores)",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Always solve, bypassing the solve cache",
+    )
+    return parser.parse_args()
+
+
+# Defs ------------------------------------------------------------------------
+def plan_windows(times, window, overlap):
+    """
+    Split a time column into equally long windows overlapping by at least
+    `overlap`, snapped outwards to the sample times.
+
+    :param times np.ndarray: Reference sample times, ascending
+    :param window float: Maximum window length (s)
+    :param overlap float: Overlap of consecutive windows (s)
+
+    returns: `windows`: list of (start, stop) sample indices, inclusive
+    """
+    if overlap >= window:
+        raise ValueError("Window overlap must be shorter than the window")
+
+    duration = times[-1] - times[0]
+    if duration <= window:
+        return [(0, len(times) - 1)]
+
+    num_windows = math.ceil((duration - overlap) / (window - overlap))
+    length = (duration + (num_windows - 1) * overlap) / num_windows
+
+    windows = []
+    for i in range(num_windows):
+        start_time = times[0] + i * (length - overlap)
+        start = int(np.searchsorted(times, start_time, side="right")) - 1
+        stop = int(np.searchsorted(times, start_time + length, side="left"))
+        windows.append((max(start, 0), min(stop, len(times) - 1)))
+    windows[-1] = (windows[-1][0], len(times) - 1)
+    return windows
+
+
+def _track_window(model_file, window_file, span, filter_params, workdir, use_cache):
+    os.chdir(workdir)
+    try:
+        # Windows start from their own tracked states: the shared library would
+        # make guesses depend on which windows finished first
+        return moco_track_states(
+            model_file,
+            Path(window_file),
+            filter_params,
+            use_cache=use_cache,
+            use_library=False,
+        )
+    except SystemExit as e:
+        # moco_track_states exits on a failed solve
+        raise RuntimeError(
+            f"Window {window_file} ({span[0]:.3f}-{span[1]:.3f} s): {e}"
+        ) from None
+
+
+def crossfade_windows(dfs):
+    """
+    Join consecutive window tables, blending each overlap linearly from the
+    earlier into the later window on the earlier window's time points.
+
+    :param dfs list: Window tables with `time` as first column, in time order
+
+    returns: `stitched` pd.DataFrame, `seams`: per overlap continuity record
+        with the largest and RMS difference between the two windows and the
+        column where they disagree most
+    """
+    stitched = dfs[0]
+    seams = []
+    for i, df in enumerate(dfs[1:]):
+        columns = [c for c in stitched.columns if c in df.columns]
+        overlap_start = df["time"].iloc[0]
+        overlap_stop = stitched["time"].iloc[-1]
+
+        head = stitched.loc[stitched["time"] < overlap_start, columns]
+        earlier = stitched.loc[stitched["time"] >= overlap_start, columns]
+        tail = df.loc[df["time"] > overlap_stop, columns]
+
+        times = earlier["time"].to_numpy()
+        later = pd.DataFrame(
+            {c: np.interp(times, df["time"], df[c]) for c in columns},
+            index=earlier.index,
+        )
+        span = overlap_stop - overlap_start
+        weight = (times - overlap_start) / span if span > 0 else np.ones_like(times)
+        blended = earlier.mul(1 - weight, axis=0) + later.mul(weight, axis=0)
+        blended["time"] = times
+
+        difference = (earlier.drop(columns="time") - later.drop(columns="time")).abs()
+        max_difference = difference.max()
+        seams.append(
+            {
+                "seam": i,
+                "start": float(overlap_start),
+                "stop": float(overlap_stop),
+                "max_abs_difference": float(max_difference.max()),
+                "rms_difference": float(np.sqrt((difference**2).to_numpy().mean())),
+                "worst_column": max_difference.idxmax(),
+            }
+        )
+
+        stitched = pd.concat([head, blended, tail], ignore_index=True)
+
+    return stitched, seams
+
+
+def _resize_header(header, df):
+    # STOFileAdapter headers carry the table size
+    sizes = {"nRows": len(df), "nColumns": len(df.columns)}
+    return [
+        f"{line.split('=')[0]}={sizes[line.split('=')[0]]}\n"
+        if line.split("=")[0] in sizes
+        else line
+        for line in header
+    ]
+
+
+def stitch_sto_files(window_files, output_file):
+    """
+    Crossfade per-window .sto files into `output_file`.
+
+    returns: `seams`, see `crossfade_windows`
+    """
+    tables = [read_sto(window_file) for window_file in window_files]
+    stitched, seams = crossfade_windows([df for df, _ in tables])
+    write_sto(output_file, _resize_header(tables[0][1], stitched), stitched)
+    return seams
+
+
+# Main ------------------------------------------------------------------------
+@log_md(md_log_file)
+def moco_track_windows(
+    model_file: Path,
+    input_sto_file: Path,
+    filter_params: dict,
+    output_file: Path | None = None,
+    window: float = 1.0,
+    overlap: float = 0.2,
+    workers: int | None = None,
+    use_cache: bool = True,
+):
+    """
+    Track a long trial as overlapping windows solved concurrently, then
+    crossfade the window solutions and muscle fiber data into single tables.
+
+    Window references and solutions are written to `<input stem>_windows/`.
+    The stitched trajectory spans several strides, so no full stride file is
+    written.
+
+    :param model_file Path: .osim model
+    :param input_sto_file Path: Reference states
+    :param filter_params Dict: filter parameters selecting the tracked states
+    :param output_file Path: Base name of the solution .sto
+    :param window float: Maximum window length (s)
+    :param overlap float: Overlap of consecutive windows (s), blended linearly
+    :param workers int: Number of windows solved concurrently
+    :param use_cache bool: Serve unchanged windows from the solve cache
+
+    returns: `output_file`, `muscle_fiber_file`, `seams_file`
+    """
+    model_file = Path(model_file).resolve()
+    input_sto_file = Path(input_sto_file)
+    output_file = (
+        Path(output_file)
+        if output_file
+        else Path(input_sto_file.stem + "_solution.sto")
+    )
+    window_dir = Path(input_sto_file.stem + "_windows").resolve()
+    window_dir.mkdir(exist_ok=True)
+
+    df, header = read_sto(input_sto_file)
+    times = df["time"].to_numpy()
+    windows = plan_windows(times, window, overlap)
+    print(f"-- Tracking {times[-1] - times[0]:.2f} s in {len(windows)} windows")
+
+    # Each window's reference runs one sample past its end, as moco_track_states
+    # tracks up to the second to last reference time
+    window_files = []
+    for i, (start, stop) in enumerate(windows):
+        window_file = window_dir / f"{input_sto_file.stem}_w{i:02d}.sto"
+        window_df = df.iloc[start : stop + 2]
+        write_sto(window_file, _resize_header(header, window_df), window_df)
+        window_files.append(window_file)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                _track_window,
+                model_file,
+                window_file.name,
+                (times[start], times[stop]),
+                filter_params,
+                str(window_dir),
+                use_cache,
+            )
+            for window_file, (start, stop) in zip(window_files, windows)
+        ]
+        results = [future.result() for future in futures]
+
+    solution_files = [window_dir / solution for solution, _ in results]
+    fiber_files = [window_dir / fibers for _, fibers in results]
+
+    output_file = Path(output_file.stem + "_success.sto")
+    muscle_fiber_file = Path(output_file.stem + "_muscle_fiber_data.sto")
+    seams = {
+        "windows": [[float(times[start]), float(times[stop])] for start, stop in windows],
+        "solution": stitch_sto_files(solution_files, output_file),
+        "muscle_fiber_data": stitch_sto_files(fiber_files, muscle_fiber_file),
+    }
+    seams_file = Path(output_file.stem + "_seams.json")
+    with open(seams_file, "w") as file:
+        json.dump(seams, file, indent=2)
+
+    worst = max(seams["solution"], key=lambda s: s["max_abs_difference"], default=None)
+    if worst is not None:
+        print(
+            f"-- Largest seam difference {worst['max_abs_difference']:.3g} "
+            f"({worst['worst_column']}) at {worst['start']:.3f}-{worst['stop']:.3f} s"
+        )
+    print(
+        f"-- Windowed tracking successful, writing:\n - {output_file}"
+        f"\n - {muscle_fiber_file}\n - {seams_file}"
+    )
+
+    return output_file, muscle_fiber_file, seams_file
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    model_file = Path(args.model).resolve()
+    sto_file = Path(args.sto).resolve()
+    os.chdir(model_file.parents[0])
+
+    filter_params = {
+        "state_filters": args.filter,
+        "invert_filter": args.invert_filter,
+    }
+
+    moco_track_windows(
+        model_file,
+        sto_file,
+        filter_params,
+        args.output,
+        window=args.window,
+        overlap=args.overlap,
+        workers=args.workers,
+        use_cache=not args.no_cache,
+    )
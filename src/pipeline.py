@@ -0,0 +1,195 @@
+"""
+Incremental stage-graph runner for the MSM workflow.
+
+Stages declare the files they read and write; dependencies follow from
+matching outputs to inputs. A stage is rerun only when the content of its
+inputs, its arguments or its own outputs changed since its last successful
+run, and stages without a dependency between them run concurrently.
+"""
+
+# Imports ---------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import hashlib
+from pathlib import Path
+from dataclasses import dataclass, field
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from utils.file_cache import CACHE_DIR_NAME, file_digest, read_json, write_json
+
+
+# Defs ------------------------------------------------------------------------
+@dataclass
+class Stage:
+    """
+    One step of the workflow.
+
+    :param name str: Unique stage name
+    :param func callable: Module-level function, called as `func(**kwargs)`
+        from the pipeline's working directory
+    :param inputs list: Files the stage reads
+    :param outputs list: Files the stage writes
+    :param kwargs dict: Arguments of `func`, part of the stage fingerprint
+    """
+    name: str
+    func: object
+    inputs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+    kwargs: dict = field(default_factory=dict)
+
+
+def _stage_dependencies(stages):
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if str(output) in producers:
+                sys.exit(f"Error: {output} is written by more than one stage")
+            producers[str(output)] = stage.name
+    return {
+        stage.name: {
+            producers[str(i)] for i in stage.inputs if str(i) in producers
+        }
+        for stage in stages
+    }
+
+
+def _check_acyclic(dependencies):
+    visited, active = set(), set()
+
+    def visit(name):
+        if name in active:
+            sys.exit(f"Error: Pipeline has a dependency cycle through '{name}'")
+        if name in visited:
+            return
+        active.add(name)
+        for dependency in dependencies[name]:
+            visit(dependency)
+        active.remove(name)
+        visited.add(name)
+
+    for name in dependencies:
+        visit(name)
+
+
+def stage_fingerprint(stage):
+    """Digest of a stage's function, arguments and input file contents."""
+    parts = {
+        "func": f"{stage.func.__module__}.{stage.func.__qualname__}",
+        "kwargs": stage.kwargs,
+        "inputs": {str(i): file_digest(i) for i in stage.inputs},
+    }
+    encoded = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def _is_up_to_date(stage, fingerprint, record):
+    if record is None or record.get("fingerprint") != fingerprint:
+        return False
+    outputs = record.get("outputs", {})
+    return all(
+        Path(output).is_file() and outputs.get(str(output)) == file_digest(output)
+        for output in stage.outputs
+    )
+
+
+def _run_stage(func, kwargs, workdir):
+    os.chdir(workdir)
+    start = time.perf_counter()
+    try:
+        func(**kwargs)
+    except SystemExit as e:
+        # Solvers exit on failure; report it as a stage error instead
+        raise RuntimeError(str(e)) from None
+    return time.perf_counter() - start
+
+
+# Main ------------------------------------------------------------------------
+def run_pipeline(stages, workdir=None, workers=None, force=(), state_file=None):
+    """
+    Run the stages whose inputs, arguments or outputs changed since their last
+    successful run, in dependency order and concurrently where possible.
+
+    :param stages list: Stage definitions
+    :param workdir Path: Working directory for all stages, defaults to the cwd
+    :param workers int: Maximum number of concurrently running stages
+    :param force list: Names of stages to rerun regardless of their state
+    :param state_file Path: JSON file holding fingerprints and timings
+
+    returns: `records`: dict of stage name to status ("done", "skipped",
+        "failed", "blocked"), seconds and error
+    """
+    workdir = Path(workdir or os.getcwd()).resolve()
+    state_file = Path(state_file or workdir / CACHE_DIR_NAME / "pipeline.json")
+    state = read_json(state_file) or {}
+
+    by_name = {stage.name: stage for stage in stages}
+    dependencies = _stage_dependencies(stages)
+    _check_acyclic(dependencies)
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    records = {}
+    pending = list(by_name)
+    running = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    statuses = [records.get(d, {}).get("status") for d in dependencies[name]]
+                    if any(s in ("failed", "blocked") for s in statuses):
+                        records[name] = {"status": "blocked", "seconds": 0.0, "error": None}
+                        pending.remove(name)
+                        continue
+                    if not all(s in ("done", "skipped") for s in statuses):
+                        continue
+
+                    pending.remove(name)
+                    stage = by_name[name]
+                    try:
+                        fingerprint = stage_fingerprint(stage)
+                    except OSError as e:
+                        records[name] = {"status": "failed", "seconds": 0.0, "error": str(e)}
+                        print(f"-- Stage failed: {name}: {e}")
+                        continue
+                    if name not in force and _is_up_to_date(stage, fingerprint, state.get(name)):
+                        print(f"-- Stage up to date: {name}")
+                        records[name] = {"status": "skipped", "seconds": 0.0, "error": None}
+                        continue
+
+                    print(f"-- Running stage: {name}")
+                    future = executor.submit(_run_stage, stage.func, stage.kwargs, str(workdir))
+                    running[future] = (name, fingerprint)
+
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, fingerprint = running.pop(future)
+                    stage = by_name[name]
+                    try:
+                        seconds = future.result()
+                        missing = [str(o) for o in stage.outputs if not Path(o).is_file()]
+                        if missing:
+                            raise RuntimeError(f"Stage did not write {', '.join(missing)}")
+                    except Exception as e:
+                        records[name] = {"status": "failed", "seconds": 0.0, "error": str(e)}
+                        print(f"-- Stage failed: {name}: {e}")
+                        state.pop(name, None)
+                        continue
+
+                    records[name] = {"status": "done", "seconds": seconds, "error": None}
+                    state[name] = {
+                        "fingerprint": fingerprint,
+                        "outputs": {str(o): file_digest(o) for o in stage.outputs},
+                        "seconds": seconds,
+                        "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    }
+                    print(f"-- Stage done: {name} ({seconds:.1f} s)")
+                    write_json(state_file, state)
+    finally:
+        os.chdir(cwd)
+
+    write_json(state_file, state)
+    return records
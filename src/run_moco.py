@@ -4,12 +4,15 @@ Run full MSM Moco.track optim workflow
 
 # Imports ---------------------------------------------------------------------
 import os
+import argparse
 from pathlib import Path
 
 from src.moco_emu import moco_predict_kinematics
 from src.sto_generator import generate_sto
-from src.moco_track_kinematics import moco_track_states
+from src.moco_track_kinematics import moco_track_states, extract_muscle_fiber_data
+from src.force_vector_extractor import extract_force_vectors
 from src.sto_visualizer import visualize_sto
+from src.pipeline import Stage, run_pipeline
 
 from utils.md_logger import log_md
 try:
@@ -22,60 +25,164 @@ except ImportError:
     md_log_file = None
 
 
+# Parse args ------------------------------------------------------------------
+def parse_arguments():
+    """
+    Parse CLI arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the full MSM workflow, rebuilding only stages with changed inputs",
+        add_help=False,
+    )
+    parser.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        default=argparse.SUPPRESS,
+        help='Use switches followed by "=" to use CLI file autocomplete, example "-i="',
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        type=str,
+        help="Path to input .osim model",
+    )
+    parser.add_argument(
+        "--force",
+        type=str,
+        nargs="+",
+        default=(),
+        help="Stages to rerun regardless of their state (e.g. --force track)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Maximum number of concurrently running stages",
+    )
+    parser.add_argument(
+        "-v",
+        "--visuals",
+        action="store_true",
+        help="Visualize the tracking solution",
+    )
+    return parser.parse_args()
+
+
+# Defs ------------------------------------------------------------------------
+def moco_stages(model_file, filter_params):
+    """
+    Stage graph of the workflow: gait prediction -> kinematics .sto -> tracking,
+    followed by muscle fiber analysis and force vector extraction in parallel.
+
+    returns: `stages`, `solution_file`
+    """
+    gait_prediction_file = Path(f"{model_file.stem}_predicted_gait_success.sto")
+    track_states_file = Path(f"{gait_prediction_file.stem}_moco_track_states.sto")
+    solution_file = Path(f"{track_states_file.stem}_solution_success.sto")
+
+    stages = [
+        Stage(
+            "gait",
+            moco_predict_kinematics,
+            inputs=[model_file],
+            outputs=[gait_prediction_file],
+            kwargs=dict(input_model_file=model_file),
+        ),
+        Stage(
+            "kinematics",
+            generate_sto,
+            inputs=[gait_prediction_file],
+            outputs=[track_states_file],
+            kwargs=dict(input_file=gait_prediction_file, filter_params=filter_params),
+        ),
+        Stage(
+            "track",
+            moco_track_states,
+            inputs=[model_file, track_states_file],
+            outputs=[solution_file],
+            kwargs=dict(
+                model_file=model_file,
+                input_sto_file=track_states_file,
+                filter_params=filter_params,
+                analyze_fibers=False,
+            ),
+        ),
+        Stage(
+            "fibers",
+            extract_muscle_fiber_data,
+            inputs=[model_file, solution_file],
+            outputs=[Path(f"{solution_file.stem}_muscle_fiber_data.sto")],
+            kwargs=dict(model_file=model_file, solution_file=solution_file),
+        ),
+        Stage(
+            "force_vectors",
+            extract_force_vectors,
+            inputs=[model_file, solution_file],
+            outputs=[
+                Path(f"{solution_file.stem}_muscle_origins.json"),
+                Path(f"{solution_file.stem}_muscle_vectors.json"),
+            ],
+            kwargs=dict(
+                osim_path=str(model_file),
+                sto_path=str(solution_file),
+                output_path=".",
+            ),
+        ),
+    ]
+    return stages, solution_file
+
+
 # Main ------------------------------------------------------------------------
 @log_md(md_log_file)
 def run_moco_modules(
     model_file,
     filter_params,
-    generate_gait=False,
-    generate_kinematics_sto=False,
-    generate_moco_track=False,
     visualize=False,
+    force=(),
+    workers=None,
 ):
+    """
+    Run the workflow incrementally: stages whose inputs and settings are
+    unchanged since their last run are skipped (see `src.pipeline`).
 
-    if generate_gait:
-        # generate Pasha's gait prediction (Python version)
-        gait_prediction_file = moco_predict_kinematics(model_file)
-    else:
-        gait_prediction_file = Path(f"{model_file.stem}_predicted_gait_success.sto")
+    :param model_file Path: .osim model, relative to the working directory
+    :param filter_params Dict: filter parameters selecting the tracked states
+    :param visualize Bool: Visualize the tracking solution
+    :param force list: Names of stages to rerun regardless of their state
+    :param workers int: Maximum number of concurrently running stages
 
-    if generate_kinematics_sto:
-        # Filter states of interest (kinematics) from the gait prediction .sto
-        track_states_file = generate_sto(
-            gait_prediction_file,
-            filter_params,
-            visualize=visualize,
-        )
-    else:
-        track_states_file = Path(
-            f"{model_file.stem}_predicted_gait_success_moco_track_states.sto"
-        )
+    returns: `records`: per-stage status and timings
+    """
+    stages, solution_file = moco_stages(model_file, filter_params)
+    records = run_pipeline(stages, workers=workers, force=force)
 
-    if generate_moco_track:
-        # Run filtered states through Moco.track optimization to generate inverse dynamics
-        tracked_states_solution_file = moco_track_states(
-            model_file,
-            track_states_file,
-            filter_params,
-        )
-    else:
-        tracked_states_solution_file = Path(
-            f"{model_file.stem}_predicted_gait_success_moco_track_states_solution.sto"
-        )
+    for name, record in records.items():
+        print(f" - {name}: {record['status']} ({record['seconds']:.1f} s)")
 
-    if visualize:
+    if visualize and solution_file.exists():
         # visualizer
         visualize_sto(
-            tracked_states_solution_file,
+            solution_file,
             filter_params,
         )
 
+    return records
+
 
 if __name__ == "__main__":
-    model_file = Path(model_file) if model_file else Path("Dromaius_model_v4_intermed.osim")
+    args = parse_arguments()
+
+    model_file = (
+        Path(args.model)
+        if args.model
+        else Path(model_file) if model_file else Path("Dromaius_model_v4_intermed.osim")
+    )
 
     if model_file.parents[0]:
         os.chdir(model_file.parents[0])
+        model_file = Path(model_file.name)
 
     filter_params = {
         "state_filters": ["jointset"],
@@ -84,8 +191,7 @@ if __name__ == "__main__":
     run_moco_modules(
         model_file,
         filter_params,
-        generate_gait=False,
-        generate_kinematics_sto=True,
-        generate_moco_track=False,
-        visualize=False,
+        visualize=args.visuals,
+        force=args.force,
+        workers=args.workers,
     )
@@ -0,0 +1,255 @@
+"""
+Convert a batch of .mat/.sto trials to Moco.Track .sto files in parallel
+"""
+
+# Imports ---------------------------------------------------------------------
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.sto_generator import read_input, generate_df_from_model
+from utils.filters import filter_states
+from utils.mat_reader import MAT_VARIABLE
+from utils.osim_model_parser import load_model_index
+from utils.sto_io import write_sto
+
+
+# Parse args ------------------------------------------------------------------
+def parse_arguments():
+    """
+    Parse CLI arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Convert directories of .mat/.sto trials to Moco.Track .sto files",
+        add_help=False,
+    )
+    parser.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        default=argparse.SUPPRESS,
+        help='Use switches followed by "=" to use CLI file autocomplete, example "-i="',
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        nargs="+",
+        help="Input directories, files or glob patterns (.mat/.sto)",
+        required=True,
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        type=str,
+        help="Path to input .osim model",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Output directory, defaults to the directory of each input",
+    )
+    parser.add_argument(
+        "-f",
+        "--filter",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Strings to filter states - can take multiple strings (e.g. -f jointset value)",
+    )
+    parser.add_argument(
+        "-if",
+        "--invert_filter",
+        action="store_true",
+        help="Inverts filter to exclude strings passed with -f / --filter",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of cores)",
+    )
+    parser.add_argument(
+        "-mv",
+        "--mat_variable",
+        type=str,
+        default=MAT_VARIABLE,
+        help=f"Name of the .mat struct holding the kinematics (default: {MAT_VARIABLE})",
+    )
+    return parser.parse_args()
+
+
+# Defs ------------------------------------------------------------------------
+OUTPUT_SUFFIX = "_moco_track_states.sto"
+MANIFEST_NAME = "sto_batch_manifest.json"
+
+
+def collect_inputs(inputs):
+    """
+    Expand directories and glob patterns into a sorted list of trial files.
+    Previously generated `*_moco_track_states.sto` files are skipped.
+    """
+    files = set()
+    for entry in inputs:
+        path = Path(entry)
+        if path.is_dir():
+            candidates = [*path.glob("*.mat"), *path.glob("*.sto")]
+        elif glob.has_magic(entry):
+            candidates = [Path(match) for match in glob.glob(entry)]
+        else:
+            candidates = [path]
+        files.update(
+            candidate.resolve()
+            for candidate in candidates
+            if candidate.suffix in (".mat", ".sto")
+            and not candidate.name.endswith(OUTPUT_SUFFIX)
+        )
+    return sorted(files)
+
+
+def convert_trial(
+    input_file,
+    output_file,
+    states,
+    joint_states,
+    filter_params,
+    mat_variable=MAT_VARIABLE,
+):
+    """
+    Convert one trial using a pre-parsed model state layout.
+
+    returns: `record`: dict with input, output, seconds, status and error
+    """
+    start = time.perf_counter()
+    record = {
+        "input": str(input_file),
+        "output": str(output_file),
+    }
+    try:
+        df, header = read_input(
+            input_file,
+            mat_variable=mat_variable,
+            joint_states=joint_states,
+        )
+        if input_file.suffix == ".mat":
+            df = generate_df_from_model(None, df, states=states)
+        if filter_params["state_filters"]:
+            df = filter_states(df, filter_params)
+        write_sto(output_file, header, df)
+        record.update(status="success", error=None)
+    except (Exception, SystemExit) as e:
+        record.update(status="failed", error=f"{type(e).__name__}: {e}")
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+
+# Main ------------------------------------------------------------------------
+def generate_sto_batch(
+    inputs,
+    model_file: Path,
+    output_dir: Path | None = None,
+    filter_params: dict | None = None,
+    workers: int | None = None,
+    mat_variable=MAT_VARIABLE,
+):
+    """
+    Convert all trials matched by `inputs` on a process pool.
+
+    :param inputs list: Directories, files or glob patterns of .mat/.sto trials
+    :param model_file Path: .osim model, parsed once for the whole batch
+    :param output_dir Path: Output directory, defaults to each input's directory
+    :param filter_params Dict: filter parameters applied to every trial
+    :param workers int: Number of worker processes, defaults to the core count
+    :param mat_variable str: Name of the .mat struct holding the kinematics
+
+    returns: `manifest_file`: Path to the JSON summary with per-file timings
+    """
+    filter_params = (
+        {
+            "state_filters": None,
+            "invert_filter": False,
+        }
+        if filter_params is None
+        else filter_params
+    )
+    input_files = collect_inputs(inputs)
+    if not input_files:
+        sys.exit("Error: No .mat/.sto inputs found. Exiting")
+
+    print(f"-- Reading model: {model_file}")
+    model_index = load_model_index(model_file)
+    states = model_index.state_table_columns
+    joint_states = model_index.joints
+
+    if output_dir is not None:
+        output_dir = Path(output_dir).resolve()
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    records = []
+    print(f"-- Converting {len(input_files)} trials")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                convert_trial,
+                input_file,
+                (output_dir or input_file.parent) / (input_file.stem + OUTPUT_SUFFIX),
+                states,
+                joint_states,
+                filter_params,
+                mat_variable,
+            )
+            for input_file in input_files
+        ]
+        for future in as_completed(futures):
+            record = future.result()
+            records.append(record)
+            print(f" - {record['status']}: {record['input']} ({record['seconds']:.2f} s)")
+
+    records.sort(key=lambda record: record["input"])
+    failed = [record for record in records if record["status"] != "success"]
+    manifest = {
+        "model": str(Path(model_file).resolve()),
+        "filter_params": filter_params,
+        "workers": workers or os.cpu_count(),
+        "num_trials": len(records),
+        "num_failed": len(failed),
+        "wall_seconds": time.perf_counter() - start,
+        "trials": records,
+    }
+    manifest_file = (output_dir or Path.cwd()) / MANIFEST_NAME
+    with open(manifest_file, "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    print(f"-- Done, {len(records) - len(failed)} / {len(records)} converted, writing:")
+    print(f" - {manifest_file}")
+    for record in failed:
+        print(f" - Failed: {record['input']}: {record['error']}")
+
+    return manifest_file
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    filter_params = {
+        "state_filters": args.filter,
+        "invert_filter": args.invert_filter,
+    }
+
+    generate_sto_batch(
+        args.input,
+        Path(args.model),
+        Path(args.output) if args.output else None,
+        filter_params,
+        workers=args.workers,
+        mat_variable=args.mat_variable,
+    )
@@ -4,13 +4,15 @@ import argparse
 from pathlib import Path
 import pandas as pd
 import numpy as np
-from pymatreader import read_mat
 import plotly.graph_objects as go
 
 from utils.filters import filter_states, filter_states_visualization
 from utils.osim_model_parser import parse_model_for_states
 from utils.md_logger import log_md
+from utils.mat_reader import MAT_ANGLE_SUFFIXES, MAT_VARIABLE, read_mat_variable
 from utils.osim_model_parser import parse_model_for_joints
+from utils.sto_io import STO_FLOAT_FORMAT, read_sto, write_sto, write_sto_body
+from utils.sto_cache import read_sto_cached
 
 try:
     from utils.get_paths import md_log_file
@@ -67,6 +69,13 @@ def parse_arguments():
         action="store_true",
         help="Inverts filter to exclude strings passed with -f / --filter",
     )
+    parser.add_argument(
+        "-mv",
+        "--mat_variable",
+        type=str,
+        default=MAT_VARIABLE,
+        help=f"Name of the .mat struct holding the kinematics (default: {MAT_VARIABLE})",
+    )
     parser.add_argument(
         "-v",
         "--visuals",
@@ -77,33 +86,60 @@ def parse_arguments():
 
 
 # Defs ------------------------------------------------------------------------
-def read_mat_to_df(input_file):
-    data = read_mat(input_file)
-    # print(data.keys())
-    return pd.DataFrame(data["WeightedToes"])
-
+def read_mat_to_df(input_file, variable=MAT_VARIABLE, fields=None):
+    """
+    Load a .mat struct variable as a DataFrame, one column per field.
 
-def read_input(input_file, model_file=None):
+    :param input_file Path: .mat file
+    :param variable str: Name of the struct variable
+    :param fields list: Field names to load, None for all
+    """
+    return pd.DataFrame(read_mat_variable(input_file, variable, fields))
+
+
+def read_input(
+    input_file,
+    model_file=None,
+    columns=None,
+    patterns=None,
+    time_range=None,
+    use_cache=True,
+    mat_variable=MAT_VARIABLE,
+    joint_states=None,
+):
     """
     Generate .sto based on input file type.
 
     :param `input_file` Path: Path to input file type used to generate the new .sto
     :: supported file types: .sto / .mat
+    :param columns list | callable: .sto only - column names (or predicate) to load
+    :param patterns list: .sto only - regular expressions of state paths to load
+    :param time_range tuple: .sto only - (start, stop) in seconds to load
+    :param use_cache bool: .sto only - serve repeated loads from the binary
+        sidecar cache (see `utils.sto_cache`)
+    :param mat_variable str: .mat only - name of the struct holding the kinematics
+    :param joint_states dict: .mat only - pre-parsed `parse_model_for_joints`
+        output, saves re-parsing `model_file` when converting many trials
     """
     df = None
     header = []
     input_file = Path(input_file)
     if input_file.suffix == ".sto":
-        with open(input_file, "r") as file:
-            header = []
-            for line in file:
-                header.append(line)
-                if "endheader" in line:
-                    break
-        df = pd.read_csv(input_file, sep="\t", skiprows=len(header))
+        reader = read_sto_cached if use_cache else read_sto
+        df, header = reader(
+            input_file,
+            columns=columns,
+            patterns=patterns,
+            time_range=time_range,
+        )
     elif input_file.suffix == ".mat":
-
-        df = read_mat_to_df(input_file)
+        # Only load the frame numbers and the model's joint angle fields
+        if joint_states is None:
+            joint_states = parse_model_for_joints(model_file)
+        fields = ["FrameNumber"] + [
+            f"{joint}{suffix}" for joint in joint_states for suffix in MAT_ANGLE_SUFFIXES
+        ]
+        df = read_mat_to_df(input_file, variable=mat_variable, fields=fields)
 
         # states = jointset, forceset/activation, forceset/normalized_tendon_force
         # controls = forceset/muscles
@@ -126,7 +162,6 @@ def read_input(input_file, model_file=None):
         df = df.rename(columns={"FrameNumber": "time"})
         df["time"] = df["time"] / framerate
 
-        joint_states = parse_model_for_joints(model_file)
         for joint in joint_states:
             print(f"- {joint}")
             for state in joint_states[joint]:
@@ -166,13 +201,9 @@ def write_header(output_file, header):
         file.writelines(header)
 
 
-def write_columns(df, output_file):
+def write_columns(df, output_file, float_format=STO_FLOAT_FORMAT):
     with open(output_file, "a") as file:
-        # Write column names (time + state columns)
-        file.write("\t".join(df.columns) + "\n")
-        # Write data rows
-        for _, row in df.iterrows():
-            file.write("\t".join(map(str, row.values)) + "\n")
+        write_sto_body(file, df, float_format=float_format)
 
 
 def visualize_states(df):
@@ -192,24 +223,60 @@ def visualize_states(df):
     fig.show()
 
 
-def generate_df_from_model(model_file, df):
-    print(f"-- Reading model: {model_file}")
-    states = parse_model_for_states(model_file)
+def column_to_float(values, empty_value=0.0):
+    """
+    Convert a DataFrame column to contiguous float64.
+
+    Object columns from .mat structs mix scalars with empty MATLAB arrays
+    ([]), these become `empty_value`.
+    """
+    values = np.asarray(values)
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        sizes = np.fromiter(map(np.size, values), dtype=np.intp, count=len(values))
+        column = np.full(len(values), empty_value, dtype=np.float64)
+        filled = sizes > 0
+        if filled.any():
+            column[filled] = np.concatenate(list(map(np.ravel, values[filled])))
+        return column
+
+
+def assemble_state_table(df, states, include, empty_value=0.0, nan_value=None):
+    """
+    Build a reference table with one column per model state in one allocation.
+
+    :param df pd.DataFrame: Input data with a `time` column and state columns
+    :param states list: Ordered state names, starting with `time`
+    :param include callable: Predicate selecting the states copied from `df`,
+        all other states are zero
+    :param empty_value float: Value for empty MATLAB arrays ([])
+    :param nan_value float: Value for missing entries, None keeps NaN
+    """
+    data = np.zeros((len(df["time"]), len(states)), dtype=np.float64)
+    for i, state in enumerate(states):
+        if state == "time" or include(state):
+            data[:, i] = column_to_float(df[state].to_numpy(), empty_value)
+
+    if nan_value is not None:
+        data[np.isnan(data)] = nan_value
 
-    df2 = pd.DataFrame(0, index=range(len(df["time"])), columns=states)
-    df2["time"] = df["time"]
+    return pd.DataFrame(data, columns=states)
 
-    # Hardcoded kinematics filter
-    for state in states:
-        if "jointset" in state:
-            print(f" - Writing state: {state}")
-            df2[state] = df[state]
 
-    # Get rid of leftover empty matlab lists ([])
-    df2 = df2.map(lambda x: 0 if isinstance(x, np.ndarray) and len(x) == 0 else x)
-    df2 = df2.map(lambda x: 0.1 if pd.isna(x) else x)
+def generate_df_from_model(model_file, df, states=None):
+    if states is None:
+        print(f"-- Reading model: {model_file}")
+        states = parse_model_for_states(model_file)
 
-    return df2
+    # Hardcoded kinematics filter
+    return assemble_state_table(
+        df,
+        states,
+        include=lambda state: "jointset" in state,
+        empty_value=0.0,
+        nan_value=0.1,
+    )
 
 
 # Main ------------------------------------------------------------------------
@@ -220,6 +287,7 @@ def generate_sto(
     model_file: Path | None = None,
     output_file: Path | None = None,
     visualize=False,
+    mat_variable=MAT_VARIABLE,
 ):
     """
     Generate custom .sto for Moco.Track based on filters
@@ -229,6 +297,7 @@ def generate_sto(
     :param model_file Path: .osim file, required when generating .sto from .mat.
     :param output_file Path: Custom .sto containing model states, with 0 for non tracked timeseries
     :param visualize Bool: Activate to visualize data contained in generated .sto
+    :param mat_variable str: Name of the .mat struct holding the kinematics
 
     returns: `output_file`: Path to generated .sto
     """
@@ -250,19 +319,22 @@ def generate_sto(
         else filter_params
     )
 
+    df, header = read_input(
+        input_file,
+        model_file=model_file,
+        mat_variable=mat_variable,
+    )
+
     if filter_params["state_filters"]:
         df = filter_states(df, filter_params)
 
-    df, header = read_input(input_file, model_file=model_file)
-
     if input_file.suffix == ".mat":
         if model_file:
             df = generate_df_from_model(model_file, df)
         else:
             sys.exit("Error: .mat file requires .osim model file to generate sto")
 
-    write_header(output_file, header)
-    write_columns(df, output_file)
+    write_sto(output_file, header, df)
 
     if visualize:
         visualize_states(df)
@@ -300,4 +372,5 @@ if __name__ == "__main__":
         model_file,
         output_file,
         visualize=args.visuals,
+        mat_variable=args.mat_variable,
     )
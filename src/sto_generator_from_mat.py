@@ -2,11 +2,10 @@
 import os
 import argparse
 from pathlib import Path
-import pandas as pd
-import numpy as np
 
 from utils.osim_model_parser import parse_model_for_states
-from sto_generator import read_input, write_header, write_columns
+from sto_generator import read_input, assemble_state_table
+from utils.sto_io import write_sto
 
 from utils.md_logger import log_md
 try:
@@ -78,19 +77,14 @@ def sto_from_model(
     print(f"-- Reading model: {model_file}")
     states = parse_model_for_states(model_file)
 
-    df2 = pd.DataFrame(0, index=range(len(df["time"])), columns=states)
-    df2["time"] = df["time"]
-
-    for state in states:
-        if "jointset" in state and "ground" not in state:
-            print(f" - Writing state: {state}")
-            df2[state] = df[state]
-
-    # Get rid of leftover empty matlab lists ([])
-    df2 = df2.map(lambda x: 0 if isinstance(x, np.ndarray) and len(x) == 0 else x)
+    df2 = assemble_state_table(
+        df,
+        states,
+        include=lambda state: "jointset" in state and "ground" not in state,
+        empty_value=0.0,
+    )
 
-    write_header(output_file, header)
-    write_columns(df2, output_file)
+    write_sto(output_file, header, df2)
     print(f"-- Output .sto generated:\n - {output_file}")
 
 
@@ -8,7 +8,7 @@ import plotly.graph_objects as go
 from src.sto_generator import read_input, filter_states_visualization
 from pathlib import Path
 
-from utils.filters import filter_states_visualization
+from utils.filters import visualization_columns
 
 from utils.md_logger import log_md
 try:
@@ -81,10 +81,12 @@ def visualize_states(df):
 # Main ------------------------------------------------------------------------
 @log_md(md_log_file)
 def visualize_sto(input_file, filter_params):
-    df, _ = read_input(input_file)
-
-    if filter_params["state_filters"]:
-        df = filter_states_visualization(df, filter_params)
+    columns = (
+        visualization_columns(filter_params)
+        if filter_params["state_filters"]
+        else None
+    )
+    df, _ = read_input(input_file, columns=columns)
 
     visualize_states(df)
 
@@ -0,0 +1,267 @@
+"""
+Library of successful Moco solutions, reused as initial guesses.
+
+Solutions are indexed by model, gait speed, duration and a kinematic signature
+(coordinate values sampled at fixed fractions of the motion). A new problem is
+seeded with its nearest stored neighbour within `LIBRARY_MAX_DISTANCE`,
+stretched onto the new time window. The index is updated under a file lock, so
+concurrent solves can add solutions, and least recently used solutions are
+evicted beyond `SOLUTION_LIBRARY_MAX_BYTES`.
+"""
+
+# Imports ---------------------------------------------------------------------
+import os
+import time
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from utils.file_cache import file_digest, file_lock, read_json, write_json
+from utils.sto_io import read_sto
+
+
+# Defs ------------------------------------------------------------------------
+SOLUTION_LIBRARY_DIR = Path(
+    os.environ.get(
+        "MOCOMSM_SOLUTION_LIBRARY",
+        Path.home() / ".cache" / "mocomsm" / "solutions",
+    )
+)
+SOLUTION_LIBRARY_MAX_BYTES = int(
+    os.environ.get("MOCOMSM_SOLUTION_LIBRARY_MAX_BYTES", 1024**3)
+)
+# Solutions further away than this (see `find_nearest`) are not used as guesses
+LIBRARY_MAX_DISTANCE = float(os.environ.get("MOCOMSM_LIBRARY_MAX_DISTANCE", 0.2))
+INDEX_NAME = "index.json"
+LOCK_NAME = "index.lock"
+SIGNATURE_SAMPLES = 8
+
+
+def kinematic_signature(df, num_samples=SIGNATURE_SAMPLES):
+    """
+    Coordinate values sampled at evenly spaced fractions of the motion.
+
+    Forward translation (`_tx`) depends on the starting position and columns
+    that are identically zero (untracked states in generated references) carry
+    no information, so both are left out.
+
+    :param df pd.DataFrame: States table with `time` as first column
+    :param num_samples int: Samples per coordinate
+
+    returns: `signature`: dict of coordinate value column to list of samples
+    """
+    times = df["time"].to_numpy()
+    phase = (times - times[0]) / (times[-1] - times[0])
+    samples = np.linspace(0, 1, num_samples)
+
+    signature = {}
+    for column in df.columns:
+        if not column.endswith("/value") or column.endswith("_tx/value"):
+            continue
+        values = df[column].to_numpy()
+        if not np.any(values):
+            continue
+        signature[column] = np.interp(samples, phase, values).tolist()
+    return signature
+
+
+def signature_distance(signature, other):
+    """RMS difference over the coordinates both signatures share, None if none."""
+    shared = signature.keys() & other.keys()
+    if not shared:
+        return None
+    differences = np.array([np.subtract(signature[c], other[c]) for c in shared])
+    return float(np.sqrt(np.mean(differences**2)))
+
+
+def load_library(library_dir=SOLUTION_LIBRARY_DIR):
+    """Index entries of the library, oldest first."""
+    return read_json(Path(library_dir) / INDEX_NAME) or []
+
+
+def add_solution(
+    solution_file,
+    model_file,
+    kind,
+    speed=None,
+    iterations=None,
+    objective=None,
+    warm_start=False,
+    library_dir=SOLUTION_LIBRARY_DIR,
+    max_bytes=SOLUTION_LIBRARY_MAX_BYTES,
+):
+    """
+    Copy a successful solution into the library and index it, evicting least
+    recently used solutions beyond `max_bytes`.
+
+    :param solution_file Path: `_success.sto` written by Moco
+    :param model_file Path: .osim model the solution was solved for
+    :param kind str: Problem type, "gait" or "track"; only solutions of the
+        same kind are used as guesses for each other
+    :param speed float: Prescribed average gait speed (m/s), if any
+    :param iterations int: Solver iterations, kept to compare warm and cold starts
+    :param objective float: Final objective value
+    :param warm_start bool: Whether the solve was seeded from the library
+    :param max_bytes int: Size bound of the stored solutions
+
+    returns: `entry`: the index entry
+    """
+    library_dir = Path(library_dir)
+    library_dir.mkdir(parents=True, exist_ok=True)
+
+    digest = file_digest(solution_file)
+    df, _ = read_sto(solution_file)
+    times = df["time"].to_numpy()
+    entry = {
+        "digest": digest,
+        "kind": kind,
+        "model": file_digest(model_file),
+        "model_name": Path(model_file).name,
+        "source": str(Path(solution_file).resolve()),
+        "speed": speed,
+        "duration": float(times[-1] - times[0]),
+        "signature": kinematic_signature(df),
+        "iterations": iterations,
+        "objective": objective,
+        "warm_start": warm_start,
+        "added": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+    with file_lock(library_dir / LOCK_NAME):
+        stored_file = library_dir / f"{digest}.sto"
+        if not stored_file.exists():
+            shutil.copyfile(solution_file, stored_file)
+        index = [e for e in load_library(library_dir) if e["digest"] != digest]
+        index.append(entry)
+        index = _evict(index, library_dir, max_bytes, keep=digest)
+        write_json(library_dir / INDEX_NAME, index)
+
+    return entry
+
+
+def _evict(index, library_dir, max_bytes, keep=None):
+    # Drop least recently used solutions (by stored file mtime, see
+    # `library_guess`) until the library fits `max_bytes`
+    stored = {}
+    for entry in index:
+        try:
+            stored[entry["digest"]] = (library_dir / f"{entry['digest']}.sto").stat()
+        except OSError:
+            pass
+    index = [entry for entry in index if entry["digest"] in stored]
+    total = sum(stat.st_size for stat in stored.values())
+    evicted = set()
+    for digest in sorted(stored, key=lambda digest: stored[digest].st_mtime):
+        if total <= max_bytes:
+            break
+        if digest == keep:
+            continue
+        (library_dir / f"{digest}.sto").unlink(missing_ok=True)
+        total -= stored[digest].st_size
+        evicted.add(digest)
+    return [entry for entry in index if entry["digest"] not in evicted]
+
+
+def find_nearest(
+    model_file,
+    kind,
+    speed=None,
+    duration=None,
+    signature=None,
+    max_distance=LIBRARY_MAX_DISTANCE,
+    library_dir=SOLUTION_LIBRARY_DIR,
+):
+    """
+    Nearest stored solution of the same model and problem kind.
+
+    The distance sums the relative speed and duration differences and the
+    signature RMS difference (rad), over whichever of them both sides have.
+    Ties go to the most recently added solution.
+
+    :param model_file Path: .osim model of the new problem
+    :param kind str: Problem type, see `add_solution`
+    :param speed float: Prescribed average gait speed (m/s)
+    :param duration float: Duration of the motion (s)
+    :param signature dict: `kinematic_signature` of the reference motion
+    :param max_distance float: Ignore solutions further away than this,
+        None accepts any distance
+
+    returns: `entry`, `distance`, or None, None if the library has no match
+    """
+    library_dir = Path(library_dir)
+    model = file_digest(model_file)
+
+    best, best_distance = None, None
+    for entry in reversed(load_library(library_dir)):
+        if entry["kind"] != kind or entry["model"] != model:
+            continue
+        if not (library_dir / f"{entry['digest']}.sto").is_file():
+            continue
+
+        distance = 0.0
+        if speed is not None and entry["speed"] is not None:
+            distance += abs(entry["speed"] - speed) / speed
+        if duration is not None:
+            distance += abs(entry["duration"] - duration) / duration
+        if signature is not None:
+            signature_term = signature_distance(signature, entry["signature"])
+            distance += signature_term if signature_term is not None else 0.0
+
+        if max_distance is not None and distance > max_distance:
+            continue
+        if best_distance is None or distance < best_distance:
+            best, best_distance = entry, distance
+
+    return best, best_distance
+
+
+def _time_scale_power(name, kind):
+    # Speeds and first-order derivatives scale with 1 / T, accelerations 1 / T^2
+    if kind == "state":
+        return 1 if name.endswith("/speed") else 0
+    if kind == "derivative":
+        return 2 if name.endswith("/accel") else 1
+    return 0
+
+
+def library_guess(solver, entry, initial_time, final_time, library_dir=SOLUTION_LIBRARY_DIR):
+    """
+    Initial guess on the solver's mesh from a library solution, stretched onto
+    [initial_time, final_time] (see `rescale_trajectory` in `src.moco_emu`).
+    Variables the stored solution does not have keep their bounds guess.
+
+    :param solver osim.MocoCasADiSolver: Solver of the new problem
+    :param entry dict: Library entry, from `find_nearest`
+    :param initial_time float: Start of the new time window (s)
+    :param final_time float: End of the new time window (s)
+
+    returns: `guess`: osim.MocoTrajectory
+    """
+    stored_file = Path(library_dir) / f"{entry['digest']}.sto"
+    df, _ = read_sto(stored_file)
+    # Mark as recently used for eviction
+    os.utime(stored_file)
+    source_times = df["time"].to_numpy()
+    source_phase = (source_times - source_times[0]) / entry["duration"]
+
+    guess = solver.createGuess()
+    num_times = guess.getNumTimes()
+    guess.setTime(np.linspace(initial_time, final_time, num_times))
+    phase = np.linspace(0, 1, num_times)
+    scale = (final_time - initial_time) / entry["duration"]
+
+    variables = [
+        ("state", guess.getStateNames(), guess.setState),
+        ("control", guess.getControlNames(), guess.setControl),
+        ("multiplier", guess.getMultiplierNames(), guess.setMultiplier),
+        ("derivative", guess.getDerivativeNames(), guess.setDerivative),
+    ]
+    for kind, names, setter in variables:
+        for name in names:
+            if name not in df.columns:
+                continue
+            values = np.interp(phase, source_phase, df[name].to_numpy())
+            setter(name, values / scale ** _time_scale_power(name, kind))
+
+    return guess
@@ -0,0 +1,142 @@
+"""
+Helpers for content-keyed cache files stored next to their source.
+"""
+
+# Imports ---------------------------------------------------------------------
+import os
+import json
+import hashlib
+import tempfile
+from pathlib import Path
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+# Defs ------------------------------------------------------------------------
+CACHE_DIR_NAME = ".mocomsm_cache"
+
+
+def file_digest(path, block_size=1 << 20):
+    """Return the hex sha256 digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_stamp(path):
+    """Return the (size, mtime_ns) pair used as a cheap validity check."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def sidecar_path(source, suffix):
+    """
+    Path of a cache file for `source`, kept in a hidden folder next to it so
+    it never matches the file globs used by the app.
+    """
+    source = Path(source)
+    return source.parent / CACHE_DIR_NAME / f"{source.name}{suffix}"
+
+
+def atomic_write(path, write):
+    """
+    Call `write(tmp_path)` and move the result onto `path` atomically, so
+    readers never see a partially written cache file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def file_lock(lock_file):
+    """
+    Hold an exclusive lock on `lock_file` (created if missing) across
+    processes: `flock` on POSIX, `msvcrt.locking` of its first byte on Windows.
+    """
+    lock_file = Path(lock_file)
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    # Blocks for about 10 s before raising, so keep retrying
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is None:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    finally:
+        os.close(fd)
+
+
+def write_json(path, data):
+    def write(tmp_path):
+        with open(tmp_path, "w") as file:
+            json.dump(data, file)
+
+    atomic_write(path, write)
+
+
+def read_json(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def is_cache_valid(source, meta):
+    """
+    Check cached metadata against `source`: size and mtime first, falling back
+    to the content digest when only the mtime changed (e.g. a copied file).
+    Refreshes the stored mtime in `meta` on a digest match.
+    """
+    if meta is None:
+        return False
+    size, mtime_ns = file_stamp(source)
+    if meta.get("size") != size:
+        return False
+    if meta.get("mtime_ns") == mtime_ns:
+        return True
+    if meta.get("digest") == file_digest(source):
+        meta["mtime_ns"] = mtime_ns
+        return True
+    return False
+
+
+def cache_key(source):
+    """Metadata identifying the current content of `source`."""
+    size, mtime_ns = file_stamp(source)
+    return {
+        "size": size,
+        "mtime_ns": mtime_ns,
+        "digest": file_digest(source),
+    }
@@ -25,3 +25,19 @@ def filter_states_visualization(df, filter_params):
     filtered = ["time"] + filtered
     df_filtered = df[filtered]
     return df_filtered
+
+
+def visualization_columns(filter_params):
+    """
+    Column predicate equivalent to `filter_states_visualization`, for use as
+    the `columns` argument of `read_input` so filtered columns are never loaded.
+    """
+    def keep(col):
+        return col == "time" or (
+            ("time" not in col.lower())
+            and (
+                any(f in col.lower() for f in filter_params["state_filters"])
+                != filter_params["invert_filter"]
+            )
+        )
+    return keep
@@ -6,6 +6,54 @@ import matplotlib.pyplot as plt
 
 from src.sto_generator import read_input
 from utils.osim_model_parser import parse_model_for_force_vector
+from utils.run_bundle import is_bundle, read_bundle_force_vectors, read_bundle_table
+
+
+FORCE_COLUMN = "/forceset/FL_p_test/normalized_tendon_force"
+# Every GIF_FRAME_STEP-th solution frame is rendered
+GIF_FRAME_STEP = 5
+
+
+def load_vector_frames(
+    solution_path,
+    force_origins_path,
+    force_vectors_path,
+    step=GIF_FRAME_STEP,
+):
+    """
+    Load the rendered frames only: the scaling force column and the origins
+    and vectors of every `step`-th frame. Each path may be a run bundle
+    (see `utils.run_bundle`), from which only these slices are read.
+
+    returns: `forces` (frame,), `muscle_names`, `origins` and `vectors`
+        shaped (frame, muscle, 3)
+    """
+    if is_bundle(solution_path):
+        df, _ = read_bundle_table(solution_path, "solution", columns=[FORCE_COLUMN])
+    else:
+        df, _ = read_input(solution_path, columns=[FORCE_COLUMN])
+    forces = df[FORCE_COLUMN].to_numpy()[::step]
+
+    if is_bundle(force_vectors_path):
+        _, muscle_names, _, vectors = read_bundle_force_vectors(force_vectors_path, step=step)
+    else:
+        force_vectors = pd.read_json(force_vectors_path, orient='records', lines=True)
+        muscle_names = [name for name in force_vectors.keys() if name != 'time']
+        vectors = np.array(
+            [force_vectors[muscle].tolist()[::step] for muscle in muscle_names]
+        ).transpose(1, 0, 2)
+
+    if is_bundle(force_origins_path):
+        _, _, origins, _ = read_bundle_force_vectors(
+            force_origins_path, muscles=muscle_names, step=step
+        )
+    else:
+        force_origins = pd.read_json(force_origins_path, orient='records', lines=True)
+        origins = np.array(
+            [force_origins[muscle].tolist()[::step] for muscle in muscle_names]
+        ).transpose(1, 0, 2)
+
+    return forces, muscle_names, origins, vectors
 
 
 def generate_vector_gif(
@@ -16,10 +64,11 @@ def generate_vector_gif(
     gif_path,
 ):
     mesh = pv.read(os.path.join(mesh_path))
-    df, _ = read_input(solution_path)
-
-    force_origins = pd.read_json(force_origins_path, orient='records', lines=True)
-    force_vectors = pd.read_json(force_vectors_path, orient='records', lines=True)
+    forces, muscle_names, force_origins, force_vectors = load_vector_frames(
+        solution_path,
+        force_origins_path,
+        force_vectors_path,
+    )
 
     # Initiate plotter
     pl = pv.Plotter(off_screen=False)
@@ -30,23 +79,22 @@ def generate_vector_gif(
 
     pl.add_mesh(mesh, color="white")
 
-    muscle_names = [name for name in force_vectors.keys() if name != 'time']
     colors = plt.cm.gist_rainbow(np.linspace(0, 1, len(muscle_names)))
 
     force_vector_actor = {}
-    for muscle, color in zip(muscle_names, colors):
+    for j, (muscle, color) in enumerate(zip(muscle_names, colors)):
         rgb_color = color[:3]
 
         pl.add_mesh(
-            pv.PolyData(force_origins[muscle][0]),
+            pv.PolyData(force_origins[0, j]),
             color="blue",
             point_size=30,
             render_points_as_spheres=True,
         )
         force_vector_actor[muscle] = pl.add_mesh(
             pv.Arrow(
-                start=force_origins[muscle][0],
-                direction=force_vectors[muscle][0],
+                start=force_origins[0, j],
+                direction=force_vectors[0, j],
                 scale=0.1,
             ),
             color=rgb_color,
@@ -54,15 +102,14 @@ def generate_vector_gif(
 
     pl.open_gif(gif_path)
     # Generate steps and animation behaviour
-    for step, force in enumerate(df["/forceset/FL_p_test/normalized_tendon_force"]):
-        if step % 5 == 0:
-            print(f"Generating gif: {step} / {len(df['time'])}", end="\r")
-            for muscle in muscle_names:
-                force_vector_actor[muscle].scale = force
-                # force_vector_actor[muscle].scale = [.3,.3,.3]
-                force_vector_actor[muscle].position = force_origins[muscle][step]
-                force_vector_actor[muscle].orientation =force_vectors[muscle][step]
-            pl.write_frame()
+    for frame, force in enumerate(forces):
+        print(f"Generating gif: {frame + 1} / {len(forces)}", end="\r")
+        for j, muscle in enumerate(muscle_names):
+            force_vector_actor[muscle].scale = force
+            # force_vector_actor[muscle].scale = [.3,.3,.3]
+            force_vector_actor[muscle].position = force_origins[frame, j]
+            force_vector_actor[muscle].orientation = force_vectors[frame, j]
+        pl.write_frame()
     pl.close()
 
     print("\nGif succesfully generated.")
@@ -0,0 +1,89 @@
+"""
+Selective readers for MATLAB motion-capture exports (.mat v5 and v7.3).
+"""
+
+# Imports ---------------------------------------------------------------------
+from scipy.io.matlab import matfile_version
+from pymatreader import read_mat
+
+
+# Defs ------------------------------------------------------------------------
+MAT_VARIABLE = "WeightedToes"
+MAT_ANGLE_SUFFIXES = ("Ang", "Angvel", "Angacc")
+
+
+def is_hdf5_mat(input_file):
+    """True for v7.3 .mat files, which are HDF5 and can be read lazily."""
+    with open(input_file, "rb") as file:
+        major, _ = matfile_version(file)
+    return major == 2
+
+
+def _v5_fields(input_file, variable):
+    # v5 stores a struct as one (compressed) element, so its field names are
+    # only available after decoding that variable - but none of the others
+    data = read_mat(input_file, variable_names=[variable])
+    if variable not in data:
+        raise KeyError(f"Variable '{variable}' not found in {input_file}")
+    return list(data[variable].keys()), data[variable]
+
+
+def list_mat_fields(input_file, variable=MAT_VARIABLE, suffixes=MAT_ANGLE_SUFFIXES):
+    """
+    List the fields of a .mat struct without loading its numeric payloads
+    (v7.3) or any of the other variables (v5).
+
+    :param input_file Path: .mat file
+    :param variable str: Name of the struct variable
+    :param suffixes tuple: Only list fields ending in one of these, None for all
+
+    returns: `fields`: list of field names in file order
+    """
+    if is_hdf5_mat(input_file):
+        import h5py
+
+        with h5py.File(input_file, "r") as file:
+            if variable not in file:
+                raise KeyError(f"Variable '{variable}' not found in {input_file}")
+            fields = list(file[variable].keys())
+    else:
+        fields, _ = _v5_fields(input_file, variable)
+
+    if suffixes is None:
+        return fields
+    return [field for field in fields if field.endswith(tuple(suffixes))]
+
+
+def read_mat_variable(input_file, variable=MAT_VARIABLE, fields=None):
+    """
+    Read a single struct variable from a .mat file, optionally only some fields.
+
+    :param input_file Path: .mat file
+    :param variable str: Name of the struct variable
+    :param fields list: Field names to load, None for all; missing names are skipped
+
+    returns: `data`: dict of field name to values
+    """
+    if is_hdf5_mat(input_file):
+        ignore_fields = None
+        if fields is not None:
+            wanted = set(fields)
+            ignore_fields = [
+                field
+                for field in list_mat_fields(input_file, variable, suffixes=None)
+                if field not in wanted
+            ]
+        data = read_mat(
+            input_file,
+            variable_names=[variable],
+            ignore_fields=ignore_fields,
+        )
+        if variable not in data:
+            raise KeyError(f"Variable '{variable}' not found in {input_file}")
+        data = data[variable]
+    else:
+        _, data = _v5_fields(input_file, variable)
+
+    if fields is None:
+        return data
+    return {field: data[field] for field in fields if field in data}
@@ -1,56 +1,487 @@
+"""
+Run logging and profiling of the pipeline entry points.
+
+Every decorated call is appended as one JSON line to a ledger next to the
+configured Markdown log; the Markdown view is rendered from it on demand:
+    python -m utils.md_logger -l path/to/log.md
+"""
+
 import os
+import sys
+import json
+import time
 import inspect
+import argparse
+import cProfile
+import threading
+import tracemalloc
+from pathlib import Path
 from datetime import datetime
 from functools import wraps
 
+from utils.file_cache import atomic_write, file_lock, read_json, write_json
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Profiling is switched on per environment, without editing code:
+#   MOCOMSM_PROFILE=1       record wall/CPU time, peak RSS and tracemalloc peak
+#   MOCOMSM_CPROFILE=1      additionally dump a cProfile .prof per call
+#   MOCOMSM_PROFILE_DIR     where run records and dumps go
+PROFILE_DIR = Path(
+    os.environ.get(
+        "MOCOMSM_PROFILE_DIR",
+        Path.home() / ".cache" / "mocomsm" / "profiles",
+    )
+)
+_frames = threading.local()
+
+
+def _env_flag(name):
+    return os.environ.get(name, "").lower() in ("1", "true", "yes", "on")
+
+
+def run_id():
+    """
+    Id shared by all profiled calls of a run, including worker processes
+    started after the first call (they inherit the environment).
+    """
+    if "MOCOMSM_RUN_ID" not in os.environ:
+        os.environ["MOCOMSM_RUN_ID"] = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}"
+    return os.environ["MOCOMSM_RUN_ID"]
+
+
+def _reset_peak_rss():
+    # Linux resets the VmHWM high-water mark on request
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _children_cpu():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class _Profile:
+    """
+    Measurements of one decorated call. Nested calls reset the peak counters,
+    so the enclosing call keeps the peaks seen before them and takes the
+    maximum at the end.
+    """
+
+    def __init__(self, func, use_cprofile):
+        self.func = func
+        stack = _frames.__dict__.setdefault("stack", [])
+        self.parent = stack[-1] if stack else None
+        self.use_cprofile = use_cprofile
+        self.profiler = None
+
+    def __enter__(self):
+        if self.parent is not None:
+            self.parent.absorb_peaks()
+        _frames.stack.append(self)
+
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.rss_resettable = _reset_peak_rss()
+        self.peak_rss = 0
+        self.peak_traced = 0
+
+        # Only one profiler can be active, nested calls are part of the outer dump
+        if self.use_cprofile and sys.getprofile() is None:
+            self.profiler = cProfile.Profile()
+        self.started = datetime.now()
+        self.cpu = time.process_time()
+        self.children_cpu = _children_cpu()
+        self.wall = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def absorb_peaks(self):
+        self.peak_traced = max(self.peak_traced, tracemalloc.get_traced_memory()[1])
+        self.peak_rss = max(self.peak_rss, _peak_rss() or 0)
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler is not None:
+            self.profiler.disable()
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        children_cpu = _children_cpu() - self.children_cpu
+        self.absorb_peaks()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        _frames.stack.pop()
+        if self.parent is not None:
+            # The parent's peaks since this call began are this call's peaks
+            self.parent.peak_traced = max(self.parent.peak_traced, self.peak_traced)
+            self.parent.peak_rss = max(self.parent.peak_rss, self.peak_rss)
+
+        record = {
+            "run": run_id(),
+            "function": self.func.__qualname__,
+            "module": self.func.__module__,
+            "pid": os.getpid(),
+            "started": self.started.isoformat(timespec="seconds"),
+            "parent": self.parent.func.__qualname__ if self.parent else None,
+            "status": "ok" if exc_type is None else f"{exc_type.__name__}: {exc}",
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "children_cpu_seconds": children_cpu,
+            "peak_rss_bytes": self.peak_rss,
+            "peak_rss_is_process_peak": not self.rss_resettable,
+            "tracemalloc_peak_bytes": self.peak_traced,
+            "cprofile": None,
+        }
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        if self.profiler is not None:
+            dump = PROFILE_DIR / f"{record['run']}_{os.getpid()}_{self.func.__name__}_{self.started:%H%M%S%f}.prof"
+            self.profiler.dump_stats(dump)
+            record["cprofile"] = str(dump)
+        write_profile_record(record)
+        self.record = record
+        return False
+
+
+def write_profile_record(record):
+    """
+    Append a record to the run's JSON-lines file with a single write, so
+    processes of the same run can share it.
+    """
+    line = (json.dumps(record, default=str) + "\n").encode()
+    fd = os.open(
+        PROFILE_DIR / f"{record['run']}.jsonl",
+        os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+        0o644,
+    )
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+# Ledger ----------------------------------------------------------------------
+# Rotate the ledger beyond this size, keeping LEDGER_BACKUPS older files
+LEDGER_MAX_BYTES = int(os.environ.get("MOCOMSM_LEDGER_MAX_BYTES", 5 * 1024**2))
+LEDGER_BACKUPS = 5
+INDEX_SIZE = 50
+GENERATED_MARKER = "<!-- Generated from the run ledger by utils.md_logger -->"
+
+
+def ledger_paths(log_file):
+    """
+    Files kept next to the Markdown log `log.md`: the ledger `log.jsonl`,
+    rotated ledgers `log.1.jsonl` (newest) to `log.5.jsonl`, the index of
+    recent calls `log.index.json` and the lock file `log.lock`.
+    """
+    log_file = Path(log_file)
+    stem = log_file.parent / log_file.stem
+    return {
+        "ledger": stem.with_name(f"{stem.name}.jsonl"),
+        "backups": [
+            stem.with_name(f"{stem.name}.{i}.jsonl") for i in range(1, LEDGER_BACKUPS + 1)
+        ],
+        "index": stem.with_name(f"{stem.name}.index.json"),
+        # Never rotated, so all processes lock the same file
+        "lock": stem.with_name(f"{stem.name}.lock"),
+        "legacy": stem.with_name(f"{stem.name}.legacy.md"),
+    }
+
+
+def _rotate(paths):
+    backups = paths["backups"]
+    if backups[-1].exists():
+        backups[-1].unlink()
+    for older, newer in zip(reversed(backups), list(reversed(backups))[1:]):
+        if newer.exists():
+            os.replace(newer, older)
+    os.replace(paths["ledger"], backups[0])
+
+
+def append_ledger(log_file, entry):
+    """
+    Append an entry to the ledger of `log_file` and update the index of
+    recent calls. Under an exclusive lock the entry is written with a single
+    append, so concurrent processes never interleave or drop entries; the
+    cost does not grow with the ledger, which is rotated beyond
+    `LEDGER_MAX_BYTES`.
 
-def log_md(log_file=None):
+    :param log_file Path: Markdown log the ledger belongs to
+    :param entry dict: JSON-serializable call record
+    """
+    paths = ledger_paths(log_file)
+    line = (json.dumps(entry, default=str) + "\n").encode()
+    with file_lock(paths["lock"]):
+        ledger = paths["ledger"]
+        if ledger.exists() and ledger.stat().st_size + len(line) > LEDGER_MAX_BYTES:
+            _rotate(paths)
+        fd = os.open(ledger, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+        if entry.get("event") != "note":
+            index = read_json(paths["index"]) or []
+            index.append(_index_entry(entry))
+            write_json(paths["index"], index[-INDEX_SIZE:])
+
+
+def _index_entry(entry):
+    keys = ("id", "started", "function", "file", "status", "wall_seconds", "run")
+    return {key: entry.get(key) for key in keys}
+
+
+def recent_runs(log_file, n=10):
+    """
+    The last `n` logged calls (at most `INDEX_SIZE`), newest first, from the
+    index, without reading the ledger.
+
+    returns: `runs`: list of dicts with id, started, function, file, status,
+        wall_seconds and run
+    """
+    index = read_json(ledger_paths(log_file)["index"]) or []
+    return index[::-1][:n]
+
+
+def read_ledger(log_file, include_rotated=True):
+    """
+    Read all entries of a ledger, oldest first, skipping a partially written
+    last line.
+
+    returns: `entries`: list of dicts
+    """
+    paths = ledger_paths(log_file)
+    files = list(reversed(paths["backups"])) if include_rotated else []
+    entries = []
+    for ledger in files + [paths["ledger"]]:
+        try:
+            with open(ledger, "r") as file:
+                for line in file:
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            continue
+    return entries
+
+
+def add_note(log_file, text, call_id=None):
+    """
+    Attach a note to a logged call, by default the most recent one.
+
+    returns: id of the annotated call
+    """
+    if call_id is None:
+        runs = recent_runs(log_file, 1)
+        if not runs:
+            sys.exit("Error: Nothing logged yet")
+        call_id = runs[0]["id"]
+    append_ledger(
+        log_file,
+        {
+            "id": call_id,
+            "event": "note",
+            "note": text,
+            "started": datetime.now().isoformat(timespec="seconds"),
+        },
+    )
+    return call_id
+
+
+def _entry_md(entry, notes):
+    started = datetime.fromisoformat(entry["started"]).strftime("%Y-%m-%d %H:%M")
+    message = f"# {started} \n## `{entry['file']}`\n"
+    if entry.get("parameters"):
+        message += "- Parameters:\n"
+        for name, value in entry["parameters"].items():
+            message += f"  - {name}: `{value}`\n"
+    message += f"- Status: {entry['status']} ({entry['wall_seconds']:.1f} s)\n"
+    if entry.get("profile"):
+        profile = entry["profile"]
+        message += (
+            f"- Profile: CPU {profile['cpu_seconds']:.1f} s, "
+            f"peak RSS {profile['peak_rss_bytes'] / 1024**2:.0f} MB, "
+            f"traced peak {profile['tracemalloc_peak_bytes'] / 1024**2:.0f} MB\n"
+        )
+    message += "- Notes:" + "".join(f"\n  - {note}" for note in notes)
+    return message
+
+
+def render_md(log_file, limit=None):
+    """
+    Write the Markdown view of the ledger to `log_file`, newest call first.
+    Entries of a Markdown log written before the ledger existed are kept in
+    `log.legacy.md` and appended.
+
+    :param limit int: Render only the most recent calls
+
+    returns: `log_file`
+    """
+    log_file = Path(log_file)
+    paths = ledger_paths(log_file)
+    if log_file.exists() and not paths["legacy"].exists():
+        with open(log_file, "r") as file:
+            content = file.read()
+        if not content.startswith(GENERATED_MARKER):
+            atomic_write(paths["legacy"], lambda tmp: Path(tmp).write_text(content))
+
+    entries = read_ledger(log_file)
+    notes = {}
+    for entry in entries:
+        if entry.get("event") == "note":
+            notes.setdefault(entry["id"], []).append(entry["note"])
+    calls = [entry for entry in entries if entry.get("event") != "note"][::-1]
+    if limit is not None:
+        calls = calls[:limit]
+
+    sections = [GENERATED_MARKER] + [_entry_md(call, notes.get(call["id"], [])) for call in calls]
+    if paths["legacy"].exists() and limit is None:
+        sections.append(paths["legacy"].read_text())
+    atomic_write(log_file, lambda tmp: Path(tmp).write_text("\n\n".join(sections) + "\n"))
+    return log_file
+
+
+def _call_entry(func, args, kwargs):
+    # Map positional arguments to their parameter names
+    names = list(inspect.signature(func).parameters)
+    parameters = {names[i]: str(arg) for i, arg in enumerate(args)}
+    parameters.update({key: str(value) for key, value in kwargs.items()})
+    started = datetime.now()
+    return {
+        "id": f"{started:%Y%m%d-%H%M%S-%f}-{os.getpid()}",
+        "started": started.isoformat(timespec="seconds"),
+        "file": os.path.basename(inspect.getfile(func)),
+        "function": func.__qualname__,
+        "pid": os.getpid(),
+        "parameters": parameters,
+    }
+
+
+def log_md(log_file=None, profile=None):
     """
     A decorator to log the execution of the main function with date, time,
-    filename, and arguments.
+    filename, arguments, status and duration to the ledger of `log_file`
+    (see `append_ledger`); render the Markdown log with `render_md`.
+
+    With profiling on (`profile=True` or MOCOMSM_PROFILE=1), every call also
+    appends wall time, CPU time (own and of finished child processes), peak
+    RSS and tracemalloc peak to `<MOCOMSM_PROFILE_DIR>/<run id>.jsonl` and the
+    ledger, and, with MOCOMSM_CPROFILE=1, dumps a cProfile .prof file.
     """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # If no log file is specified, run the function without logging
-            if log_file is None:
+            profiling = profile if profile is not None else _env_flag("MOCOMSM_PROFILE")
+
+            # If no log file is specified and profiling is off, just run the function
+            if log_file is None and not profiling:
                 return func(*args, **kwargs)
 
-            current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M")
-            caller_filename = os.path.basename(inspect.getfile(func))
-
-            # Format the header with date, time, and filename
-            header = f"# {current_datetime} \n## `{caller_filename}`\n"
-            message = ""
-
-            # Get the function's parameter names and default values
-            sig = inspect.signature(func)
-            params = sig.parameters
-
-            # Map each positional argument to its parameter name
-            if args or kwargs:
-                message += "- Parameters:\n"
-                for i, arg in enumerate(args):
-                    param_name = list(params.keys())[i]
-                    message += f"  - {param_name}: `{arg}`\n"
-                # Add each keyword argument with its original parameter name
-                for key, value in kwargs.items():
-                    message += f"  - {key}: `{value}`\n"
-            # Add a line for user notes
-            message += "- Notes:"
-
-            # Read the existing content of the log file (to prepend)
-            if os.path.exists(log_file):
-                with open(log_file, "r") as file:
-                    existing_content = file.read()
-            else:
-                existing_content = ""
-
-            # Write the new log entry at the beginning of the log file
-            with open(log_file, "w") as file:
-                file.write(header + message + "\n\n" + existing_content)
-
-            # Execute the original function
-            return func(*args, **kwargs)
+            entry = _call_entry(func, args, kwargs) if log_file is not None else None
+            measure = _Profile(func, _env_flag("MOCOMSM_CPROFILE")) if profiling else None
+            start = time.perf_counter()
+            status = "ok"
+            try:
+                if measure is None:
+                    return func(*args, **kwargs)
+                with measure:
+                    return func(*args, **kwargs)
+            except BaseException as e:
+                status = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                if entry is not None:
+                    entry.update(
+                        status=status,
+                        wall_seconds=time.perf_counter() - start,
+                        run=run_id() if profiling else None,
+                        profile=getattr(measure, "record", None),
+                    )
+                    try:
+                        append_ledger(log_file, entry)
+                    except OSError as e:
+                        print(f"-- Could not write run log {log_file}: {e}")
         return wrapper
     return decorator
+
+
+# Parse args ------------------------------------------------------------------
+def parse_arguments():
+    """
+    Parse CLI arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Render the Markdown run log from its ledger",
+        add_help=False,
+    )
+    parser.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        default=argparse.SUPPRESS,
+        help='Use switches followed by "=" to use CLI file autocomplete, example "-l="',
+    )
+    parser.add_argument(
+        "-l",
+        "--log",
+        type=str,
+        help="Markdown log file, as passed to log_md",
+        required=True,
+    )
+    parser.add_argument(
+        "-n",
+        "--limit",
+        type=int,
+        default=None,
+        help="Render only the most recent calls (default: all)",
+    )
+    parser.add_argument(
+        "--recent",
+        action="store_true",
+        help="Print the most recent calls from the index instead of rendering",
+    )
+    parser.add_argument(
+        "--note",
+        type=str,
+        default=None,
+        help="Attach a note to the most recent call before rendering",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.recent:
+        for run in recent_runs(args.log, args.limit or 10):
+            print(f"{run['started']}  {run['function']:<28} {run['status']:<10} {run['wall_seconds']:.1f} s")
+    else:
+        if args.note:
+            add_note(args.log, args.note)
+        print(f"-- Writing {render_md(args.log, args.limit)}")
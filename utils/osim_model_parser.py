@@ -4,10 +4,22 @@ Parse .osim (.xml) file for jointset and forceset elements.
 
 # Imports ---------------------------------------------------------------------
 import argparse
+import hashlib
 import numpy as np
 from pathlib import Path
+from dataclasses import asdict, dataclass, field
 from lxml import etree
 
+from utils.file_cache import (
+    cache_key,
+    file_digest,
+    file_stamp,
+    is_cache_valid,
+    read_json,
+    sidecar_path,
+    write_json,
+)
+
 
 # Parse args ------------------------------------------------------------------
 def parse_arguments():
@@ -38,6 +50,11 @@ def parse_arguments():
         type=str,
         help="Path to solution .sto model",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the model with iterparse instead of loading the full tree",
+    )
     return parser.parse_args()
 
 
@@ -55,114 +72,348 @@ def compute_orientation(vec):
     return vec / norm if norm != 0 else vec
 
 
-# Main ------------------------------------------------------------------------
-def parse_model_for_states(osim):
+@dataclass
+class ModelIndex:
     """
-    Specific order o
+    Model metadata gathered in a single traversal of an .osim file.
+
+    State, control and derivative names follow the column order of the
+    Moco.Track reference tables (see `state_table_columns`).
     """
-    states = ["time"]
-    parser = etree.XMLParser(remove_blank_text=True)
-    tree = etree.parse(osim, parser)
-    root = tree.getroot()
+    digest: str
+    joints: dict = field(default_factory=dict)
+    coordinates: list = field(default_factory=list)
+    muscles: list = field(default_factory=list)
+    path_points: dict = field(default_factory=dict)
+    states: list = field(default_factory=list)
+    controls: list = field(default_factory=list)
+    derivatives: list = field(default_factory=list)
+
+    @property
+    def state_table_columns(self):
+        return ["time"] + self.states + self.controls + self.derivatives
+
+
+MODEL_INDEX_FORMAT = 1
+# Models with embedded geometry or many path points are streamed above this size
+STREAMING_THRESHOLD = 20 * 1024 * 1024
+_model_indices = {}
+
+
+def _index_joint(joint, joints, coordinates):
+    joint_name = joint.attrib.get("name")
+    coord_names = []
+    coords = joint.find("coordinates")
+    if coords is not None:
+        coord_names = [c.attrib.get("name") for c in coords.findall("Coordinate")]
+
+    if joint_name:
+        joints[joint_name] = coord_names
+    if joint.tag != "WeldJoint":
+        joint_name = joint_name or "Unnamed Joint"
+        coordinates.extend(f"/jointset/{joint_name}/{c}" for c in coord_names)
+
+
+def _index_force(force, muscles, path_points):
+    if "DeGroote" not in force.tag:
+        return
+    muscle_name = force.attrib.get("name")
+    muscles.append(muscle_name)
+    path_points[muscle_name] = [
+        {
+            "name": point.get("name"),
+            "location": parse_location(point.findtext("location")).tolist(),
+            "parent_frame": point.findtext("socket_parent_frame"),
+        }
+        for point in force.iter("PathPoint")
+    ]
 
-    # Jointset values
-    joint_set = root.findall("Model/JointSet/objects/")
-    joints = [joint for joint in joint_set if joint.tag != "WeldJoint"]
-    for joint in joints:
-        joint_name = joint.attrib.get("name", "Unnamed Joint")
-        coordinates = joint.find("coordinates")
-        if coordinates is not None:
-            for coordinate in coordinates.findall("Coordinate"):
-                coord_name = coordinate.attrib.get("name")
-                states.append(f"/jointset/{joint_name}/{coord_name}/value")
-
-    # Jointset speed
-    joint_set = root.findall("Model/JointSet/objects/")
-    joints = [joint for joint in joint_set if joint.tag != "WeldJoint"]
-    for joint in joints:
-        joint_name = joint.attrib.get("name", "Unnamed Joint")
-        coordinates = joint.find("coordinates")
-        if coordinates is not None:
-            for coordinate in coordinates.findall("Coordinate"):
-                coord_name = coordinate.attrib.get("name")
-                states.append(f"/jointset/{joint_name}/{coord_name}/speed")
-
-    # Force activation / normalized tendon force
-    force_set = root.findall("Model/ForceSet/objects/")
-    forces = [force for force in force_set]
-    for force in forces:
-        if "DeGroote" in force.tag:
-            states.append(f"/forceset/{force.attrib.get('name')}/activation")
-            states.append(
-                f"/forceset/{force.attrib.get('name')}/normalized_tendon_force"
-            )
-
-    # Force
-    force_set = root.findall("Model/ForceSet/objects/")
-    forces = [force for force in force_set]
-    for force in forces:
-        if "DeGroote" in force.tag:
-            states.append(f"/forceset/{force.attrib.get('name')}")
-
-    # Jointset accel
-    joint_set = root.findall("Model/JointSet/objects/")
-    joints = [joint for joint in joint_set if joint.tag != "WeldJoint"]
-    for joint in joints:
-        joint_name = joint.attrib.get("name", "Unnamed Joint")
-        coordinates = joint.find("coordinates")
-        if coordinates is not None:
-            for coordinate in coordinates.findall("Coordinate"):
-                coord_name = coordinate.attrib.get("name")
-                states.append(f"/jointset/{joint_name}/{coord_name}/accel")
 
-    # Force implicitderiv_normalized_tendon_force
-    force_set = root.findall("Model/ForceSet/objects/")
-    forces = [force for force in force_set]
-    for force in forces:
-        if "DeGroote" in force.tag:
-            states.append(
-                f"/forceset/{force.attrib.get('name')}/implicitderiv_normalized_tendon_force"
-            )
+def _iter_set_objects(osim):
+    """
+    Stream the objects of the Model's sets (JointSet, BodySet, ForceSet, ...)
+    from an .osim file with `iterparse`, yielding (set name, element) for
+    JointSet and ForceSet objects.
+
+    Every set object is freed once it has been handled, together with its
+    already processed siblings, so memory stays bounded by the largest single
+    body, joint or muscle rather than by the model size.
+    """
+    for _, element in etree.iterparse(
+        str(osim),
+        events=("end",),
+        remove_blank_text=True,
+    ):
+        objects = element.getparent()
+        if objects is None or objects.tag != "objects":
+            continue
+        model_set = objects.getparent()
+        model = model_set.getparent() if model_set is not None else None
+        if model is None or model.tag != "Model":
+            # Nested objects, e.g. the PathPoints of a muscle
+            continue
+
+        if model_set.tag in ("JointSet", "ForceSet"):
+            yield model_set.tag, element
 
-    return states
+        element.clear(keep_tail=False)
+        while element.getprevious() is not None:
+            del objects[0]
 
 
-def parse_model_for_joints(osim):
-    joint_states = {}
-    parser = etree.XMLParser(remove_blank_text=True)
-    tree = etree.parse(osim, parser)
-    root = tree.getroot()
-
-    joint_set = root.findall("Model/JointSet/objects/")
-    # joints = [joint for joint in joint_set if joint.tag != "WeldJoint"]
-    joints = [joint for joint in joint_set]
+def build_model_index(osim, digest=None, streaming=False):
+    """
+    Parse an .osim file once for joints, coordinates, muscles, path points
+    and the ordered state, control and derivative names.
+
+    :param osim Path: .osim model
+    :param digest str: Precomputed sha256 of the model
+    :param streaming bool: Stream the file with `iterparse` instead of building
+        the full tree, for very large models
+    """
+    digest = file_digest(osim) if digest is None else digest
+
+    joints, coordinates = {}, []
+    muscles, path_points = [], {}
+    if streaming:
+        for set_name, element in _iter_set_objects(osim):
+            if set_name == "JointSet":
+                _index_joint(element, joints, coordinates)
+            else:
+                _index_force(element, muscles, path_points)
+    else:
+        parser = etree.XMLParser(remove_blank_text=True)
+        root = etree.parse(str(osim), parser).getroot()
+        for joint in root.findall("Model/JointSet/objects/"):
+            _index_joint(joint, joints, coordinates)
+        for force in root.findall("Model/ForceSet/objects/"):
+            _index_force(force, muscles, path_points)
+
+    return ModelIndex(
+        digest=digest,
+        joints=joints,
+        coordinates=coordinates,
+        muscles=muscles,
+        path_points=path_points,
+        states=[f"{c}/value" for c in coordinates]
+        + [f"{c}/speed" for c in coordinates]
+        + [
+            f"/forceset/{m}/{state}"
+            for m in muscles
+            for state in ("activation", "normalized_tendon_force")
+        ],
+        controls=[f"/forceset/{m}" for m in muscles],
+        derivatives=[f"{c}/accel" for c in coordinates]
+        + [f"/forceset/{m}/implicitderiv_normalized_tendon_force" for m in muscles],
+    )
+
+
+def load_model_index(osim, streaming=None):
+    """
+    Return the `ModelIndex` of an .osim file, memoized in-process and persisted
+    next to the model keyed on its content digest, so each model version is
+    parsed once.
+
+    :param osim Path: .osim model
+    :param streaming bool: Force streaming (True) or full-tree (False) parsing,
+        None streams models larger than `STREAMING_THRESHOLD` bytes
+    """
+    osim = Path(osim).resolve()
+    stamp = file_stamp(osim)
+    memo = _model_indices.get(osim)
+    if memo is not None and memo[0] == stamp:
+        return memo[1]
+
+    cache_file = sidecar_path(osim, ".index.json")
+    meta = read_json(cache_file)
+    if (
+        meta is not None
+        and meta.get("format") == MODEL_INDEX_FORMAT
+        and is_cache_valid(osim, meta)
+    ):
+        index = ModelIndex(**meta["index"])
+    else:
+        meta = cache_key(osim)
+        if streaming is None:
+            streaming = stamp[0] > STREAMING_THRESHOLD
+        index = build_model_index(osim, digest=meta["digest"], streaming=streaming)
+        meta.update(format=MODEL_INDEX_FORMAT, index=asdict(index))
+        try:
+            write_json(cache_file, meta)
+        except OSError:
+            pass
+
+    _model_indices[osim] = (stamp, index)
+    return index
+
+
+@dataclass
+class MuscleDependency:
+    """
+    What a muscle's path geometry depends on.
+
+    `coordinates` are the coordinates of the joints between the path's frames
+    (path points and wrap objects) and ground, plus coordinates that drive
+    conditional or moving path points; all coordinates when the model has
+    constraints. `digest` covers the XML of the muscle's geometry path and
+    of the bodies and joints on those chains.
+    """
+    coordinates: list
+    digest: str
+
+
+def _path_names(reference):
+    return [part for part in reference.split("/") if part not in ("", ".", "..")]
+
+
+def muscle_dependencies(osim):
+    """
+    Derive the coordinates and model elements each muscle's path depends on
+    from the .osim file.
+
+    Every ForceSet element with a `GeometryPath` is included, whatever its
+    class (e.g. `Schutte1993Muscle_Deprecated`), so the muscles of
+    `Model.getMuscles()` are a subset; path actuators and ligaments are listed
+    too.
+
+    :param osim Path: .osim model
+
+    returns: dict of force name to MuscleDependency, in ForceSet order
+    """
+    parser = etree.XMLParser(remove_blank_text=True, remove_comments=True)
+    root = etree.parse(str(osim), parser).getroot()
+    model = root.find("Model")
+
+    bodies = {body.get("name"): body for body in model.findall("BodySet/objects/")}
+    wrap_bodies = {
+        wrap.get("name"): name
+        for name, body in bodies.items()
+        for wrap in body.findall("WrapObjectSet/objects/")
+    }
+    joints = model.findall("JointSet/objects/")
+    joint_frames = {
+        joint.get("name"): {
+            frame.get("name"): frame.findtext("socket_parent")
+            for frame in joint.findall("frames/")
+        }
+        for joint in joints
+    }
+    all_coordinates = [
+        coord.get("name")
+        for joint in joints
+        for coord in joint.findall("coordinates/Coordinate")
+    ]
+
+    def frame_body(reference, scope=None, depth=0):
+        # Body a frame is fixed to: "ground", a body name, or None if unknown
+        names = _path_names(reference or "")
+        if not names or depth > 10:
+            return None
+        if len(names) >= 3 and names[0] == "jointset":
+            scope = joint_frames.get(names[1], {})
+        name = names[-1]
+        if scope and name in scope:
+            return frame_body(scope[name], depth=depth + 1)
+        if name == "ground" or name in bodies:
+            return name
+        return None
+
+    # Joint connecting every body to its parent body
+    parent_joint = {}
     for joint in joints:
-        joint_name = joint.attrib.get("name")
-        if not joint_name:
+        scope = joint_frames[joint.get("name")]
+        child = frame_body(joint.findtext("socket_child_frame"), scope)
+        parent = frame_body(joint.findtext("socket_parent_frame"), scope)
+        if child is not None:
+            parent_joint[child] = (joint, parent)
+
+    def chain(body):
+        # Joints from a body to ground, None if the chain cannot be resolved
+        joints_on_chain, seen = [], set()
+        while body != "ground":
+            if body is None or body in seen or body not in parent_joint:
+                return None
+            seen.add(body)
+            joint, parent = parent_joint[body]
+            joints_on_chain.append(joint)
+            body = parent
+        return joints_on_chain
+
+    constrained = len(model.findall("ConstraintSet/objects/")) > 0
+    dependencies = {}
+    for force in model.findall("ForceSet/objects/"):
+        geometry_path = force.find("GeometryPath")
+        if geometry_path is None:
             continue
 
-        joint_states[joint_name] = []
-        coordinates = joint.find("coordinates")
-        if coordinates is not None:
-            for coordinate in coordinates.findall("Coordinate"):
-                coord_name = coordinate.attrib.get("name")
-                joint_states[joint_name].append(coord_name)
+        path_bodies = {
+            frame_body(reference.text)
+            for reference in geometry_path.iter("socket_parent_frame")
+        }
+        path_bodies |= {
+            wrap_bodies.get(wrap.findtext("wrap_object"))
+            for wrap in geometry_path.iter("PathWrap")
+        }
+        driving = {
+            _path_names(element.text)[-1]
+            for element in geometry_path.iter()
+            if isinstance(element.tag, str)
+            and element.tag.startswith("socket_")
+            and element.tag.endswith("coordinate")
+            and element.text
+        }
 
-    return joint_states
+        chains = [chain(body) for body in path_bodies]
+        digest = hashlib.sha256(etree.tostring(geometry_path))
+        if constrained or any(joints_on_chain is None for joints_on_chain in chains):
+            # Unresolved frames or constraints: depend on the whole model
+            coordinates = list(all_coordinates)
+            digest.update(etree.tostring(model))
+        else:
+            on_chain = {id(joint) for joints_on_chain in chains for joint in joints_on_chain}
+            coordinates = [
+                coord.get("name")
+                for joint in joints
+                if id(joint) in on_chain
+                for coord in joint.findall("coordinates/Coordinate")
+            ]
+            coordinates += [
+                name for name in all_coordinates if name in driving and name not in coordinates
+            ]
+            for joint in joints:
+                if id(joint) in on_chain:
+                    digest.update(etree.tostring(joint))
+            for body in sorted(path_bodies - {"ground"}):
+                digest.update(etree.tostring(bodies[body]))
+
+        dependencies[force.get("name")] = MuscleDependency(coordinates, digest.hexdigest())
+    return dependencies
 
 
-def parse_model_for_force_vector(osim, sto):
-    parser = etree.XMLParser(remove_blank_text=True)
-    tree = etree.parse(osim, parser)
+# Main ------------------------------------------------------------------------
+def parse_model_for_states(osim):
+    """
+    Reference table columns in Moco.Track order: time, coordinate values and
+    speeds, muscle activations / normalized tendon forces, muscle controls,
+    coordinate accelerations and implicit tendon force derivatives.
+    """
+    return list(load_model_index(osim).state_table_columns)
+
+
+def parse_model_for_joints(osim):
+    return {
+        joint: list(coords) for joint, coords in load_model_index(osim).joints.items()
+    }
+
 
-    muscles = tree.xpath("//DeGrooteFregly2016Muscle")
+def parse_model_for_force_vector(osim, sto):
+    index = load_model_index(osim)
 
     # Data structure to store results
     force_vector_data = {}
 
-    for muscle in muscles:
-        muscle_name = muscle.get("name")
-        path_points = muscle.xpath(".//PathPoint")
+    for muscle_name in index.muscles:
+        path_points = index.path_points[muscle_name]
 
         if len(path_points) < 2:
             continue
@@ -170,16 +421,16 @@ def parse_model_for_force_vector(osim, sto):
         second_to_last = path_points[-2]
         last = path_points[-1]
 
-        second_to_last_location = parse_location(second_to_last.findtext("location"))
-        last_location = parse_location(last.findtext("location"))
+        second_to_last_location = np.array(second_to_last["location"])
+        last_location = np.array(last["location"])
 
         vector = last_location - second_to_last_location
         orientation = compute_orientation(vector)
 
         force_vector_data[muscle_name] = {
-            "second_to_last_pathpoint_name": second_to_last.get("name"),
+            "second_to_last_pathpoint_name": second_to_last["name"],
             "second_to_last_location": second_to_last_location.tolist(),
-            "origin_pathpoint_name": last.get("name"),
+            "origin_pathpoint_name": last["name"],
             "origin": last_location.tolist(),
             "vector_orientation": orientation.tolist(),
         }
@@ -192,6 +443,7 @@ if __name__ == "__main__":
 
     # states = parse_model_for_states(Path(args.input))
     # parse_model_for_force_vector(args.input, args.sto)
+    load_model_index(args.input, streaming=args.stream or None)
     parse_model_for_joints(args.input)
 
     # [print(state) for state in states]
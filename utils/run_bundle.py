@@ -0,0 +1,385 @@
+"""
+Run bundle: the outputs of a tracking run in one chunked, compressed HDF5 file.
+
+Layout of `<solution stem>_run.h5`:
+    /tables/<name>/time       (T,) float64, shared (hard-linked) between
+                              tables on the same time axis
+    /tables/<name>/data       (T, C) float64 or float32
+    /tables/<name>/columns    (C,) column labels, .sto header as attribute
+    /force_vectors/time       (T,)
+    /force_vectors/muscles    (M,)
+    /force_vectors/origins    (T, M, 3)
+    /force_vectors/directions (T, M, 3)
+
+Datasets are chunked along time and columns, so columns and time slices are
+read without decompressing the rest of the file. HDF5 does not reclaim the
+space of deleted objects, so replacing a table or the force vectors rewrites
+the bundle into a new file that is swapped in atomically.
+"""
+
+# Imports ---------------------------------------------------------------------
+import argparse
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from utils.file_cache import atomic_write
+from utils.sto_io import read_sto, select_columns
+
+
+# Parse args ------------------------------------------------------------------
+def parse_arguments():
+    """
+    Parse CLI arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Collect the outputs of a tracking run into one HDF5 run bundle",
+        add_help=False,
+    )
+    parser.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        default=argparse.SUPPRESS,
+        help='Use switches followed by "=" to use CLI file autocomplete, example "-s="',
+    )
+    parser.add_argument(
+        "-s",
+        "--solution",
+        type=str,
+        help="Tracking solution (<trial>_success.sto), or a bundle with --list",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=None,
+        help="Bundle file (default: <solution stem>_run.h5)",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Store values as float32, halving the file size",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="List the datasets of a bundle",
+    )
+    return parser.parse_args()
+
+
+# Defs ------------------------------------------------------------------------
+BUNDLE_SUFFIX = ".h5"
+CHUNK_ROWS = 256
+CHUNK_COLUMNS = 64
+COMPRESSION = dict(compression="gzip", compression_opts=4, shuffle=True)
+
+# Table name to the suffix of the .sto written next to the solution
+RUN_TABLES = {
+    "solution": "",
+    "fullstride": "_fullstride",
+    "muscle_fiber_data": "_muscle_fiber_data",
+}
+
+
+def bundle_path(solution_file):
+    """Default bundle of a tracking solution: `<solution stem>_run.h5`."""
+    solution_file = Path(solution_file)
+    return solution_file.with_name(f"{solution_file.stem}_run{BUNDLE_SUFFIX}")
+
+
+def is_bundle(path):
+    return path is not None and Path(path).suffix == BUNDLE_SUFFIX
+
+
+def _strings(dataset):
+    return [
+        value.decode() if isinstance(value, bytes) else str(value)
+        for value in dataset[()]
+    ]
+
+
+def _chunks(shape):
+    # Chunks may not exceed the data, so empty datasets are chunked by h5py
+    if 0 in shape:
+        return True
+    return tuple(
+        min(size, limit) for size, limit in zip(shape, (CHUNK_ROWS, CHUNK_COLUMNS, 3))
+    )
+
+
+def _write_time(bundle, group, time):
+    # Hard-link the time axis of an earlier table when the samples are identical
+    tables = [f"tables/{table}" for table in bundle.get("tables", {})]
+    for name in ["force_vectors"] + tables:
+        other = bundle.get(f"{name}/time")
+        if (
+            other is not None
+            and other.name != f"{group.name}/time"
+            and other.shape == time.shape
+            and np.array_equal(other[()], time)
+        ):
+            group["time"] = other
+            return
+    group.create_dataset("time", data=time, dtype="f8", chunks=True, **COMPRESSION)
+
+
+def _copy_except(source, target, skip):
+    # Copy a bundle's groups and datasets except `skip`, re-linking time axes
+    for name, item in source.items():
+        if item.name.lstrip("/") == skip:
+            continue
+        if isinstance(item, h5py.Group):
+            group = target.require_group(name)
+            group.attrs.update(item.attrs)
+            _copy_except(item, group, skip)
+        elif name == "time":
+            _write_time(target.file, target, item[()])
+        else:
+            source.copy(item, target, name=name)
+
+
+def _update_bundle(bundle_file, name, write):
+    # Rewrite the bundle without group `name`, then call `write(bundle, group)`
+    # with a new, empty group of that name
+    bundle_file = Path(bundle_file)
+
+    def rewrite(tmp_path):
+        with h5py.File(tmp_path, "w") as bundle:
+            if bundle_file.exists():
+                with h5py.File(bundle_file, "r") as source:
+                    _copy_except(source, bundle, name)
+            write(bundle, bundle.require_group(name))
+
+    atomic_write(bundle_file, rewrite)
+
+
+def write_bundle_table(bundle_file, name, df, header=None, float32=False):
+    """
+    Store a table (`time` first column) in a bundle, replacing an existing
+    table of the same name.
+
+    :param bundle_file Path: Bundle, created if missing
+    :param name str: Table name, e.g. "solution"
+    :param df pd.DataFrame: Table with `time` as first column
+    :param header list: .sto header lines, kept to write the table back
+    :param float32 bool: Store values in single precision
+    """
+    columns = [column for column in df.columns if column != "time"]
+    data = df[columns].to_numpy(dtype="f4" if float32 else "f8")
+
+    def write(bundle, group):
+        _write_time(bundle, group, df["time"].to_numpy(dtype="f8"))
+        group.create_dataset(
+            "data",
+            data=data,
+            chunks=_chunks(data.shape),
+            **COMPRESSION,
+        )
+        group.create_dataset("columns", data=columns, dtype=h5py.string_dtype())
+        group.attrs["header"] = "".join(header or [])
+
+    _update_bundle(bundle_file, f"tables/{name}", write)
+
+
+def write_bundle_force_vectors(
+    bundle_file,
+    time,
+    muscles,
+    origins,
+    directions,
+    float32=False,
+):
+    """
+    Store force vector arrays (see `src.force_vector_extractor.ForceVectors`)
+    in a bundle, replacing earlier ones.
+    """
+    dtype = "f4" if float32 else "f8"
+
+    def write(bundle, group):
+        _write_time(bundle, group, np.asarray(time, dtype="f8"))
+        group.create_dataset("muscles", data=list(muscles), dtype=h5py.string_dtype())
+        for name, values in (("origins", origins), ("directions", directions)):
+            values = np.asarray(values, dtype=dtype)
+            group.create_dataset(
+                name,
+                data=values,
+                chunks=_chunks(values.shape),
+                **COMPRESSION,
+            )
+
+    _update_bundle(bundle_file, "force_vectors", write)
+
+
+def _time_rows(time, time_range):
+    if time_range is None:
+        return 0, time.shape[0]
+    start, stop = time_range
+    times = time[()]
+    first = 0 if start is None else int(np.searchsorted(times, start, side="left"))
+    last = len(times) if stop is None else int(np.searchsorted(times, stop, side="right"))
+    return first, last
+
+
+def _select(dataset, rows, indices, step=None):
+    # h5py reads one increasing index list per axis; restore the requested order
+    num_rows = len(range(*rows, step or 1))
+    if not indices or num_rows == 0:
+        # h5py cannot combine an index list with an empty row selection
+        return np.empty((num_rows, len(indices)) + dataset.shape[2:], dtype=dataset.dtype)
+    order = np.argsort(indices)
+    sorted_indices = [indices[i] for i in order]
+    values = dataset[slice(*rows, step), sorted_indices]
+    restored = np.empty_like(values)
+    restored[:, order] = values
+    return restored
+
+
+def read_bundle_table(bundle_file, name, columns=None, patterns=None, time_range=None):
+    """
+    Read (part of) a bundle table, like `utils.sto_io.read_sto`.
+
+    :param bundle_file Path: Bundle
+    :param name str: Table name, e.g. "solution" or "muscle_fiber_data"
+    :param columns list | callable: See `utils.sto_io.select_columns`
+    :param patterns list: See `utils.sto_io.select_columns`
+    :param time_range tuple: (start, stop) in seconds, either may be None
+
+    returns: `df`, `header`
+    """
+    with h5py.File(bundle_file, "r") as bundle:
+        group = bundle[f"tables/{name}"]
+        labels = _strings(group["columns"])
+        selected = select_columns(["time"] + labels, columns, patterns)
+        selected = labels if selected is None else [c for c in selected if c != "time"]
+        index = {label: i for i, label in enumerate(labels)}
+
+        rows = _time_rows(group["time"], time_range)
+        df = pd.DataFrame(
+            _select(group["data"], rows, [index[c] for c in selected]).astype("f8"),
+            columns=selected,
+        )
+        df.insert(0, "time", group["time"][slice(*rows)])
+        header = group.attrs["header"].splitlines(keepends=True)
+    return df, header
+
+
+def read_bundle_force_vectors(bundle_file, muscles=None, time_range=None, step=None):
+    """
+    Read (part of) the force vectors of a bundle.
+
+    :param muscles list: Muscles to read, default all
+    :param time_range tuple: (start, stop) in seconds, either may be None
+    :param step int: Read every `step`-th frame only
+
+    returns: `time`, `muscles`, `origins`, `directions` with the arrays
+        shaped (time, muscle, 3)
+    """
+    with h5py.File(bundle_file, "r") as bundle:
+        group = bundle["force_vectors"]
+        names = _strings(group["muscles"])
+        muscles = names if muscles is None else list(muscles)
+        indices = [names.index(muscle) for muscle in muscles]
+        rows = _time_rows(group["time"], time_range)
+        return (
+            group["time"][slice(*rows, step)],
+            muscles,
+            _select(group["origins"], rows, indices, step).astype("f8"),
+            _select(group["directions"], rows, indices, step).astype("f8"),
+        )
+
+
+def bundle_contents(bundle_file):
+    """
+    Names of the tables in a bundle, plus "force_vectors" if it holds them.
+
+    returns: set of names, empty if the bundle does not exist
+    """
+    if bundle_file is None or not Path(bundle_file).is_file():
+        return set()
+    with h5py.File(bundle_file, "r") as bundle:
+        names = set(bundle.get("tables", {}))
+        if "force_vectors" in bundle:
+            names.add("force_vectors")
+    return names
+
+
+def list_bundle(bundle_file):
+    """
+    Datasets of a bundle, listing shared time axes under every table.
+
+    returns: dict of dataset path to (shape, dtype)
+    """
+    contents = {}
+
+    def walk(group):
+        for item in group.values():
+            if isinstance(item, h5py.Group):
+                walk(item)
+            else:
+                contents[item.name.lstrip("/")] = (item.shape, str(item.dtype))
+
+    with h5py.File(bundle_file, "r") as bundle:
+        walk(bundle)
+    return contents
+
+
+def _read_force_vector_json(force_origins_path, force_vectors_path):
+    force_origins = pd.read_json(force_origins_path, orient="records", lines=True)
+    force_vectors = pd.read_json(force_vectors_path, orient="records", lines=True)
+    muscles = [name for name in force_vectors.columns if name != "time"]
+    origins = np.array([force_origins[m].tolist() for m in muscles]).transpose(1, 0, 2)
+    directions = np.array([force_vectors[m].tolist() for m in muscles]).transpose(1, 0, 2)
+    return force_vectors["time"].to_numpy(), muscles, origins, directions
+
+
+# Main ------------------------------------------------------------------------
+def bundle_run(solution_file, output_file=None, float32=False):
+    """
+    Collect a tracking run's outputs found next to its solution (full stride,
+    muscle fiber data, force vector JSON) into one bundle.
+
+    :param solution_file Path: `<trial>_success.sto`
+    :param output_file Path: Bundle, default `<solution stem>_run.h5`
+    :param float32 bool: Store values in single precision
+
+    returns: `output_file`
+    """
+    solution_file = Path(solution_file)
+    output_file = Path(output_file) if output_file else bundle_path(solution_file)
+    stem = solution_file.with_suffix("")
+
+    print(f"-- Bundling {solution_file.name}:")
+    for name, suffix in RUN_TABLES.items():
+        table_file = Path(f"{stem}{suffix}.sto")
+        if table_file.exists():
+            df, header = read_sto(table_file)
+            write_bundle_table(output_file, name, df, header, float32=float32)
+            print(f" - {name}: {table_file.name}")
+
+    force_origins_path = Path(f"{stem}_muscle_origins.json")
+    force_vectors_path = Path(f"{stem}_muscle_vectors.json")
+    if force_origins_path.exists() and force_vectors_path.exists():
+        write_bundle_force_vectors(
+            output_file,
+            *_read_force_vector_json(force_origins_path, force_vectors_path),
+            float32=float32,
+        )
+        print(f" - force_vectors: {force_vectors_path.name}")
+
+    print(f"-- Writing {output_file}")
+    return output_file
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.list:
+        for name, (shape, dtype) in list_bundle(args.solution).items():
+            print(f"{name:<40} {str(shape):<16} {dtype}")
+    else:
+        bundle_run(Path(args.solution), args.output, float32=args.float32)
@@ -0,0 +1,125 @@
+"""
+Content-addressed cache for Moco solve outputs.
+
+A solve is keyed on the digests of its input files and every setting that
+affects the result; a cache entry holds copies of the files the solve wrote.
+"""
+
+# Imports ---------------------------------------------------------------------
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import tempfile
+from pathlib import Path
+
+from utils.file_cache import file_digest
+
+
+# Defs ------------------------------------------------------------------------
+SOLVE_CACHE_DIR = Path(
+    os.environ.get(
+        "MOCOMSM_SOLVE_CACHE",
+        Path.home() / ".cache" / "mocomsm" / "solves",
+    )
+)
+SOLVE_CACHE_MAX_BYTES = int(
+    os.environ.get("MOCOMSM_SOLVE_CACHE_MAX_BYTES", 5 * 1024**3)
+)
+
+
+def code_digest(*funcs):
+    """
+    Digest of the source of the functions that set up a problem, so editing
+    goals, bounds or solver settings invalidates previously cached solutions.
+    """
+    digest = hashlib.sha256()
+    for func in funcs:
+        digest.update(inspect.getsource(inspect.unwrap(func)).encode())
+    return digest.hexdigest()
+
+
+def solve_key(input_files=None, **settings):
+    """
+    Key of a solve: digests of its input files plus all settings.
+
+    :param input_files dict: Role (e.g. "model") to file path
+    :param settings: JSON-serializable solver, goal and filter settings
+    """
+    parts = {
+        "inputs": {
+            role: file_digest(path) for role, path in (input_files or {}).items()
+        },
+        "settings": settings,
+    }
+    encoded = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def fetch_solve(key, outputs, cache_dir=SOLVE_CACHE_DIR):
+    """
+    Copy a cached solve's files to their output paths.
+
+    :param key str: `solve_key` of the solve
+    :param outputs dict: Entry name to destination path
+
+    returns: True on a cache hit
+    """
+    entry = Path(cache_dir) / key
+    if not all((entry / name).is_file() for name in outputs):
+        return False
+
+    for name, destination in outputs.items():
+        shutil.copyfile(entry / name, destination)
+    # Mark as recently used for eviction
+    os.utime(entry)
+    return True
+
+
+def store_solve(key, outputs, cache_dir=SOLVE_CACHE_DIR, max_bytes=SOLVE_CACHE_MAX_BYTES):
+    """
+    Store a solve's files under `key` and evict old entries beyond `max_bytes`.
+
+    :param key str: `solve_key` of the solve
+    :param outputs dict: Entry name to the path of the written file
+    """
+    cache_dir = Path(cache_dir)
+    entry = cache_dir / key
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_entry = Path(tempfile.mkdtemp(dir=cache_dir, prefix=f".{key}."))
+    try:
+        for name, source in outputs.items():
+            shutil.copyfile(source, tmp_entry / name)
+        if entry.exists():
+            shutil.rmtree(entry)
+        os.replace(tmp_entry, entry)
+    finally:
+        if tmp_entry.exists():
+            shutil.rmtree(tmp_entry)
+
+    evict_solves(cache_dir, max_bytes, keep=key)
+
+
+def _entry_size(entry):
+    return sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+
+
+def evict_solves(cache_dir=SOLVE_CACHE_DIR, max_bytes=SOLVE_CACHE_MAX_BYTES, keep=None):
+    """Remove least recently used entries until the cache fits `max_bytes`."""
+    cache_dir = Path(cache_dir)
+    entries = [
+        entry
+        for entry in cache_dir.iterdir()
+        if entry.is_dir() and not entry.name.startswith(".")
+    ]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    sizes = {entry: _entry_size(entry) for entry in entries}
+    total = sum(sizes.values())
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if entry.name == keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
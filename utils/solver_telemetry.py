@@ -0,0 +1,273 @@
+"""
+Live telemetry of IPOPT solves run through Moco.
+
+IPOPT prints one line per iteration to the process' stdout. While a
+`SolverTelemetry` is active, stdout is routed through a pipe; a reader thread
+passes every line on unchanged and turns iteration lines into records that are
+appended to a JSON-lines file and handed to a callback. IPOPT writes through C
+stdio, which fully buffers a pipe, so the C stdout is switched to line
+buffering and flushed before stdout is restored.
+"""
+
+# Imports ---------------------------------------------------------------------
+import os
+import re
+import sys
+import json
+import time
+import ctypes
+import threading
+from pathlib import Path
+
+
+# Defs ------------------------------------------------------------------------
+IPOPT_ITERATION = re.compile(
+    r"^\s*(?P<iteration>\d+)(?P<restoration>r?)\s+"
+    r"(?P<objective>[-+]?\d\.\d+e[-+]\d+)\s+"
+    r"(?P<inf_pr>\d\.\d+e[-+]\d+)\s+"
+    r"(?P<inf_du>\d\.\d+e[-+]\d+)\s+"
+)
+STALLED_EXIT_CODE = 75
+
+
+def _c_stdio():
+    # C runtime and its stdout FILE*, which IPOPT prints through
+    try:
+        if sys.platform == "win32":
+            libc = ctypes.CDLL("ucrtbase")
+            libc.__acrt_iob_func.restype = ctypes.c_void_p
+            libc.__acrt_iob_func.argtypes = [ctypes.c_uint]
+            stdout = libc.__acrt_iob_func(1)
+        else:
+            libc = ctypes.CDLL(None)
+            name = "__stdoutp" if sys.platform == "darwin" else "stdout"
+            stdout = ctypes.c_void_p.in_dll(libc, name).value
+        libc.fflush.argtypes = [ctypes.c_void_p]
+        libc.setvbuf.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_char_p,
+            ctypes.c_int,
+            ctypes.c_size_t,
+        ]
+    except (OSError, AttributeError, ValueError):
+        return None, None
+    return libc, stdout
+
+
+_LIBC, _C_STDOUT = _c_stdio()
+# The Windows CRT treats _IOLBF as full buffering, so it gets no buffering
+_C_LINE_BUFFERED = 0x4 if sys.platform == "win32" else 1
+
+
+def flush_c_stdio():
+    """Flush all C stdio output buffers, e.g. IPOPT's."""
+    if _LIBC is not None:
+        _LIBC.fflush(None)
+
+
+def _line_buffer_c_stdout():
+    if _LIBC is not None and _C_STDOUT:
+        _LIBC.fflush(_C_STDOUT)
+        _LIBC.setvbuf(_C_STDOUT, None, _C_LINE_BUFFERED, 0)
+
+
+def parse_ipopt_line(line):
+    """
+    Parse an IPOPT iteration line.
+
+    returns: dict with iteration, objective, inf_pr (constraint violation),
+        inf_du and restoration, or None for other lines
+    """
+    match = IPOPT_ITERATION.match(line)
+    if match is None:
+        return None
+    return {
+        "iteration": int(match["iteration"]),
+        "objective": float(match["objective"]),
+        "inf_pr": float(match["inf_pr"]),
+        "inf_du": float(match["inf_du"]),
+        "restoration": bool(match["restoration"]),
+    }
+
+
+def read_telemetry(jsonl_file):
+    """
+    Read the records of a telemetry file, skipping a partially written last line.
+
+    returns: `records`: list of dicts
+    """
+    records = []
+    try:
+        with open(jsonl_file, "r") as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    except FileNotFoundError:
+        pass
+    return records
+
+
+class SolverTelemetry:
+    """
+    Capture IPOPT progress from stdout while active (use as context manager).
+
+    A solve is considered stalled when neither the objective nor the
+    constraint violation improved by more than `stall_tolerance` (relative)
+    within the last `stall_iterations` iterations.
+
+    :param jsonl_file Path: Append one JSON record per iteration and event
+    :param callback callable: Called with every record, from the reader thread
+    :param stall_iterations int: Iterations without progress before a solve
+        counts as stalled, None disables stall detection
+    :param stall_tolerance float: Relative improvement that counts as progress
+    :param exit_on_stall bool: Terminate the process with `STALLED_EXIT_CODE`
+        when a solve stalls; IPOPT cannot be interrupted from Python, so this
+        is meant for solves running in their own process
+    :param echo bool: Pass the captured output on to the original stdout
+    """
+
+    def __init__(
+        self,
+        jsonl_file=None,
+        callback=None,
+        stall_iterations=None,
+        stall_tolerance=1e-3,
+        exit_on_stall=False,
+        echo=True,
+    ):
+        self.jsonl_file = Path(jsonl_file) if jsonl_file else None
+        self.callback = callback
+        self.stall_iterations = stall_iterations
+        self.stall_tolerance = stall_tolerance
+        self.exit_on_stall = exit_on_stall
+        self.echo = echo
+        self.phase = "solve"
+        self.stalled = None
+        self.last = None
+        self._reader = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def start(self):
+        """Route stdout through the telemetry pipe."""
+        if self.jsonl_file is not None:
+            self.jsonl_file.parent.mkdir(parents=True, exist_ok=True)
+            self.jsonl_file.write_text("")
+        self._start = time.perf_counter()
+        self._solve = 0
+        self._reset_progress()
+
+        sys.stdout.flush()
+        flush_c_stdio()
+        self._stdout = os.dup(1)
+        read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, 1)
+        os.close(write_fd)
+        # Pass IPOPT's iterations on as they are printed, not in 4 KB blocks
+        _line_buffer_c_stdout()
+        self._reader = threading.Thread(target=self._read, args=(read_fd,), daemon=True)
+        self._reader.start()
+
+    def stop(self):
+        """Restore stdout and wait for the remaining output to be processed."""
+        if self._reader is None:
+            return
+        sys.stdout.flush()
+        # IPOPT's last lines (final iterations, exit status) may still sit in
+        # the C buffer and must go through the pipe before it is replaced
+        flush_c_stdio()
+        # Replacing fd 1 closes the pipe's last write end, ending the reader
+        os.dup2(self._stdout, 1)
+        self._reader.join()
+        os.close(self._stdout)
+        self._reader = None
+
+    def _reset_progress(self):
+        self._best_objective = None
+        self._best_inf_pr = None
+        self._last_progress = 0
+        self._last_iteration = -1
+        self._stall_reported = False
+
+    def _read(self, read_fd):
+        jsonl = open(self.jsonl_file, "a") if self.jsonl_file is not None else None
+        try:
+            with os.fdopen(read_fd, "rb") as pipe:
+                for raw_line in pipe:
+                    if self.echo:
+                        os.write(self._stdout, raw_line)
+                    record = parse_ipopt_line(raw_line.decode(errors="replace"))
+                    if record is not None:
+                        self._emit(record, jsonl)
+        finally:
+            if jsonl is not None:
+                jsonl.close()
+
+    def _emit(self, record, jsonl):
+        # IPOPT restarts its count for every solve (e.g. per continuation level)
+        if record["iteration"] <= self._last_iteration:
+            self._solve += 1
+            self._reset_progress()
+        self._last_iteration = record["iteration"]
+        record.update(
+            solve=self._solve,
+            phase=self.phase,
+            elapsed=time.perf_counter() - self._start,
+        )
+        self._write(record, jsonl)
+
+        if self.stall_iterations and not self._stall_reported and self._is_stalled(record):
+            self._stall_reported = True
+            self.stalled = dict(record, event="stalled")
+            self._write(self.stalled, jsonl)
+            if self.exit_on_stall:
+                if jsonl is not None:
+                    jsonl.close()
+                os.write(self._stdout, f"-- Solve stalled at iteration {record['iteration']}\n".encode())
+                os._exit(STALLED_EXIT_CODE)
+
+    def _write(self, record, jsonl):
+        self.last = record
+        if jsonl is not None:
+            jsonl.write(json.dumps(record) + "\n")
+            jsonl.flush()
+        if self.callback is not None:
+            try:
+                self.callback(record)
+            except Exception as e:
+                os.write(self._stdout, f"-- Telemetry callback failed: {e}\n".encode())
+
+    def _is_stalled(self, record):
+        objective, inf_pr = record["objective"], record["inf_pr"]
+        progress = (
+            self._best_objective is None
+            or objective < self._best_objective - self.stall_tolerance * abs(self._best_objective)
+            or inf_pr < self._best_inf_pr * (1 - self.stall_tolerance)
+        )
+        if progress:
+            self._last_progress = record["iteration"]
+        if self._best_objective is None:
+            self._best_objective, self._best_inf_pr = objective, inf_pr
+        else:
+            self._best_objective = min(self._best_objective, objective)
+            self._best_inf_pr = min(self._best_inf_pr, inf_pr)
+        return record["iteration"] - self._last_progress >= self.stall_iterations
+
+
+def as_telemetry(telemetry):
+    """
+    Accept a SolverTelemetry, a JSON-lines path or None.
+
+    returns: SolverTelemetry or None
+    """
+    if telemetry is None or isinstance(telemetry, SolverTelemetry):
+        return telemetry
+    return SolverTelemetry(jsonl_file=telemetry)
@@ -0,0 +1,136 @@
+"""
+Memory-mapped binary sidecar cache for parsed .sto trajectories.
+
+The numeric block of a .sto is stored column-major in a .npy file and its
+header and labels in a .json file, both keyed on the source's size, mtime and
+content digest (see `utils.file_cache`).
+"""
+
+# Imports ---------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+from utils.file_cache import (
+    atomic_write,
+    cache_key,
+    is_cache_valid,
+    read_json,
+    sidecar_path,
+    write_json,
+)
+from utils.sto_io import read_sto, select_columns
+
+
+# Defs ------------------------------------------------------------------------
+CACHE_FORMAT = 1
+
+
+def _cache_paths(input_file):
+    return sidecar_path(input_file, ".npy"), sidecar_path(input_file, ".json")
+
+
+def write_sto_cache(input_file, df, header):
+    """
+    Store a parsed .sto next to its source.
+
+    returns: `meta`: cache metadata, or None if the table is not purely numeric
+    """
+    try:
+        data = np.asfortranarray(df.to_numpy(dtype=np.float64))
+    except (TypeError, ValueError):
+        return None
+
+    data_path, meta_path = _cache_paths(input_file)
+    meta = cache_key(input_file)
+    meta.update(
+        format=CACHE_FORMAT,
+        header=header,
+        columns=list(df.columns),
+    )
+    def write_data(tmp_path):
+        with open(tmp_path, "wb") as file:
+            np.save(file, data)
+
+    atomic_write(data_path, write_data)
+    write_json(meta_path, meta)
+    return meta
+
+
+def load_sto_cache(input_file, columns=None, patterns=None, time_range=None):
+    """
+    Load a cached .sto as a DataFrame backed by the memory-mapped array.
+
+    Selecting all columns returns a zero-copy view; projections only copy the
+    requested columns.
+
+    returns: `df`, `header`, or None if there is no valid cache
+    """
+    data_path, meta_path = _cache_paths(input_file)
+    meta = read_json(meta_path)
+    if meta is None or meta.get("format") != CACHE_FORMAT or not data_path.exists():
+        return None
+    mtime_ns = meta.get("mtime_ns")
+    if not is_cache_valid(input_file, meta):
+        return None
+    if meta["mtime_ns"] != mtime_ns:
+        # Same content under a new mtime, store it to skip hashing next time
+        try:
+            write_json(meta_path, meta)
+        except OSError:
+            pass
+
+    try:
+        # Copy-on-write: callers may edit the DataFrame without touching the cache
+        data = np.load(data_path, mmap_mode="c")
+    except (OSError, ValueError):
+        return None
+
+    labels = meta["columns"]
+    if time_range is not None:
+        times = data[:, labels.index("time")]
+        start, stop = time_range
+        first = 0 if start is None else np.searchsorted(times, start, side="left")
+        last = len(times) if stop is None else np.searchsorted(times, stop, side="right")
+        data = data[first:last]
+
+    selected = select_columns(labels, columns, patterns)
+    if selected is not None:
+        data = data[:, [labels.index(label) for label in selected]]
+        labels = selected
+
+    return pd.DataFrame(data, columns=labels, copy=False), meta["header"]
+
+
+def read_sto_cached(input_file, columns=None, patterns=None, time_range=None):
+    """
+    Drop-in replacement for `read_sto` that serves repeated loads from the
+    sidecar cache and rebuilds it whenever the source changed.
+
+    returns: `df`, `header`
+    """
+    cached = load_sto_cache(input_file, columns, patterns, time_range)
+    if cached is not None:
+        return cached
+
+    df, header = read_sto(input_file)
+    try:
+        meta = write_sto_cache(input_file, df, header)
+    except OSError:
+        meta = None
+    if meta is not None:
+        cached = load_sto_cache(input_file, columns, patterns, time_range)
+        if cached is not None:
+            return cached
+
+    # Cache not writable or table not numeric: project the parsed table
+    if time_range is not None:
+        start, stop = time_range
+        if start is not None:
+            df = df[df["time"] >= start]
+        if stop is not None:
+            df = df[df["time"] <= stop]
+        df = df.reset_index(drop=True)
+    selected = select_columns(list(df.columns), columns, patterns)
+    if selected is not None:
+        df = df[selected]
+    return df, header
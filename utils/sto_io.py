@@ -0,0 +1,197 @@
+"""
+Read and write OpenSim .sto (storage) files.
+"""
+
+# Imports ---------------------------------------------------------------------
+import re
+import pandas as pd
+
+
+# Defs ------------------------------------------------------------------------
+# Ten significant digits keeps well below Moco's solver tolerances while
+# writing roughly half the characters of the full-precision repr.
+STO_FLOAT_FORMAT = "%.10g"
+
+
+def write_sto_body(file, df, float_format=STO_FLOAT_FORMAT):
+    """
+    Write the column labels and the numeric block of `df` to an open file.
+
+    :param file: Text file handle, positioned after the header
+    :param df pd.DataFrame: Table with `time` as first column
+    :param float_format str: printf-style format applied to every float cell
+    """
+    df.to_csv(
+        file,
+        sep="\t",
+        index=False,
+        float_format=float_format,
+        na_rep="NaN",
+        lineterminator="\n",
+    )
+
+
+def write_sto(output_file, header, df, float_format=STO_FLOAT_FORMAT):
+    """
+    Write header and data of a .sto file in a single open.
+
+    :param output_file Path: .sto file to (over)write
+    :param header list: Header lines, including the closing `endheader\\n`
+    :param df pd.DataFrame: Table with `time` as first column
+    :param float_format str: printf-style format applied to every float cell
+
+    returns: `output_file`
+    """
+    with open(output_file, "w") as file:
+        file.writelines(header)
+        write_sto_body(file, df, float_format=float_format)
+
+    return output_file
+
+
+def read_sto_header(file):
+    """
+    Read header lines from an open .sto file up to and including `endheader`.
+
+    :param file: Text file handle positioned at the start of the file
+
+    returns: `header`: list of header lines
+    """
+    header = []
+    for line in iter(file.readline, ""):
+        header.append(line)
+        if "endheader" in line:
+            break
+    return header
+
+
+def read_sto_metadata(header):
+    """
+    Parse `key=value` header lines, e.g. Moco's `objective`, `success` and
+    `num_iterations`, into a dict of strings.
+
+    :param header list: Header lines from `read_sto_header`
+
+    returns: `metadata`: dict of key to value
+    """
+    metadata = {}
+    for line in header:
+        key, sep, value = line.strip().partition("=")
+        if sep:
+            metadata[key] = value
+    return metadata
+
+
+def select_columns(labels, columns=None, patterns=None):
+    """
+    Project .sto column labels onto the requested subset, keeping file order.
+
+    :param labels list: All column labels of the .sto
+    :param columns list | callable: Column names to keep, or a predicate on the label
+    :param patterns list: Regular expressions matched against the full label,
+        as in `study.analyze` (e.g. r".*activation")
+
+    returns: `selected`: list of labels, always including `time`, or None for all
+    """
+    if columns is None and patterns is None:
+        return None
+
+    if callable(columns):
+        keep = columns
+    else:
+        names = set(columns) if columns is not None else set()
+        regexes = [re.compile(p) for p in patterns] if patterns is not None else []
+
+        def keep(label):
+            return label in names or any(r.fullmatch(label) for r in regexes)
+
+    return [label for label in labels if label == "time" or keep(label)]
+
+
+def _clip_time(df, time_range):
+    start, stop = time_range
+    mask = pd.Series(True, index=df.index)
+    if start is not None:
+        mask &= df["time"] >= start
+    if stop is not None:
+        mask &= df["time"] <= stop
+    return df[mask]
+
+
+def _read_body(file, labels, usecols, chunksize, time_range):
+    # Rows are time-ordered, so reading stops at the first chunk past `stop`
+    reader = pd.read_csv(
+        file,
+        sep="\t",
+        header=None,
+        names=labels,
+        usecols=usecols,
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        if time_range is not None:
+            stop = time_range[1]
+            past_stop = stop is not None and chunk["time"].iloc[0] > stop
+            if past_stop:
+                break
+            chunk = _clip_time(chunk, time_range)
+        yield chunk
+
+
+def iter_sto_chunks(
+    input_file,
+    chunksize=4096,
+    columns=None,
+    patterns=None,
+    time_range=None,
+):
+    """
+    Stream a .sto file as DataFrames of at most `chunksize` rows.
+
+    :param input_file Path: .sto file
+    :param chunksize int: Rows per chunk
+    :param columns list | callable: See `select_columns`
+    :param patterns list: See `select_columns`
+    :param time_range tuple: (start, stop) in seconds, either may be None
+
+    yields: `df`: next chunk of rows
+    """
+    with open(input_file, "r") as file:
+        read_sto_header(file)
+        labels = file.readline().rstrip("\n").split("\t")
+        usecols = select_columns(labels, columns, patterns)
+        yield from _read_body(file, labels, usecols, chunksize, time_range)
+
+
+def read_sto(input_file, columns=None, patterns=None, time_range=None):
+    """
+    Read a .sto file in a single pass, optionally projecting columns and rows.
+
+    :param input_file Path: .sto file
+    :param columns list | callable: See `select_columns`
+    :param patterns list: See `select_columns`
+    :param time_range tuple: (start, stop) in seconds, either may be None
+
+    returns: `df`, `header`
+    """
+    with open(input_file, "r") as file:
+        header = read_sto_header(file)
+        labels = file.readline().rstrip("\n").split("\t")
+        usecols = select_columns(labels, columns, patterns)
+        if time_range is None:
+            df = pd.read_csv(
+                file,
+                sep="\t",
+                header=None,
+                names=labels,
+                usecols=usecols,
+            )
+        else:
+            chunks = list(_read_body(file, labels, usecols, 4096, time_range))
+            df = (
+                pd.concat(chunks, ignore_index=True)
+                if chunks
+                else pd.DataFrame(columns=usecols or labels)
+            )
+
+    return df, header